@@ -0,0 +1,681 @@
+import asyncio
+import datetime as dt
+import heapq
+import json
+import signal
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import aiohttp
+import telegram
+from telegram.error import BadRequest, ChatMigrated, Conflict, NetworkError, RetryAfter, Unauthorized
+
+import main
+from backends import is_quota_error
+from outbox import Outbox, _Message
+
+DRIVE_API = "https://www.googleapis.com/drive/v3/"
+TELEGRAM_API = "https://api.telegram.org/bot{token}/"
+POLL_TIMEOUT = 30   # secondi di long polling di getUpdates
+
+
+class StateOwner:
+    """
+    Unico thread che modifica lo stato (reminder_cache, sending_keys, topologia, digest) nel
+    motore asyncio: scansioni, invii e update gli passano le funzioni di main da eseguire,
+    una alla volta e nell'ordine di arrivo. Quelle funzioni scrivono su SQLite e sul journal
+    e prendono `lock`: girando su un thread dedicato (run_in_executor con un solo worker)
+    non bloccano mai il loop, e nessuna coroutine aspetta `lock` o SQLite.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._executor = None
+        self.applied = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-owner")
+
+    def _apply(self, fn, args):
+        try:
+            return fn(*args)
+        finally:
+            self.applied += 1
+
+    def submit(self, fn, *args) -> asyncio.Future:
+        return self._loop.run_in_executor(self._executor, self._apply, fn, args)
+
+    async def call(self, fn, *args):
+        """Esegue fn(*args) nel thread dello stato e ne ritorna il risultato (o l'eccezione)."""
+        return await self.submit(fn, *args)
+
+    def post(self, fn, *args):
+        """Come call(), senza attendere: gli errori vengono solo stampati."""
+        def _logged():
+            try:
+                fn(*args)
+            except Exception:
+                print(f"❌ Errore aggiornamento stato ({getattr(fn, '__name__', fn)}):\n{traceback.format_exc()}")
+
+        self.submit(_logged)
+
+    async def close(self):
+        """Attende le funzioni già accodate e ferma il thread."""
+        if self._executor is not None:
+            await self._loop.run_in_executor(None, self._executor.shutdown, True)
+            self._executor = None
+
+
+def _telegram_error(data: dict):
+    code = data.get("error_code")
+    description = data.get("description") or f"errore {code}"
+    params = data.get("parameters") or {}
+    if params.get("retry_after"):
+        return RetryAfter(params["retry_after"])
+    if params.get("migrate_to_chat_id"):
+        return ChatMigrated(params["migrate_to_chat_id"])
+    if code in (401, 403):
+        return Unauthorized(description)
+    if code == 400:
+        return BadRequest(description)
+    if code == 409:
+        return Conflict(description)
+    return NetworkError(description)
+
+
+class TelegramAPI:
+    """Bot API su aiohttp: errori tradotti nelle eccezioni di python-telegram-bot, come per telegram.Bot."""
+
+    def __init__(self, session, token: str, bot=None):
+        self.session = session
+        self.base = TELEGRAM_API.format(token=token)
+        self.bot = bot
+
+    async def call(self, method: str, http_timeout: float = None, **params):
+        payload = {
+            k: (v.to_dict() if hasattr(v, "to_dict") else v) for k, v in params.items() if v is not None
+        }
+        kwargs = {"json": payload}
+        if http_timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=http_timeout)
+        try:
+            async with self.session.post(self.base + method, **kwargs) as resp:
+                data = await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise NetworkError(f"{type(e).__name__}: {e}")
+        if data.get("ok"):
+            return data.get("result")
+        raise _telegram_error(data)
+
+    async def send_message(self, chat_id, text: str, **kwargs):
+        result = await self.call("sendMessage", chat_id=chat_id, text=text, **kwargs)
+        return telegram.Message.de_json(result, self.bot)
+
+
+class DriveAPI:
+    """
+    Drive v3 REST su aiohttp (connessioni keep-alive della sessione), al massimo
+    `concurrency` richieste in volo. Gli errori HTTP diventano googleapiclient HttpError,
+    così is_quota_error() e i messaggi restano quelli del backend sincrono.
+    """
+
+    def __init__(self, session, creds, concurrency: int = 8, metrics=None):
+        self.session = session
+        self.creds = creds
+        self.metrics = metrics
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._auth_lock = asyncio.Lock()
+
+    async def _token(self, force: bool = False) -> str:
+        async with self._auth_lock:
+            if force or not self.creds.valid:
+                from google.auth.transport.requests import Request
+
+                # refresh bloccante (requests): fuori dal loop
+                await asyncio.get_running_loop().run_in_executor(None, self.creds.refresh, Request())
+            return self.creds.token
+
+    async def _request(self, name: str, method: str, path: str, params: dict = None, body: dict = None) -> dict:
+        if self.metrics is not None:
+            self.metrics.inc("drive_requests_total", method=name)
+        try:
+            return await self._send(method, path, params, body)
+        except Exception as e:
+            if self.metrics is not None and is_quota_error(e):
+                self.metrics.inc("drive_quota_errors_total", method=name)
+            raise
+
+    async def _send(self, method: str, path: str, params, body):
+        url = DRIVE_API + path
+        async with self._slots:
+            for attempt in range(2):
+                token = await self._token(force=attempt > 0)
+                async with self.session.request(
+                    method, url, params=params, json=body, headers={"Authorization": f"Bearer {token}"}
+                ) as resp:
+                    content = await resp.read()
+                    status = resp.status
+                if status == 401 and attempt == 0:
+                    # token revocato/scaduto prima del previsto: uno nuovo e si riprova
+                    continue
+                if status >= 400:
+                    import httplib2
+                    from googleapiclient.errors import HttpError
+
+                    raise HttpError(httplib2.Response({"status": status}), content, uri=url)
+                return json.loads(content) if content else {}
+
+    async def list_files(self, q: str, fields: str, page_size: int = 1000, page_token: str = None) -> dict:
+        params = {
+            "q": q,
+            "fields": fields,
+            "pageSize": str(page_size),
+            "supportsAllDrives": "true",
+            "includeItemsFromAllDrives": "true",
+        }
+        if page_token:
+            params["pageToken"] = page_token
+        return await self._request("files.list", "GET", "files", params)
+
+    async def get_start_page_token(self) -> str:
+        resp = await self._request(
+            "changes.getStartPageToken", "GET", "changes/startPageToken", {"supportsAllDrives": "true"}
+        )
+        return resp.get("startPageToken")
+
+    async def list_changes(self, page_token: str, fields: str) -> dict:
+        params = {
+            "pageToken": page_token,
+            "fields": fields,
+            "pageSize": "1000",
+            "supportsAllDrives": "true",
+            "includeItemsFromAllDrives": "true",
+        }
+        return await self._request("changes.list", "GET", "changes", params)
+
+    async def create_permission(self, file_id: str, permission: dict) -> dict:
+        return await self._request(
+            "permissions.create",
+            "POST",
+            f"files/{file_id}/permissions",
+            {"supportsAllDrives": "true", "fields": "id"},
+            permission,
+        )
+
+
+class AsyncOutbox(Outbox):
+    """
+    Outbox con la stessa interfaccia (e gli stessi limiti, RetryAfter e retry) di quella a
+    thread, ma servita da un task asyncio: fino a `concurrency` invii in parallelo, mai
+    due nella stessa chat (l'ordine per chat resta quello di accodamento).
+
+    Coda, bucket e contatori appartengono al loop e si toccano senza lock: send() si può
+    chiamare da qualunque thread (lo StateOwner in particolare) e consegna il messaggio al
+    loop con call_soon_threadsafe. Le callback girano nel thread dello stato (StateOwner),
+    non nel task di invio.
+    """
+
+    def __init__(self, *args, concurrency: int = 8, **kwargs):
+        super().__init__(None, *args, **kwargs)
+        self.concurrency = max(1, concurrency)
+        self.api = None
+        self.owner = None
+        self._loop = None
+        self._wake = None
+        self._slots = None
+        self._task = None
+        self._busy = set()   # chat con un invio in volo
+
+    def attach(self, api, owner):
+        self.api = api
+        self.owner = owner
+
+    def send(self, chat_id, text, on_sent=None, on_failed=None, on_dispatch=None, **kwargs):
+        msg = _Message(next(self._seq), chat_id, text, kwargs, on_sent, on_failed, on_dispatch)
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            # prima di start() (ripresa degli invii all'avvio) c'è ancora un solo thread
+            heapq.heappush(self._heap, (msg.enqueued, msg.seq, msg))
+        else:
+            loop.call_soon_threadsafe(self._push, msg)
+
+    def _push(self, msg):
+        heapq.heappush(self._heap, (msg.enqueued, msg.seq, msg))
+        self._wake.set()
+
+    def depth(self) -> int:
+        # la coda è del loop: len() basta, senza lock
+        return len(self._heap)
+
+    def start(self):
+        if self.alive():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._stopping = False
+        self._task = self._loop.create_task(self._run_async())
+
+    async def aclose(self, timeout: float = 10.0):
+        """Attende lo svuotamento della coda (max timeout secondi) e ferma il task."""
+        deadline = time.monotonic() + timeout
+        while (self.depth() or self._busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self._stopping = True
+        if self._task is not None:
+            self._wake.set()
+            try:
+                await asyncio.wait_for(self._task, max(0.0, deadline - time.monotonic()) + 1.0)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+            self._task = None
+
+    def stop(self, timeout: float = 10.0):
+        # la coda si svuota con aclose(), dentro il loop
+        self._stopping = True
+
+    def alive(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _take_ready(self, now: float):
+        """Messaggi inviabili ora (uno per chat libera) e istante del prossimo controllo."""
+        ready = []
+        deferred = []
+        self._sweep(now)
+        while self._heap and self._heap[0][0] <= now:
+            item = heapq.heappop(self._heap)
+            msg = item[2]
+            if msg.chat_id in self._busy:
+                deferred.append(item)
+                continue
+            wait = max(
+                self._blocked_until.get(msg.chat_id, 0.0) - now,
+                self._chat_bucket(msg.chat_id).wait_time(now),
+                self._global.wait_time(now),
+            )
+            if wait > 0:
+                self.throttled += 1
+                self._reschedule(msg, now + wait)
+                continue
+            self._chat_bucket(msg.chat_id).consume(now)
+            self._global.consume(now)
+            self._busy.add(msg.chat_id)
+            ready.append(msg)
+        for item in deferred:
+            heapq.heappush(self._heap, item)
+        # le chat occupate si risvegliano a fine invio
+        next_at = min((t for t, _s, m in self._heap if m.chat_id not in self._busy), default=None)
+        return ready, next_at
+
+    async def _run_async(self):
+        while True:
+            self._wake.clear()
+            ready, next_at = self._take_ready(time.monotonic())
+            for msg in ready:
+                await self._slots.acquire()
+                self._loop.create_task(self._deliver_async(msg))
+            if self._stopping and not self.depth() and not self._busy:
+                return
+            timeout = None if next_at is None else max(0.0, next_at - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _callback(self, fn, arg, what: str):
+        try:
+            await self.owner.call(fn, *arg)
+        except Exception:
+            print(f"❌ Errore callback {what}:\n{traceback.format_exc()}")
+
+    def _retry_later(self, msg, delay: float, extend: bool = False):
+        self.retried += 1
+        until = time.monotonic() + delay
+        if extend:
+            until = max(self._blocked_until.get(msg.chat_id, 0.0), until)
+        self._blocked_until[msg.chat_id] = until
+        self._reschedule(msg, until)
+
+    async def _deliver_async(self, msg):
+        try:
+            msg.attempts += 1
+            if msg.attempts == 1 and msg.on_dispatch is not None:
+                await self._callback(msg.on_dispatch, (), "dispatch")
+            try:
+                sent = await self.api.send_message(msg.chat_id, msg.text, **msg.kwargs)
+            except RetryAfter as e:
+                delay = float(getattr(e, "retry_after", 1) or 1)
+                self._retry_later(msg, delay)
+                print(f"⏳ Telegram RetryAfter {delay:.0f}s per chat {msg.chat_id}, messaggio ripianificato")
+                return
+            except (BadRequest, Unauthorized, ChatMigrated) as e:
+                await self._callback(self._fail, (msg, e), "fallimento")
+                return
+            except NetworkError as e:
+                if msg.attempts > self.max_retries:
+                    await self._callback(self._fail, (msg, e), "fallimento")
+                    return
+                delay = self.base_backoff * (2 ** (msg.attempts - 1))
+                self._retry_later(msg, delay, extend=True)
+                print(f"🔁 Errore rete verso chat {msg.chat_id} ({e}), nuovo tentativo tra {delay:.0f}s")
+                return
+            except Exception as e:
+                await self._callback(self._fail, (msg, e), "fallimento")
+                return
+
+            latency = time.monotonic() - msg.enqueued
+            self.sent += 1
+            self._latency_total += latency
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+            if msg.on_sent is not None:
+                await self._callback(msg.on_sent, (sent,), "invio")
+        finally:
+            self._busy.discard(msg.chat_id)
+            self._slots.release()
+            self._wake.set()
+
+
+class AsyncEngine:
+    """
+    Motore asyncio (ENGINE=asyncio): le stesse scansioni, gli stessi solleciti e gli stessi
+    comandi del motore a thread, con le chiamate Drive e Telegram come task concorrenti su
+    una sessione aiohttp con connessioni keep-alive.
+
+    La logica sullo stato resta in main (_plan_full_scan, _apply_changes, invia_sollecito,
+    conferma, ...) ed è eseguita dallo StateOwner; qui restano solo l'I/O e i cicli.
+    """
+
+    def __init__(self, drive, api, owner: StateOwner, permission_concurrency: int = 4):
+        self.drive = drive
+        self.api = api
+        self.owner = owner
+        # permissions.create sono scritture: poche alla volta, come i batch del motore a thread
+        self._permission_slots = asyncio.Semaphore(max(1, permission_concurrency))
+        self.username = None
+        self.commands = {
+            "stato": main.cmd_stato,
+            "stop_solleciti": main.cmd_stop_solleciti,
+            "perf": main.cmd_perf,
+            "report": main.cmd_report,
+        }
+
+    # --- Drive ---
+
+    async def list_folders(self, query: str, fields: str):
+        files = []
+        page_token = None
+        while True:
+            resp = await self.drive.list_files(query, f"nextPageToken, files({fields})", page_token=page_token)
+            files.extend(resp.get("files", []))
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return files
+
+    async def _list_group(self, folder_id: str):
+        try:
+            return await self.list_folders(main._children_query(folder_id), main.PREVENTIVO_FIELDS), None
+        except Exception as e:
+            return None, e
+
+    async def root_folder_id(self):
+        root_id = await self.owner.call(main._cached_root_id)
+        if root_id:
+            return root_id
+        resp = await self.drive.list_files(main._name_query(main.FOLDER_NAME), "files(id)", page_size=1)
+        folders = resp.get("files", [])
+        return await self.owner.call(main._set_root_id, folders[0]["id"] if folders else None, time.time())
+
+    async def list_changes(self, page_token: str):
+        changes = []
+        while True:
+            resp = await self.drive.list_changes(
+                page_token,
+                "nextPageToken, newStartPageToken, "
+                "changes(fileId, removed, file(id, name, mimeType, parents, trashed, permissionIds, permissions(type, role)))",
+            )
+            changes.extend(resp.get("changes", []))
+            if resp.get("newStartPageToken"):
+                return changes, resp["newStartPageToken"]
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return changes, await self.drive.get_start_page_token()
+
+    async def _create_permission(self, folder_id: str, permission: dict):
+        async with self._permission_slots:
+            return await self.drive.create_permission(folder_id, permission)
+
+    async def share_links(self, folders):
+        """
+        Come main.generate_share_links: un permissions.create per cartella, al massimo
+        permission_concurrency in volo (oltre al limite generale di DriveAPI).
+        """
+        links = {f["id"]: main.folder_link(f["id"]) for f in folders}
+        pending = [f["id"] for f in folders if not main._is_public(f)]
+        if not pending:
+            return links, {}
+
+        main.metrics.inc("drive_permissions_total", len(pending))
+        permission = {"type": "anyone", "role": "reader", "allowFileDiscovery": False}
+        with main.metrics.timed("generate_share_links"):
+            results = await asyncio.gather(
+                *(self._create_permission(fid, permission) for fid in pending), return_exceptions=True
+            )
+        errors = {fid: res for fid, res in zip(pending, results) if isinstance(res, Exception)}
+        main._report_permission_errors(errors)
+        return links, errors
+
+    # --- scansioni ---
+
+    async def send_collected(self, items) -> int:
+        unique = main._unique_items(items)
+        if not unique:
+            return 0
+        links, _errors = await self.share_links([p for (_g, _k, p) in unique])
+        await self.owner.call(main._enqueue_collected, unique, links)
+        return len(unique)
+
+    async def scan_full(self) -> int:
+        token = await self.drive.get_start_page_token()
+        root_id = await self.root_folder_id()
+        if not root_id:
+            print(f"❌ Cartella '{main.FOLDER_NAME}' non trovata su Drive (o non condivisa col service account).")
+            return 0
+
+        gruppi = await self.list_folders(main._children_query(root_id), "id, name, modifiedTime")
+        groups, to_list = await self.owner.call(main._plan_full_scan, gruppi, time.time())
+        listed = await asyncio.gather(*(self._list_group(fid) for fid in to_list))
+
+        def _collect():
+            out = []
+            for fid, (preventivi, err) in zip(to_list, listed):
+                main._collect_listed(groups[fid], preventivi, err, out)
+            return out
+
+        await self.send_collected(await self.owner.call(_collect))
+        await self.owner.call(main._finish_full_scan, groups, token)
+        return len(to_list)
+
+    async def scan_incremental(self) -> int:
+        token, root_id = await self.owner.call(main._changes_cursor)
+        changes, new_token = await self.list_changes(token)
+        folders, new_groups, topology_changed = await self.owner.call(main._apply_changes, changes, root_id)
+        listed = await asyncio.gather(
+            *(self.list_folders(main._children_query(fid), main.PREVENTIVO_FIELDS) for fid, _entry in new_groups)
+        )
+
+        def _collect():
+            out = []
+            for (_fid, entry), preventivi in zip(new_groups, listed):
+                main._collect_new(entry, entry["gruppo_id"], preventivi, out)
+            main._collect_changed(folders, {fid for fid, _entry in new_groups}, out)
+            return out
+
+        await self.send_collected(await self.owner.call(_collect))
+        await self.owner.call(main._finish_incremental, new_token, topology_changed)
+        return len(folders) + int(topology_changed)
+
+    async def scan_and_send(self) -> int:
+        with main.metrics.timed("scan_and_send"):
+            if await self.owner.call(main._full_scan_due):
+                return await self.scan_full()
+            try:
+                return await self.scan_incremental()
+            except Exception:
+                print(f"⚠️ Scansione incrementale fallita, eseguo scansione completa:\n{traceback.format_exc()}")
+                await self.owner.call(main._set_changes_token, None)
+                return await self.scan_full()
+
+    async def _scan_tick(self) -> int:
+        try:
+            return await self.scan_and_send()
+        finally:
+            if "primo_giro" not in main.startup_times:
+                main._startup_mark("primo_giro")
+                print(f"⏱ Avvio: {main._startup_report()}")
+
+    async def _solleciti(self) -> int:
+        return await self.owner.call(main.invia_sollecito)
+
+    # --- update Telegram ---
+
+    def _dispatch(self, update):
+        msg = update.effective_message
+        if msg is None or not msg.text:
+            return
+        if not msg.text.startswith("/"):
+            main.conferma(update, None)
+            return
+        words = msg.text.split()
+        command, _, target = words[0][1:].partition("@")
+        handler = self.commands.get(command.lower())
+        if handler is None or (target and self.username and target.lower() != self.username.lower()):
+            return
+        handler(update, SimpleNamespace(args=words[1:], bot=self.api.bot))
+
+    async def receive_updates(self):
+        while self.username is None:
+            try:
+                me = await self.api.call("getMe")
+                # come start_polling(drop_pending_updates=True)
+                await self.api.call("deleteWebhook", drop_pending_updates=True)
+                self.username = me.get("username") or ""
+            except Exception as e:
+                print(f"⚠️ Bot Telegram non raggiungibile, riprovo tra 5s: {e}")
+                await asyncio.sleep(5)
+        offset = None
+        while True:
+            try:
+                # `timeout` è il long polling lato Telegram: quello HTTP deve andare oltre
+                updates = await self.api.call(
+                    "getUpdates",
+                    http_timeout=POLL_TIMEOUT + 10,
+                    offset=offset,
+                    timeout=POLL_TIMEOUT,
+                    allowed_updates=["message"],
+                )
+            except Exception as e:
+                print(f"⚠️ getUpdates fallito, riprovo tra 5s: {e}")
+                await asyncio.sleep(5)
+                continue
+            for data in updates:
+                offset = data["update_id"] + 1
+                self.owner.post(self._dispatch, telegram.Update.de_json(data, self.api.bot))
+
+    # --- cicli periodici ---
+
+    async def _every(self, job, fn, first: float):
+        await asyncio.sleep(first)
+        while True:
+            await asyncio.sleep(await job.run_async(fn))
+
+    async def _daily_report(self):
+        while True:
+            now = main._now_local()
+            at = now.replace(hour=main.DAILY_REPORT_HOUR, minute=0, second=0, microsecond=0)
+            if at <= now:
+                at += dt.timedelta(days=1)
+            await asyncio.sleep((at - now).total_seconds())
+            await self.owner.call(main.report_giornaliero, None)
+
+    async def _in_thread(self, fn, interval: float, first: float, owner: StateOwner = None):
+        """
+        fn bloccante ogni interval secondi: nel thread dello stato se tocca SQLite (owner),
+        altrimenti in un thread del loop (Sheets).
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(first)
+        while True:
+            try:
+                if owner is not None:
+                    await owner.call(fn)
+                else:
+                    await loop.run_in_executor(None, fn)
+            except Exception:
+                print(f"❌ Errore {fn.__name__}:\n{traceback.format_exc()}")
+            await asyncio.sleep(interval)
+
+    def tasks(self):
+        loop = asyncio.get_running_loop()
+        tasks = [
+            loop.create_task(self._every(main.scan_job, self._scan_tick, 1)),
+            loop.create_task(self._every(main.sollecito_job, self._solleciti, 5)),
+            loop.create_task(self.receive_updates()),
+            loop.create_task(self._daily_report()),
+            loop.create_task(self._in_thread(main.manutenzione_stato, 24 * 3600, 600, self.owner)),
+        ]
+        if main.sheet_log is not None:
+            tasks.append(
+                loop.create_task(self._in_thread(main.sheet_flush, main.SHEET_FLUSH_INTERVAL, main.SHEET_FLUSH_INTERVAL))
+            )
+        return tasks
+
+
+async def _serve():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    owner = StateOwner()
+    owner.start()
+    connector = aiohttp.TCPConnector(limit_per_host=main.HTTP_POOL_SIZE, keepalive_timeout=60, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        api = TelegramAPI(session, main.BOT_TOKEN, main.bot)
+        drive = DriveAPI(session, main.drive.creds, main.ASYNC_DRIVE_CONCURRENCY, metrics=main.metrics)
+        main.outbox.attach(api, owner)
+        main.start_services()
+
+        engine = AsyncEngine(drive, api, owner, main.ASYNC_PERMISSION_CONCURRENCY)
+        tasks = engine.tasks()
+        main._startup_mark("pronto")
+        print("🚀 BOT preventivi avviato (asyncio)...")
+        try:
+            await stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # svuota la coda prima di uscire (le consegne aggiornano ancora lo stato)
+            await main.outbox.aclose()
+            await owner.close()
+
+
+def run():
+    """Avvio col motore asyncio: stesso stato e stessi job di main.main()."""
+    # l'outbox va sostituita prima di startup(): la ripresa degli invii interrotti accoda già
+    main.outbox = AsyncOutbox(
+        global_rate=main.TG_GLOBAL_RATE,
+        chat_per_minute=main.TG_CHAT_PER_MINUTE,
+        chat_burst=main.TG_CHAT_BURST,
+        max_retries=main.TG_MAX_RETRIES,
+        concurrency=main.ASYNC_SEND_CONCURRENCY,
+    )
+    main.startup()
+    try:
+        asyncio.run(_serve())
+    finally:
+        main.shutdown()
@@ -0,0 +1,185 @@
+import base64
+import json
+import os
+import time
+from threading import Lock, local
+
+# googleapiclient / google-auth / httplib2 si importano al primo uso (~0,2s all'avvio risparmiati)
+
+SCOPES = ["https://www.googleapis.com/auth/drive"]
+
+# motivi con cui Drive segnala il superamento della quota (403) oltre al 429
+QUOTA_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded", "sharingRateLimitExceeded"}
+
+
+def is_quota_error(e) -> bool:
+    """True se l'eccezione è un errore di quota/rate limit di Drive (da ritentare più tardi)."""
+    if not type(e).__module__.startswith("googleapiclient"):
+        return False
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(e, HttpError):
+        return False
+    status = getattr(e.resp, "status", None)
+    if str(status) == "429":
+        return True
+    if str(status) != "403":
+        return False
+    details = e.error_details if isinstance(e.error_details, list) else []
+    return any(isinstance(d, dict) and d.get("reason") in QUOTA_REASONS for d in details)
+
+
+def load_google_credentials():
+    """Credenziali del service account da Railway Variables (o credentials.json in locale)."""
+    from google.oauth2 import service_account
+
+    creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON", "").strip()
+    creds_b64 = os.getenv("GOOGLE_CREDENTIALS_B64", "").strip()
+
+    if creds_json:
+        info = json.loads(creds_json)
+        return service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
+    if creds_b64:
+        raw = base64.b64decode(creds_b64).decode("utf-8")
+        info = json.loads(raw)
+        return service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
+
+    # fallback SOLO per locale se hai il file (sconsigliato su Railway)
+    credentials_file = "credentials.json"
+    if not os.path.exists(credentials_file):
+        raise RuntimeError(
+            "❌ Manca GOOGLE_CREDENTIALS_JSON (o GOOGLE_CREDENTIALS_B64) e non trovo credentials.json in locale."
+        )
+    return service_account.Credentials.from_service_account_file(credentials_file, scopes=SCOPES)
+
+
+def credentials_configured() -> bool:
+    """Controllo veloce (senza import né parsing) che le credenziali ci siano."""
+    return bool(
+        os.getenv("GOOGLE_CREDENTIALS_JSON", "").strip()
+        or os.getenv("GOOGLE_CREDENTIALS_B64", "").strip()
+        or os.path.exists("credentials.json")
+    )
+
+
+def build_drive_service(creds, discovery_file: str = None):
+    """
+    Client Drive v3 dal documento di discovery locale, senza richieste di rete:
+    discovery_file se esiste, altrimenti la copia inclusa in googleapiclient.
+    """
+    from googleapiclient.discovery import build, build_from_document
+
+    if discovery_file and os.path.exists(discovery_file):
+        with open(discovery_file, "r", encoding="utf-8") as f:
+            return build_from_document(f.read(), credentials=creds)
+    return build("drive", "v3", credentials=creds, static_discovery=True, cache_discovery=False)
+
+
+class GoogleDriveBackend:
+    """
+    Le sole chiamate Drive usate dal bot, sopra googleapiclient.
+
+    Credenziali e client vengono costruiti alla prima chiamata (creds=None → dalle variabili
+    d'ambiente): l'avvio non li aspetta. init_seconds ne misura il costo.
+
+    Il trasporto httplib2 del servizio non è thread-safe: ogni thread usa il proprio
+    AuthorizedHttp (con connessioni keep-alive riusate tra un tick e l'altro) passato
+    a execute(http=...). Qualunque backend con gli stessi metodi (vedi fakes.FakeDrive)
+    può sostituirlo.
+    """
+
+    def __init__(self, creds=None, discovery_file: str = None):
+        self._creds = creds
+        self.discovery_file = discovery_file
+        self._service = None
+        self._init_lock = Lock()
+        self.init_seconds = None
+        self._thread_state = local()
+
+    @property
+    def creds(self):
+        if self._creds is None:
+            with self._init_lock:
+                if self._creds is None:
+                    self._creds = load_google_credentials()
+        return self._creds
+
+    @property
+    def service(self):
+        if self._service is None:
+            t0 = time.perf_counter()
+            creds = self.creds
+            with self._init_lock:
+                if self._service is None:
+                    self._service = build_drive_service(creds, self.discovery_file)
+                    self.init_seconds = time.perf_counter() - t0
+        return self._service
+
+    def _http(self):
+        http = getattr(self._thread_state, "http", None)
+        if http is None:
+            import google_auth_httplib2
+            import httplib2
+
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._thread_state.http = http
+        return http
+
+    def list_files(self, q: str, fields: str, page_size: int = 1000, page_token: str = None) -> dict:
+        """Una pagina di files.list (risposta grezza, con nextPageToken)."""
+        return self.service.files().list(
+            q=q,
+            fields=fields,
+            pageSize=page_size,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+            pageToken=page_token,
+        ).execute(http=self._http())
+
+    def get_start_page_token(self) -> str:
+        resp = self.service.changes().getStartPageToken(supportsAllDrives=True).execute(http=self._http())
+        return resp.get("startPageToken")
+
+    def list_changes(self, page_token: str, fields: str) -> dict:
+        """Una pagina di changes.list (risposta grezza, con nextPageToken/newStartPageToken)."""
+        return self.service.changes().list(
+            pageToken=page_token,
+            fields=fields,
+            pageSize=1000,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+        ).execute(http=self._http())
+
+    def create_permissions(self, file_ids, permission: dict) -> dict:
+        """
+        Crea lo stesso permesso su più file con UNA richiesta batch (max 100 file).
+        Ritorna file_id -> eccezione per gli elementi falliti.
+        """
+        errors = {}
+
+        def _on_result(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+
+        batch = self.service.new_batch_http_request(callback=_on_result)
+        for file_id in file_ids:
+            batch.add(
+                self.service.permissions().create(
+                    fileId=file_id,
+                    body=permission,
+                    supportsAllDrives=True,
+                    fields="id",
+                ),
+                request_id=file_id,
+            )
+        batch.execute(http=self._http())
+        return errors
+
+
+def open_worksheet(spreadsheet_id: str, title: str = None, creds=None):
+    """Foglio `title` dello spreadsheet (il primo se title è vuoto). gspread serve solo qui."""
+    import gspread
+
+    client = gspread.authorize(creds or load_google_credentials())
+    spreadsheet = client.open_by_key(spreadsheet_id)
+    return spreadsheet.worksheet(title) if title else spreadsheet.sheet1
@@ -0,0 +1,194 @@
+"""
+Benchmark offline di scansione, solleciti e conferme, su topologie sintetiche
+(backend finti di fakes.py: nessuna rete, nessuna credenziale).
+
+    python bench.py                                   # 10 / 500 / 5000 gruppi × 3 preventivi
+    python bench.py --groups 50 200 --preventivi 5 --drive-latency 0.02 --drive-errors 0.01
+
+Per ogni fase riporta il tempo del tick (thread del job), il tempo fino alla consegna
+di tutti i messaggi, le chiamate API e il costo dei salvataggi di stato.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+# lo stato del bot va in una cartella temporanea, MAI nei file reali
+_TMP = tempfile.mkdtemp(prefix="bench_preventivi_")
+os.environ["CACHE_FILE"] = os.path.join(_TMP, "bot_cache.json")
+os.environ["STATE_DB"] = os.path.join(_TMP, "bot_state.db")
+
+import main  # noqa: E402
+from fakes import FakeBot, FakeDrive  # noqa: E402
+from outbox import Outbox  # noqa: E402
+from state_store import StateStore  # noqa: E402
+from write_behind import WriteBehindStore  # noqa: E402
+
+
+class SaveMeter:
+    """Misura numero e durata delle scritture di stato (transazioni SQLite + file topologia)."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def wrap(self, fn):
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.count += 1
+                self.seconds += time.perf_counter() - t0
+        return timed
+
+    def reset(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _fake_update(chat_id: int, text: str):
+    msg = _Obj(text=text, chat=_Obj(id=chat_id), chat_id=chat_id, message_id=1, from_user=None)
+    return _Obj(effective_message=msg, effective_chat=msg.chat, effective_user=None)
+
+
+def setup_scenario(n_groups: int, n_prev: int, args):
+    """Topologia sintetica + stato pulito del bot collegato ai backend finti."""
+    workdir = tempfile.mkdtemp(dir=_TMP)
+    drive = FakeDrive(latency=args.drive_latency, error_rate=args.drive_errors, seed=1)
+    bot = FakeBot(latency=args.tg_latency, error_rate=args.tg_errors, retry_after=0.01, seed=2)
+
+    root = drive.add_folder(main.FOLDER_NAME)
+    groups = []
+    for g in range(n_groups):
+        gid = -1000000000000 - g
+        folder = drive.add_folder(f"gruppo_{gid}", root)
+        groups.append((gid, folder))
+        for p in range(n_prev):
+            drive.add_folder(f"Preventivo {g}-{p}", folder)
+
+    meter = SaveMeter()
+    inner = StateStore(os.path.join(workdir, "bot_state.db"))
+    inner.apply = meter.wrap(inner.apply)
+    store = WriteBehindStore(inner, max_delay=main.STATE_FLUSH_DELAY, max_pending=main.STATE_FLUSH_MAX_PENDING)
+
+    main.configure_backends(drive, bot)
+    main.store = store
+    main.TOPOLOGY_FILE = os.path.join(workdir, "bot_topology.json")
+    main.outbox = Outbox(bot, global_rate=1e6, chat_per_minute=10 ** 9, chat_burst=10 ** 6, base_backoff=0.01)
+    main.outbox.start()
+    with main.lock:
+        main.reminder_cache.clear()
+        main.sending_keys.clear()
+        main.topology.update({"root_id": None, "root_checked": 0.0, "groups": {}})
+        main.scan_state.update({"changes_token": None, "last_full_scan": 0.0})
+    return drive, bot, groups, meter
+
+
+def drain():
+    """Attende la consegna di tutto ciò che è in coda."""
+    main.outbox.stop(timeout=600)
+    main.outbox.start()
+
+
+def run_phase(label, fn, drive, bot, meter):
+    drive.reset_calls()
+    bot.reset_calls()
+    meter.reset()
+    t0 = time.perf_counter()
+    fn()
+    t_tick = time.perf_counter() - t0
+    drain()
+    main.store.flush()
+    t_done = time.perf_counter() - t0
+    calls = Counter(drive.calls)
+    calls.update(bot.calls)
+    return {
+        "fase": label,
+        "tick_s": t_tick,
+        "consegna_s": t_done,
+        "drive": sum(drive.calls.values()),
+        "telegram": sum(bot.calls.values()),
+        "dettaglio": dict(calls),
+        "salvataggi": meter.count,
+        "salvataggi_ms": meter.seconds * 1000,
+    }
+
+
+def bench_topology(n_groups: int, n_prev: int, args):
+    drive, bot, groups, meter = setup_scenario(n_groups, n_prev, args)
+    save_topology = main.save_topology
+    main.save_topology = meter.wrap(save_topology)
+    results = []
+    try:
+        results.append(run_phase("scan iniziale (completo)", main.scan_and_send, drive, bot, meter))
+        results.append(run_phase("scan incrementale, nessuna novità", main.scan_and_send, drive, bot, meter))
+
+        k = min(args.new, n_groups)
+        for gid, folder in groups[:k]:
+            drive.add_folder(f"Nuovo {gid}", folder)
+        results.append(run_phase(f"scan incrementale, +{k} nuovi", main.scan_and_send, drive, bot, meter))
+
+        def full_again():
+            with main.lock:
+                main.scan_state["last_full_scan"] = 0.0
+            main.scan_and_send()
+        results.append(run_phase("riconciliazione completa, nessuna novità", full_again, drive, bot, meter))
+
+        results.append(run_phase("solleciti, nessuno scaduto", main.invia_sollecito, drive, bot, meter))
+
+        with main.lock:
+            for key, info in main.reminder_cache.items():
+                info["t0"] -= main.SOLLECITO_INTERVAL
+                main.reminder_cache.reschedule(key)
+        results.append(run_phase("solleciti, tutti scaduti", main.invia_sollecito, drive, bot, meter))
+
+        def confirm_all():
+            for gid, _folder in groups:
+                main.conferma(_fake_update(gid, "ok confermo"), None)
+                main.conferma(_fake_update(gid, "grazie, ci sentiamo domani"), None)
+        results.append(run_phase("conferme (2 messaggi/gruppo)", confirm_all, drive, bot, meter))
+    finally:
+        main.save_topology = save_topology
+        main.outbox.stop(timeout=5)
+        main.store.close()
+    return results
+
+
+def print_results(n_groups, n_prev, results):
+    print(f"\n=== {n_groups} gruppi × {n_prev} preventivi ===")
+    print(f"{'fase':<42}{'tick s':>9}{'consegna s':>12}{'drive':>8}{'telegram':>10}{'salv.':>7}{'salv. ms':>10}")
+    for r in results:
+        print(
+            f"{r['fase']:<42}{r['tick_s']:>9.3f}{r['consegna_s']:>12.3f}{r['drive']:>8}"
+            f"{r['telegram']:>10}{r['salvataggi']:>7}{r['salvataggi_ms']:>10.1f}"
+        )
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, nargs="+", default=[10, 500, 5000])
+    parser.add_argument("--preventivi", type=int, default=3, help="preventivi per gruppo")
+    parser.add_argument("--new", type=int, default=10, help="nuovi preventivi nella fase incrementale")
+    parser.add_argument("--drive-latency", type=float, default=0.0, help="secondi per chiamata Drive")
+    parser.add_argument("--drive-errors", type=float, default=0.0, help="probabilità di errore quota Drive")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="secondi per chiamata Telegram")
+    parser.add_argument("--tg-errors", type=float, default=0.0, help="probabilità di RetryAfter Telegram")
+    args = parser.parse_args()
+
+    try:
+        for n_groups in args.groups:
+            print_results(n_groups, args.preventivi, bench_topology(n_groups, args.preventivi, args))
+    finally:
+        shutil.rmtree(_TMP, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_bench()
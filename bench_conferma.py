@@ -0,0 +1,51 @@
+"""
+Micro-benchmark del riconoscimento conferme.
+
+Confronta la vecchia logica di conferma() (BASE/EXTRA ricostruiti e re.sub ad ogni
+messaggio) con ConfirmMatcher su messaggi di lunghezza tipica.
+
+    python bench_conferma.py [ripetizioni]
+"""
+import re
+import sys
+import timeit
+
+from conferma_matcher import ConfirmMatcher
+
+
+def legacy_match(text: str) -> bool:
+    testo = (text or "").strip().lower()
+    testo = re.sub(r"\s+", " ", testo)
+    BASE = {"ok", "confermo", "va bene", "accetto"}
+    EXTRA = ["ok confermo", "ok, confermo", "ok va bene", "ok, va bene"]
+    if testo in BASE:
+        return True
+    return any(phrase in testo for phrase in EXTRA)
+
+
+FILLER = "Buongiorno, vi mando le foto del sopralluogo di stamattina in via Roma. "
+
+MESSAGES = {
+    "conferma breve": "Ok",
+    "conferma con spazi": "  ok    confermo  ",
+    "frase 60 car.": "Ciao a tutti, domani passo in cantiere verso le nove e mezza",
+    "frase + conferma": "Abbiamo visto il preventivo, ok, va bene per noi. Grazie",
+    "messaggio 500 car.": (FILLER * 7)[:500],
+    "messaggio 4000 car.": (FILLER * 56)[:4000],
+}
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    matcher = ConfirmMatcher()
+
+    print(f"{'messaggio':<22}{'len':>6}{'legacy ns':>12}{'matcher ns':>12}{'speedup':>9}")
+    for label, text in MESSAGES.items():
+        assert legacy_match(text) == matcher.matches(text), label
+        t_old = timeit.timeit(lambda: legacy_match(text), number=number) / number * 1e9
+        t_new = timeit.timeit(lambda: matcher.matches(text), number=number) / number * 1e9
+        print(f"{label:<22}{len(text):>6}{t_old:>12.0f}{t_new:>12.0f}{t_old / t_new:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
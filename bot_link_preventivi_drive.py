@@ -8,6 +8,9 @@ from telegram import Bot
 from telegram import ParseMode
 from dotenv import load_dotenv
 
+from sheet_sync import SheetSync
+from sheet_writeback import COL_CONFERMATO, COL_GRUPPO, COL_NOME
+
 load_dotenv()
 
 # Logging
@@ -18,6 +21,13 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 OWNER_ID = int(os.getenv("OWNER_ID", "0"))
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 GOOGLE_CREDS_JSON = os.getenv("GOOGLE_CREDENTIALS")
+CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "60"))  # secondi tra un ciclo e l'altro
+# stato su file: indice delle righe del foglio e preventivi già inviati (sopravvivono ai riavvii)
+SHEET_STATE_FILE = os.getenv("SHEET_STATE_FILE", "sheet_state.json")
+SHEET_CACHE_FILE = os.getenv("SHEET_CACHE_FILE", "sheet_cache.json")
+# ogni ciclo rilegge solo le righe nuove e le ultime SHEET_RECENT_ROWS; tutto il foglio ogni SHEET_FULL_READ_EVERY cicli
+SHEET_RECENT_ROWS = int(os.getenv("SHEET_RECENT_ROWS", "100"))
+SHEET_FULL_READ_EVERY = int(os.getenv("SHEET_FULL_READ_EVERY", "10"))
 
 # Converti JSON stringa in dizionario
 if isinstance(GOOGLE_CREDS_JSON, str):
@@ -30,6 +40,16 @@ bot = Bot(token=BOT_TOKEN)
 gc = gspread.service_account_from_dict(GOOGLE_CREDS_JSON)
 sheet = gc.open_by_key(SPREADSHEET_ID).sheet1
 
+# Colonne lette dal foglio (solo queste, una volta per ciclo): COL_NOME, COL_GRUPPO, COL_CONFERMATO,
+# le stesse che main.py aggiorna con sheet_writeback
+sheet_sync = SheetSync(
+    sheet,
+    [COL_NOME, COL_GRUPPO, COL_CONFERMATO],
+    SHEET_STATE_FILE,
+    recent_rows=SHEET_RECENT_ROWS,
+    full_every=SHEET_FULL_READ_EVERY,
+)
+
 # Gruppi Telegram
 GRUPPI = {
     "-1003418284764": "Mustafa",
@@ -37,24 +57,50 @@ GRUPPI = {
     "-100yyyyyyyyyy": "GruppoC"
 }
 
-# Prevenzione doppio invio
-cache = {}
+# Prevenzione doppio invio: preventivo -> {"sent_time", "gruppo"}, salvato in SHEET_CACHE_FILE
+def load_cache():
+    if not os.path.exists(SHEET_CACHE_FILE):
+        return {}
+    try:
+        with open(SHEET_CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logging.error(f"Cache non leggibile ({SHEET_CACHE_FILE}), la ignoro: {e}")
+        return {}
+
+
+def save_cache():
+    try:
+        tmp = SHEET_CACHE_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp, SHEET_CACHE_FILE)
+    except Exception as e:
+        logging.error(f"Impossibile salvare cache: {e}")
+
+
+cache = load_cache()
+# righe con invio fallito: riprovate al ciclo successivo anche se il foglio non cambia
+da_riprovare = {}
 
 # Tempo massimo attesa (in secondi) prima del sollecito
 MAX_ATTESA = 4 * 3600  # 4 ore
 
-# 🔁 Controlla nuovi preventivi
-def check_nuovi_preventivi():
-    rows = sheet.get_all_records()
+
+def _confermato(row) -> bool:
+    return row.get(COL_CONFERMATO, "").strip().lower() == "sì"
+
+
+# 🔁 Controlla nuovi preventivi (solo tra le righe nuove o cambiate)
+def check_nuovi_preventivi(rows):
     now = time.time()
+    inviati = 0
 
     for row in rows:
-        preventivo = row.get("Nome Preventivo")
-        gruppo_id = str(row.get("ID Gruppo"))
-        confermato = row.get("Confermato", "").strip().lower()
-        timestamp = row.get("Timestamp", "")
+        preventivo = row.get(COL_NOME)
+        gruppo_id = row.get(COL_GRUPPO, "")
 
-        if confermato == "sì":
+        if _confermato(row):
             continue
 
         if not preventivo or gruppo_id not in GRUPPI:
@@ -70,20 +116,26 @@ def check_nuovi_preventivi():
                 "sent_time": now,
                 "gruppo": gruppo_id
             }
+            da_riprovare.pop(preventivo, None)
+            inviati += 1
         except Exception as e:
+            da_riprovare[preventivo] = row
             logging.error(f"Errore invio messaggio: {e}")
 
-# 🔁 Invia solleciti
+    if inviati:
+        save_cache()
+
+
+# 🔁 Invia solleciti (righe dell'ultima lettura, senza rileggere il foglio)
 def invia_solleciti():
     now = time.time()
-    rows = sheet.get_all_records()
+    sollecitati = 0
 
-    for row in rows:
-        preventivo = row.get("Nome Preventivo")
-        gruppo_id = str(row.get("ID Gruppo"))
-        confermato = row.get("Confermato", "").strip().lower()
+    for row in sheet_sync.records():
+        preventivo = row.get(COL_NOME)
+        gruppo_id = row.get(COL_GRUPPO, "")
 
-        if confermato == "sì" or preventivo not in cache:
+        if _confermato(row) or preventivo not in cache:
             continue
 
         tempo_passato = now - cache[preventivo]["sent_time"]
@@ -92,5 +144,30 @@ def invia_solleciti():
             try:
                 bot.send_message(chat_id=gruppo_id, text=f"🔔 <b>Promemoria:</b> il preventivo <b>{preventivo}</b> è ancora in attesa di conferma.", parse_mode=ParseMode.HTML)
                 cache[preventivo]["sent_time"] = now
+                sollecitati += 1
             except Exception as e:
                 logging.error(f"Errore sollecito: {e}")
+
+    if sollecitati:
+        save_cache()
+
+
+# 🔁 Un ciclo: una sola lettura del foglio, poi invii e solleciti
+def ciclo(primo=False):
+    cambiate = [row for _n, row in sheet_sync.sync()]
+    # al primo ciclo si guardano tutte le righe (es. GRUPPI cambiati dall'ultimo avvio)
+    rows = sheet_sync.records() if primo else cambiate + list(da_riprovare.values())
+    check_nuovi_preventivi(rows)
+    invia_solleciti()
+    logging.info(f"Ciclo foglio: {len(cambiate)} righe nuove/cambiate, {sheet_sync.stats()}")
+
+
+if __name__ == "__main__":
+    primo = True
+    while True:
+        try:
+            ciclo(primo)
+            primo = False
+        except Exception as e:
+            logging.error(f"Errore ciclo: {e}")
+        time.sleep(CHECK_INTERVAL)
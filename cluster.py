@@ -0,0 +1,172 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL,
+    started REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def default_instance_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Cluster:
+    """
+    Coordinamento tra più istanze del bot tramite un file SQLite condiviso (stessa macchina
+    o volume condiviso): nessun servizio esterno.
+
+    - Ogni istanza scrive un heartbeat; sono vive quelle con heartbeat più recente di ttl.
+    - I gruppi sono ripartiti tra le istanze vive con rendezvous hashing: ogni gruppo ha
+      un solo proprietario, e quando un'istanza entra o esce si spostano solo i suoi gruppi.
+    - Un lease con scadenza (acquire_lease) elegge l'unica istanza che riceve gli update
+      Telegram e manda il report giornaliero.
+
+    Passaggio di consegne: quando cambia l'insieme delle istanze un gruppo che se ne va
+    smette subito di essere nostro, uno che arriva lo diventa solo dopo `grace` secondi
+    (il tempo perché il vecchio proprietario veda il cambio e scriva il suo stato). All'avvio
+    un'istanza non possiede nulla finché la prima ripartizione non è stabile.
+
+    on_change(members) viene chiamato (nel thread dell'heartbeat) quando una nuova
+    ripartizione diventa effettiva, per ricaricare lo stato dei gruppi acquisiti.
+    """
+
+    def __init__(self, path: str, instance_id: str = None, heartbeat: float = 5.0, ttl: float = 20.0,
+                 grace: float = None):
+        self.path = path
+        self.instance_id = instance_id or default_instance_id()
+        self.heartbeat_interval = heartbeat
+        self.ttl = ttl
+        self.grace = 2 * heartbeat if grace is None else grace
+        self.on_change = None
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._members = ()
+        self._previous = ()          # ripartizione precedente, finché il passaggio non è concluso
+        self._changed_at = time.monotonic()
+        self._settled = False
+        self._leases = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- heartbeat / membri ---
+
+    def beat(self):
+        """Aggiorna il proprio heartbeat e rilegge le istanze vive."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO instances(id, heartbeat, started) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (self.instance_id, now, now),
+            )
+            self._conn.execute("DELETE FROM instances WHERE heartbeat < ?", (now - 10 * self.ttl,))
+            rows = self._conn.execute(
+                "SELECT id FROM instances WHERE heartbeat >= ? ORDER BY id", (now - self.ttl,)
+            ).fetchall()
+        members = tuple(r[0] for r in rows) or (self.instance_id,)
+        if members != self._members:
+            if self._settled:
+                self._previous = self._members
+            self._members = members
+            self._changed_at = time.monotonic()
+            self._settled = False
+            print(f"🧩 Istanze attive: {', '.join(members)} (io: {self.instance_id})")
+        elif not self._settled and time.monotonic() - self._changed_at >= self.grace:
+            self._settled = True
+            self._previous = ()
+            print(f"🧩 Ripartizione gruppi attiva su {len(members)} istanze")
+            if self.on_change is not None:
+                self.on_change(members)
+
+    def members(self):
+        return self._members
+
+    def settled(self) -> bool:
+        return self._settled
+
+    @staticmethod
+    def _owner(members, gruppo_id):
+        if not members:
+            return None
+        key = str(gruppo_id).encode()
+        return max(members, key=lambda m: zlib.crc32(m.encode() + b"\x00" + key))
+
+    def owner(self, gruppo_id) -> str:
+        return self._owner(self._members, gruppo_id)
+
+    def owns(self, gruppo_id) -> bool:
+        if self._owner(self._members, gruppo_id) != self.instance_id:
+            return False
+        # durante il passaggio solo i gruppi che erano già nostri
+        return self._settled or self._owner(self._previous, gruppo_id) == self.instance_id
+
+    # --- lease ---
+
+    def acquire_lease(self, name: str) -> bool:
+        """Prende o rinnova il lease (valido ttl secondi). True se lo detiene questa istanza."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO leases(name, holder, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires "
+                "WHERE leases.holder = excluded.holder OR leases.expires < ?",
+                (name, self.instance_id, now + self.ttl, now),
+            )
+            row = self._conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        held = row is not None and row[0] == self.instance_id
+        if held:
+            self._leases.add(name)
+        else:
+            self._leases.discard(name)
+        return held
+
+    def holds(self, name: str) -> bool:
+        return name in self._leases
+
+    def release_lease(self, name: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, self.instance_id))
+        self._leases.discard(name)
+
+    # --- ciclo di vita ---
+
+    def _run(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.beat()
+            except Exception as e:
+                print(f"⚠️ Heartbeat cluster fallito: {e}")
+
+    def start(self):
+        self.beat()
+        self._thread = threading.Thread(target=self._run, name="cluster-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Esce dal cluster: rilascia i lease e toglie il proprio heartbeat (i gruppi passano agli altri)."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        for name in list(self._leases):
+            self.release_lease(name)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM instances WHERE id = ?", (self.instance_id,))
+        self._conn.close()
@@ -0,0 +1,66 @@
+import json
+import os
+import re
+
+# frasi base accettate (il messaggio deve essere esattamente una di queste)
+DEFAULT_EXACT = ("ok", "confermo", "va bene", "accetto")
+# frasi più lunghe che valgono come conferma ovunque compaiano nel messaggio
+DEFAULT_CONTAINS = ("ok confermo", "ok, confermo", "ok va bene", "ok, va bene")
+
+
+def _phrase_pattern(phrase: str) -> str:
+    # gli spazi di una frase accettano qualunque sequenza di spazi ("ok   confermo")
+    words = phrase.strip().lower().split()
+    return r"\s+".join(re.escape(w) for w in words)
+
+
+class ConfirmMatcher:
+    """
+    Riconosce i messaggi di conferma con un'unica regex precompilata:
+    frase esatta (a meno di spazi e maiuscole) oppure frase "contiene".
+    """
+
+    def __init__(self, exact=DEFAULT_EXACT, contains=DEFAULT_CONTAINS):
+        self.exact = tuple(p for p in (_phrase_pattern(x) for x in exact) if p)
+        self.contains = tuple(p for p in (_phrase_pattern(x) for x in contains) if p)
+
+        parts = []
+        if self.exact:
+            parts.append(r"\A\s*(?:" + "|".join(self.exact) + r")\s*\Z")
+        if self.contains:
+            parts.append("(?:" + "|".join(self.contains) + ")")
+        # (?!) non corrisponde mai: nessuna frase configurata = nessuna conferma
+        self._regex = re.compile("|".join(parts) or "(?!)", re.IGNORECASE)
+
+    def matches(self, text: str) -> bool:
+        return bool(text) and self._regex.search(text) is not None
+
+
+def _split_phrases(raw: str):
+    return [p.strip() for p in raw.split("|") if p.strip()]
+
+
+def load_matcher() -> ConfirmMatcher:
+    """
+    Costruisce il matcher dalla configurazione:
+    - CONFERMA_FRASI_FILE: JSON {"exact": [...], "contains": [...]};
+    - altrimenti CONFERMA_FRASI / CONFERMA_FRASI_CONTIENE, frasi separate da "|";
+    - altrimenti le frasi di default.
+    """
+    exact, contains = list(DEFAULT_EXACT), list(DEFAULT_CONTAINS)
+
+    path = os.getenv("CONFERMA_FRASI_FILE", "").strip()
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        exact = [str(x) for x in data.get("exact", exact)]
+        contains = [str(x) for x in data.get("contains", contains)]
+    else:
+        raw_exact = os.getenv("CONFERMA_FRASI")
+        raw_contains = os.getenv("CONFERMA_FRASI_CONTIENE")
+        if raw_exact is not None:
+            exact = _split_phrases(raw_exact)
+        if raw_contains is not None:
+            contains = _split_phrases(raw_contains)
+
+    return ConfirmMatcher(exact, contains)
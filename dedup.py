@@ -0,0 +1,45 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Filtro di Bloom per i controlli "già inviato?": un no è certo (niente query su SQLite),
+    un sì va confermato sul database. Occupa ~1,8 byte per chiave con error_rate=0.001.
+    Non supporta cancellazioni: dopo una potatura va ricostruito.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = max(1, int(capacity))
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: bytes):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: bytes):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def full(self) -> bool:
+        return self.count > self.capacity
+
+
+def sent_key(gruppo_id: int, folder_id: str) -> bytes:
+    return f"{gruppo_id}\x00{folder_id}".encode("utf-8")
+
+
+def pruned_key(folder_id: str) -> bytes:
+    """Chiave nel filtro per le cartelle uscite da sent con la retention (senza gruppo)."""
+    return f"pruned\x00{folder_id}".encode("utf-8")
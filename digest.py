@@ -0,0 +1,158 @@
+from threading import Lock
+
+TELEGRAM_MAX_LEN = 4096
+
+
+class _Entry:
+    __slots__ = ("section", "line", "single", "notice", "on_sent", "on_failed", "dispatch_key")
+
+    def __init__(self, section, line, single, notice, on_sent, on_failed, dispatch_key):
+        self.section = section
+        self.line = line
+        self.single = single
+        self.notice = notice
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.dispatch_key = dispatch_key
+
+
+def split_blocks(blocks, limit: int = TELEGRAM_MAX_LEN):
+    """
+    blocks = [(titolo_sezione, riga, payload)] → [(testo, [payload])] con testi <= limit.
+    Si spezza solo tra una riga e l'altra (l'HTML di ogni riga resta integro) e il titolo
+    della sezione viene ripetuto in testa al messaggio successivo.
+    """
+    chunks = []
+    parts, payloads, size, current = [], [], 0, None
+
+    for title, line, payload in blocks:
+        piece = line if title == current else (f"\n{title}\n{line}" if parts else f"{title}\n{line}")
+        if parts and size + 1 + len(piece) > limit:
+            chunks.append(("\n".join(parts), payloads))
+            parts, payloads, size, current = [], [], 0, None
+            piece = f"{title}\n{line}"
+        parts.append(piece)
+        payloads.append(payload)
+        size += len(piece) + (1 if len(parts) > 1 else 0)
+        current = title
+
+    if parts:
+        chunks.append(("\n".join(parts), payloads))
+    return chunks
+
+
+class DigestBatcher:
+    """
+    Raccoglie i messaggi di un giro (scansione o solleciti) e li unisce per chat:
+    un solo messaggio per gruppo con nuovi preventivi, promemoria e scadenze, spezzato
+    al limite di Telegram. Le notifiche per il gruppo di controllo diventano un unico
+    riepilogo, inviato quando tutti i messaggi del giro sono stati consegnati o sono falliti.
+
+    Una voce da sola in una chat viene inviata col suo testo singolo (single), come prima.
+    on_sent/on_failed di ogni voce vengono chiamati con l'esito del messaggio che la contiene;
+    on_dispatch(keys) con i dispatch_key delle voci di un messaggio, subito prima dell'invio.
+    """
+
+    def __init__(self, control_chat_id, sections: dict, summary_title: str, limit: int = TELEGRAM_MAX_LEN,
+                 on_dispatch=None):
+        self.control_chat_id = control_chat_id
+        self.on_dispatch = on_dispatch
+        self.sections = dict(sections)          # chiave -> titolo, nell'ordine di visualizzazione
+        self.summary_title = summary_title
+        self.limit = limit
+        self._pending = {}                      # chat_id -> [_Entry]
+        self._notices = []
+        self._lock = Lock()
+
+    def add(self, chat_id, section: str, line: str, single: str = None, notice: str = None,
+            on_sent=None, on_failed=None, dispatch_key=None):
+        """Accoda una voce per la chat; notice va nel riepilogo di controllo se la voce viene consegnata."""
+        entry = _Entry(section, line, single, notice, on_sent, on_failed, dispatch_key)
+        with self._lock:
+            self._pending.setdefault(chat_id, []).append(entry)
+
+    def notify(self, text: str):
+        """Riga del riepilogo di controllo, indipendente dall'esito degli invii."""
+        with self._lock:
+            self._notices.append(text)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(v) for v in self._pending.values()) + len(self._notices)
+
+    def flush(self, outbox) -> int:
+        """Accoda nell'outbox i messaggi raccolti. Ritorna il numero di messaggi per le chat."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            notices, self._notices = self._notices, []
+        if not pending and not notices:
+            return 0
+
+        order = {key: i for i, key in enumerate(self.sections)}
+        messages = []
+        for chat_id, entries in pending.items():
+            if len(entries) == 1 and entries[0].single is not None:
+                messages.append((chat_id, entries[0].single, entries))
+                continue
+            entries.sort(key=lambda e: order.get(e.section, len(order)))
+            blocks = [(self.sections.get(e.section, e.section), e.line, e) for e in entries]
+            for text, chunk in split_blocks(blocks, self.limit):
+                messages.append((chat_id, text, chunk))
+
+        state = {"remaining": len(messages), "notices": list(notices)}
+        state_lock = Lock()
+
+        def _settle(delivered_notices):
+            with state_lock:
+                state["notices"].extend(delivered_notices)
+                state["remaining"] -= 1
+                done = state["remaining"] == 0
+            if done:
+                self._send_summary(outbox, state["notices"])
+
+        for chat_id, text, chunk in messages:
+            def _on_sent(message, chunk=chunk):
+                for e in chunk:
+                    if e.on_sent is not None:
+                        e.on_sent(message)
+                _settle([e.notice for e in chunk if e.notice])
+
+            def _on_failed(exc, chunk=chunk):
+                for e in chunk:
+                    if e.on_failed is not None:
+                        e.on_failed(exc)
+                _settle([])
+
+            keys = [e.dispatch_key for e in chunk if e.dispatch_key is not None]
+
+            def _on_dispatch(keys=keys):
+                self.on_dispatch(keys)
+
+            outbox.send(
+                chat_id,
+                text,
+                on_sent=_on_sent,
+                on_failed=_on_failed,
+                on_dispatch=_on_dispatch if keys and self.on_dispatch is not None else None,
+                parse_mode="HTML",
+            )
+
+        if not messages:
+            self._send_summary(outbox, state["notices"])
+        return len(messages)
+
+    def _send_summary(self, outbox, notices):
+        if not notices:
+            return
+        if len(notices) == 1:
+            texts = [notices[0]]
+        else:
+            blocks = [(self.summary_title, line, None) for line in notices]
+            texts = [text for text, _ in split_blocks(blocks, self.limit)]
+        for text in texts:
+            outbox.send(
+                self.control_chat_id,
+                text,
+                on_failed=lambda e: print(f"Errore invio riepilogo di controllo: {e}"),
+                parse_mode="HTML",
+            )
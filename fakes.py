@@ -0,0 +1,182 @@
+"""
+Backend finti in memoria per Drive e Telegram: stessa interfaccia di backends.GoogleDriveBackend
+e di telegram.Bot.send_message, con latenza ed errori di quota simulati.
+Servono a benchmark (bench.py) e prove offline, senza rete né credenziali.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+from telegram.error import RetryAfter
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+
+_NAME_RE = re.compile(r"name = '((?:[^'\\]|\\.)*)'")
+_PARENT_RE = re.compile(r"'([^']+)' in parents")
+
+
+def quota_error() -> HttpError:
+    """Lo stesso errore che Drive restituisce quando si supera la quota."""
+    resp = httplib2.Response({"status": "403", "reason": "Forbidden"})
+    content = json.dumps(
+        {"error": {"code": 403, "message": "Rate Limit Exceeded", "errors": [{"reason": "rateLimitExceeded"}]}}
+    ).encode("utf-8")
+    return HttpError(resp, content)
+
+
+class _Simulated:
+    """Latenza, errori casuali e contatori per metodo, condivisi dai fake."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, method: str) -> bool:
+        """Conta la chiamata, attende la latenza; True se questa chiamata deve fallire."""
+        with self._lock:
+            self.calls[method] += 1
+            fail = self.error_rate > 0 and self._rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        return fail
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+
+class FakeDrive(_Simulated):
+    """Albero di cartelle Drive in memoria, con Changes API e permessi."""
+
+    def __init__(self, page_size: int = 1000, **kwargs):
+        super().__init__(**kwargs)
+        self.page_size = page_size
+        self.files = {}          # id -> file
+        self._children = {}      # parent_id -> [id]
+        self._changes = []       # log delle modifiche (file id); il token è l'indice
+        self._ids = itertools.count(1)
+        self._tree_lock = threading.Lock()
+
+    # --- costruzione della topologia ---
+
+    def add_folder(self, name: str, parent_id: str = None, modified: str = None) -> str:
+        with self._tree_lock:
+            fid = f"fake{next(self._ids)}"
+            stamp = modified or time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+            self.files[fid] = {
+                "id": fid,
+                "name": name,
+                "mimeType": FOLDER_MIME,
+                "parents": [parent_id] if parent_id else [],
+                "trashed": False,
+                "modifiedTime": stamp,
+                "permissions": [],
+                "permissionIds": [],
+            }
+            if parent_id:
+                self._children.setdefault(parent_id, []).append(fid)
+                # come Drive: aggiungere un figlio aggiorna il modifiedTime della cartella
+                if parent_id in self.files:
+                    self.files[parent_id]["modifiedTime"] = stamp + f"#{fid}"
+            self._changes.append(fid)
+            return fid
+
+    def trash(self, fid: str):
+        with self._tree_lock:
+            self.files[fid]["trashed"] = True
+            self._changes.append(fid)
+
+    # --- interfaccia backend ---
+
+    def list_files(self, q: str, fields: str, page_size: int = 1000, page_token: str = None) -> dict:
+        if self._call("files.list"):
+            raise quota_error()
+        with self._tree_lock:
+            m = _NAME_RE.search(q)
+            if m:
+                name = m.group(1).replace("\\'", "'")
+                found = [f for f in self.files.values() if f["name"] == name and not f["trashed"]]
+            else:
+                parent = _PARENT_RE.search(q).group(1)
+                found = [self.files[c] for c in self._children.get(parent, ()) if not self.files[c]["trashed"]]
+            start = int(page_token or 0)
+            size = min(page_size, self.page_size)
+            page = [dict(f) for f in found[start:start + size]]
+        resp = {"files": page}
+        if start + size < len(found):
+            resp["nextPageToken"] = str(start + size)
+        return resp
+
+    def get_start_page_token(self) -> str:
+        if self._call("changes.getStartPageToken"):
+            raise quota_error()
+        with self._tree_lock:
+            return str(len(self._changes))
+
+    def list_changes(self, page_token: str, fields: str) -> dict:
+        if self._call("changes.list"):
+            raise quota_error()
+        with self._tree_lock:
+            start = int(page_token)
+            end = min(len(self._changes), start + self.page_size)
+            changes = [
+                {"fileId": fid, "removed": False, "file": dict(self.files[fid])}
+                for fid in self._changes[start:end]
+            ]
+            resp = {"changes": changes}
+            if end < len(self._changes):
+                resp["nextPageToken"] = str(end)
+            else:
+                resp["newStartPageToken"] = str(end)
+        return resp
+
+    def create_permissions(self, file_ids, permission: dict) -> dict:
+        # una richiesta batch = una chiamata HTTP, gli errori sono per elemento
+        self._call("batch")
+        errors = {}
+        for fid in file_ids:
+            if self._call("permissions.create"):
+                errors[fid] = quota_error()
+                continue
+            with self._tree_lock:
+                self.files[fid]["permissions"].append({"type": permission["type"], "role": permission["role"]})
+                if permission["type"] == "anyone":
+                    self.files[fid]["permissionIds"].append("anyoneWithLink")
+        return errors
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, chat_id, text: str):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.text = text
+
+
+class FakeBot(_Simulated):
+    """Bot Telegram finto: registra i messaggi e può rispondere con RetryAfter."""
+
+    def __init__(self, retry_after: float = 1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.retry_after = retry_after
+        self.sent = []
+        self._ids = itertools.count(1)
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self._call("sendMessage"):
+            raise RetryAfter(self.retry_after)
+        msg = FakeMessage(next(self._ids), chat_id, text)
+        with self._lock:
+            self.sent.append(msg)
+        return msg
+
+    def delete_webhook(self, **kwargs):
+        return True
@@ -0,0 +1,211 @@
+import time
+import traceback
+from threading import Lock
+
+
+class AdaptiveJob:
+    """
+    Job periodico del JobQueue con intervallo adattivo ed esecuzione single-flight.
+
+    Ogni esecuzione pianifica la successiva (run_once), quindi due esecuzioni dello
+    stesso job non si sovrappongono mai; il lock copre anche le chiamate manuali (run()).
+    fn() ritorna il numero di novità trovate:
+      - novità > 0       → intervallo al minimo (stringe finché c'è attività)
+      - nessuna novità   → l'intervallo torna gradualmente a quello base
+      - errore di quota  → intervallo raddoppiato, fino al massimo (is_backoff_error(e),
+                           oppure pressure() cresciuto durante l'esecuzione)
+    wake_hint() può anticipare il risveglio (secondi alla prossima scadenza nota).
+
+    Contati: esecuzioni saltate (job già in corso, o turni persi durante un'esecuzione
+    troppo lunga) e overrun (esecuzione più lunga dell'intervallo corrente).
+
+    start() dopo stop() apre una nuova catena: i giri già pianificati da quella vecchia
+    vengono ignorati. healthy() dice se la catena è viva (per il supervisore).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn,
+        interval: float,
+        min_interval: float,
+        max_interval: float,
+        metrics=None,
+        is_backoff_error=None,
+        pressure=None,
+        wake_hint=None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.base_interval = float(interval)
+        self.min_interval = float(min(min_interval, interval))
+        self.max_interval = float(max(max_interval, interval))
+        self.interval = self.base_interval
+        self.metrics = metrics
+        self.is_backoff_error = is_backoff_error
+        self.pressure = pressure
+        self.wake_hint = wake_hint
+
+        self.runs = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.backoffs = 0
+        self.last_duration = 0.0
+        self._running = Lock()
+        self._job_queue = None
+        self._stopped = False
+        self._generation = 0
+        self._next_at = None       # monotonic del prossimo giro pianificato
+        self._started_at = None    # monotonic dell'inizio del giro in corso
+
+    def start(self, job_queue, first: float = 1.0):
+        self._job_queue = job_queue
+        self._stopped = False
+        self._generation += 1
+        self._schedule(first)
+
+    def stop(self):
+        self._stopped = True
+        self._next_at = None
+
+    def _schedule(self, delay: float):
+        self._next_at = time.monotonic() + delay
+        self._job_queue.run_once(self._callback, when=delay, name=self.name, context=self._generation)
+
+    def healthy(self, grace: float) -> bool:
+        """
+        False se il prossimo giro è in ritardo di oltre grace secondi (catena interrotta)
+        o se il giro in corso dura da più di max_interval + grace (bloccato).
+        """
+        if self._stopped:
+            return True
+        now = time.monotonic()
+        if self._next_at is not None:
+            return now <= self._next_at + grace
+        return self._started_at is None or now - self._started_at <= self.max_interval + grace
+
+    def _inc(self, counter: str, value: float = 1):
+        if self.metrics is not None:
+            self.metrics.inc(counter, value, job=self.name)
+
+    def _callback(self, context):
+        generation = context.job.context if context is not None else self._generation
+        if generation != self._generation:
+            # giro di una catena fermata (job riavviato)
+            return
+        self._next_at = None
+        self._started_at = time.monotonic()
+        try:
+            self.run()
+        finally:
+            self._started_at = None
+            if not self._stopped and self._job_queue is not None and generation == self._generation:
+                self._schedule(self.next_delay())
+
+    def run(self) -> bool:
+        """Esegue fn se il job non è già in corso. False se l'esecuzione è stata saltata."""
+        if not self._running.acquire(blocking=False):
+            self.skipped += 1
+            self._inc("job_skipped_total")
+            print(f"⏭ Job {self.name} ancora in corso, esecuzione saltata")
+            return False
+
+        try:
+            interval = self.interval
+            pressure_before = self.pressure() if self.pressure else 0
+            t0 = time.perf_counter()
+            activity = 0
+            backoff = False
+            try:
+                if self.metrics is not None:
+                    with self.metrics.timed(f"job_{self.name}"):
+                        activity = self.fn() or 0
+                else:
+                    activity = self.fn() or 0
+            except Exception as e:
+                backoff = self.is_backoff_error is not None and self.is_backoff_error(e)
+                print(f"❌ Errore job {self.name}:\n{traceback.format_exc()}")
+            self._account(interval, pressure_before, time.perf_counter() - t0, activity, backoff)
+            return True
+        finally:
+            self._running.release()
+
+    async def run_async(self, fn) -> float:
+        """
+        Un giro per il motore asyncio (async_engine): fn è una coroutine function usata al
+        posto di self.fn, con lo stesso adattamento dell'intervallo. Ritorna l'attesa fino
+        al giro successivo.
+        """
+        self._next_at = None
+        self._started_at = time.monotonic()
+        interval = self.interval
+        pressure_before = self.pressure() if self.pressure else 0
+        t0 = time.perf_counter()
+        activity = 0
+        backoff = False
+        try:
+            if self.metrics is not None:
+                with self.metrics.timed(f"job_{self.name}"):
+                    activity = await fn() or 0
+            else:
+                activity = await fn() or 0
+        except Exception as e:
+            backoff = self.is_backoff_error is not None and self.is_backoff_error(e)
+            print(f"❌ Errore job {self.name}:\n{traceback.format_exc()}")
+        finally:
+            self._started_at = None
+        self._account(interval, pressure_before, time.perf_counter() - t0, activity, backoff)
+        delay = self.next_delay()
+        self._next_at = time.monotonic() + delay
+        return delay
+
+    def _account(self, interval: float, pressure_before, elapsed: float, activity, backoff: bool):
+        if self.pressure and self.pressure() > pressure_before:
+            backoff = True
+
+        self.runs += 1
+        self.last_duration = elapsed
+        if elapsed > interval:
+            # i turni caduti durante l'esecuzione non vengono recuperati
+            missed = int(elapsed // interval)
+            self.overruns += 1
+            self.skipped += missed
+            self._inc("job_overruns_total")
+            self._inc("job_skipped_total", missed)
+            print(f"⚠️ Job {self.name} durato {elapsed:.1f}s, oltre l'intervallo di {interval:g}s")
+
+        self._adapt(activity, backoff)
+
+    def _adapt(self, activity, backoff: bool):
+        if backoff:
+            self.backoffs += 1
+            self._inc("job_backoffs_total")
+            self.interval = min(self.max_interval, self.interval * 2)
+            print(f"🐢 Job {self.name}: quota superata, prossimo giro tra {self.interval:.0f}s")
+        elif activity:
+            self.interval = self.min_interval
+        elif self.interval > self.base_interval:
+            self.interval = max(self.base_interval, self.interval / 2)
+        elif self.interval < self.base_interval:
+            self.interval = min(self.base_interval, self.interval * 2)
+
+    def next_delay(self) -> float:
+        delay = self.interval
+        if self.wake_hint is not None:
+            try:
+                hint = self.wake_hint()
+            except Exception:
+                hint = None
+            if hint is not None:
+                delay = min(delay, max(self.min_interval, hint))
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "overruns": self.overruns,
+            "backoffs": self.backoffs,
+            "last_duration": self.last_duration,
+        }
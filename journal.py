@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+import time
+
+
+class Journal:
+    """
+    Journal append-only degli eventi di stato (una riga JSON per evento, con numero di
+    sequenza), diviso in segmenti nella cartella `directory`.
+
+    Ogni scrittura va subito al sistema operativo; l'fsync è raggruppato: un thread lo fa
+    ogni fsync_interval secondi se ci sono righe nuove, oppure append(sync=True) lo fa
+    subito (per gli eventi che devono essere su disco prima di proseguire).
+
+    rotate() chiude il segmento corrente; compact(seq) cancella i segmenti chiusi con
+    eventi tutti <= seq, cioè già presenti nello snapshot SQLite.
+    """
+
+    def __init__(self, directory: str, fsync_interval: float = 0.2):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._closed_segments = []   # [(path, ultimo seq)]
+        self._seq = 0
+        self._dirty = False
+        self._file = None
+        self._path = None
+        self._stop = threading.Event()
+
+        for path in self.segments():
+            if os.path.getsize(path) == 0:
+                os.remove(path)
+                continue
+            for event in self._read(path):
+                self._seq = max(self._seq, event["seq"])
+            self._closed_segments.append((path, self._seq))
+
+        self._open_segment()
+        self._thread = threading.Thread(target=self._sync_loop, name="journal-fsync", daemon=True)
+        self._thread.start()
+
+    def segments(self):
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".log")
+        )
+
+    @staticmethod
+    def _read(path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # riga troncata da un crash a metà scrittura: è l'ultima, la scartiamo
+                    break
+                if isinstance(event, dict) and "seq" in event:
+                    yield event
+
+    def _open_segment(self):
+        self._path = os.path.join(self.directory, f"{self._seq + 1:012d}.log")
+        self._file = open(self._path, "a", encoding="utf-8")
+
+    def append(self, event: str, args, sync: bool = False) -> int:
+        """Aggiunge un evento e ritorna il suo numero di sequenza."""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._file.write(json.dumps({"seq": seq, "ev": event, "args": args, "ts": time.time()}) + "\n")
+            self._file.flush()
+            self._dirty = True
+            if sync:
+                self._fsync_locked()
+        return seq
+
+    def advance_to(self, seq: int):
+        """Riprende la numerazione almeno da seq (segmenti già compattati nello snapshot)."""
+        with self._lock:
+            self._seq = max(self._seq, int(seq))
+
+    def last_seq(self) -> int:
+        with self._lock:
+            return self._seq
+
+    def _fsync_locked(self):
+        if self._dirty and self._file is not None:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def sync(self):
+        with self._lock:
+            self._fsync_locked()
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"⚠️ fsync journal fallito: {e}")
+
+    def rotate(self) -> int:
+        """Chiude il segmento corrente (se contiene eventi) e ne apre uno nuovo. Ritorna l'ultimo seq."""
+        with self._lock:
+            if os.path.getsize(self._path) > 0:
+                self._fsync_locked()
+                self._file.close()
+                self._closed_segments.append((self._path, self._seq))
+                self._open_segment()
+            return self._seq
+
+    def compact(self, applied_seq: int) -> int:
+        """Cancella i segmenti chiusi già riportati nello snapshot. Ritorna quanti ne ha cancellati."""
+        with self._lock:
+            keep, drop = [], []
+            for path, last in self._closed_segments:
+                (drop if last <= applied_seq else keep).append((path, last))
+            self._closed_segments = keep
+        for path, _last in drop:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return len(drop)
+
+    def events_after(self, seq: int):
+        """Eventi dei segmenti chiusi con numero > seq, in ordine (per il replay all'avvio)."""
+        with self._lock:
+            paths = [path for path, _last in self._closed_segments]
+        for path in paths:
+            for event in self._read(path):
+                if event["seq"] > seq:
+                    yield event
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+        with self._lock:
+            self._fsync_locked()
+            self._file.close()
+            self._file = None
@@ -1,70 +1,312 @@
 import os
 import time
+
+_IMPORT_T0 = time.perf_counter()
 import json
-import base64
 import re
+import signal
+import sys
 import datetime as dt
 import telegram
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from html import escape
-from threading import Lock
-
-from telegram.ext import Updater, MessageHandler, Filters, CommandHandler
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+from threading import Event, Lock
+
+
+from backends import GoogleDriveBackend, credentials_configured, is_quota_error, open_worksheet
+from cluster import Cluster, default_instance_id
+from conferma_matcher import load_matcher
+from digest import DigestBatcher
+from jobs import AdaptiveJob
+from journal import Journal
+from metrics import Metrics, start_http_server
+from outbox import Outbox
+from reminders import PendingReminders
+from rolling_stats import RollingStats, TTC_BUCKETS
+from sheet_writeback import SheetWriteBack
+from state_store import StateStore
+from write_behind import WriteBehindStore
 
 # === CONFIG ===
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
-if not BOT_TOKEN:
-    raise RuntimeError("❌ Manca BOT_TOKEN nelle variabili d'ambiente.")
 
 FOLDER_NAME = os.getenv("FOLDER_NAME", "PreventiviTelegram")
 CONFIRMATION_GROUP_ID = int(os.getenv("CONFIRMATION_GROUP_ID", "-5071236492"))
 
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "60"))                 # secondi
+# job separati per scansione Drive e solleciti, con intervallo adattivo tra MIN e MAX
+SCAN_INTERVAL = int(os.getenv("SCAN_INTERVAL", str(CHECK_INTERVAL)))
+SCAN_INTERVAL_MIN = int(os.getenv("SCAN_INTERVAL_MIN", str(max(10, SCAN_INTERVAL // 4))))   # con novità su Drive
+SCAN_INTERVAL_MAX = int(os.getenv("SCAN_INTERVAL_MAX", str(SCAN_INTERVAL * 10)))            # con errori di quota
+SOLLECITO_CHECK_INTERVAL = int(os.getenv("SOLLECITO_CHECK_INTERVAL", str(CHECK_INTERVAL)))
 SOLLECITO_INTERVAL = int(os.getenv("SOLLECITO_INTERVAL", str(4 * 3600)))  # 4 ore
 SOLLECITO_MAX = int(os.getenv("SOLLECITO_MAX", "12"))                  # 48 ore
 
-CACHE_FILE = os.getenv("CACHE_FILE", "bot_cache.json")
+CACHE_FILE = os.getenv("CACHE_FILE", "bot_cache.json")  # vecchio formato JSON, migrato una sola volta in STATE_DB
+STATE_DB = os.getenv("STATE_DB", os.path.join(os.path.dirname(CACHE_FILE), "bot_state.db"))
+# più istanze in parallelo sullo stesso STATE_DB: ognuna scansiona e sollecita solo i suoi gruppi,
+# una sola (col lease) riceve gli update Telegram e manda il report. Coordinamento su CLUSTER_DB.
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "0").strip().lower() in ("1", "true", "yes", "on")
+INSTANCE_ID = os.getenv("INSTANCE_ID", "").strip() or default_instance_id()  # meglio fisso: journal e token sono per istanza
+CLUSTER_DB = os.getenv("CLUSTER_DB", os.path.join(os.path.dirname(STATE_DB), "bot_cluster.db"))
+CLUSTER_HEARTBEAT = float(os.getenv("CLUSTER_HEARTBEAT", "5"))  # secondi tra due heartbeat/rinnovi del lease
+CLUSTER_TTL = float(os.getenv("CLUSTER_TTL", "20"))              # oltre, istanza considerata morta e lease libero
+# secondi di validità dell'elenco dei gruppi di altre istanze con solleciti pendenti (per le conferme)
+REMOTE_PENDING_TTL = float(os.getenv("REMOTE_PENDING_TTL", "10"))
+_INSTANCE_SUFFIX = f".{INSTANCE_ID}" if CLUSTER_MODE else ""
+# scritture di stato differite: un'unica transazione ogni STATE_FLUSH_DELAY secondi o STATE_FLUSH_MAX_PENDING operazioni
+STATE_FLUSH_DELAY = float(os.getenv("STATE_FLUSH_DELAY", "2"))
+STATE_FLUSH_MAX_PENDING = int(os.getenv("STATE_FLUSH_MAX_PENDING", "500"))
+# retention: oltre RETENTION_DAYS si potano solo le chiavi di cartelle cestinate/rimosse su Drive
+# e le statistiche giornaliere diventano mensili (0 = conserva tutto)
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+# journal degli eventi (append-only) davanti a SQLite: dopo un crash si riparte da snapshot + journal
+# (vuoto: STATE_DB + ".journal", uno per istanza, deciso in init_store con la configurazione dell'avvio)
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "")
+JOURNAL_FSYNC_INTERVAL = float(os.getenv("JOURNAL_FSYNC_INTERVAL", "0.2"))   # secondi tra due fsync
+
+# scansione Drive: "incremental" usa la Changes API, "full" rilegge tutte le cartelle ad ogni tick
+SCAN_MODE = os.getenv("SCAN_MODE", "incremental").strip().lower()
+FULL_SCAN_INTERVAL = int(os.getenv("FULL_SCAN_INTERVAL", "3600"))       # secondi, riconciliazione completa
+
+# cache della topologia Drive (cartella radice + cartelle gruppo), salvata accanto a CACHE_FILE
+TOPOLOGY_FILE = os.getenv(
+    "TOPOLOGY_FILE", os.path.join(os.path.dirname(CACHE_FILE), f"bot_topology{_INSTANCE_SUFFIX}.json")
+)
+TOPOLOGY_TTL = int(os.getenv("TOPOLOGY_TTL", str(6 * 3600)))  # secondi, oltre i quali si rilegge comunque
+SCAN_WORKERS = max(1, int(os.getenv("SCAN_WORKERS", "8")))     # thread per il listing parallelo dei gruppi
+PERMISSION_BATCH_SIZE = min(100, int(os.getenv("PERMISSION_BATCH_SIZE", "100")))  # max 100 chiamate per batch Drive
 
 # offset orario (per i report/statistiche). 0 = UTC, 1 = UTC+1, ecc.
 TZ_OFFSET_HOURS = int(os.getenv("TZ_OFFSET_HOURS", "0"))
 DAILY_REPORT_HOUR = int(os.getenv("DAILY_REPORT_HOUR", "20"))  # ora del report giornaliero (0-23, nel fuso TZ_OFFSET_HOURS)
 
-bot = telegram.Bot(token=BOT_TOKEN)
-
-# === GOOGLE DRIVE CREDENTIALS (da Railway Variables) ===
-SCOPES = ["https://www.googleapis.com/auth/drive"]
-
-creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON", "").strip()
-creds_b64 = os.getenv("GOOGLE_CREDENTIALS_B64", "").strip()
-
-if creds_json:
-    info = json.loads(creds_json)
-    creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
-elif creds_b64:
-    raw = base64.b64decode(creds_b64).decode("utf-8")
-    info = json.loads(raw)
-    creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
-else:
-    # fallback SOLO per locale se hai il file (sconsigliato su Railway)
-    CREDENTIALS_FILE = "credentials.json"
-    if not os.path.exists(CREDENTIALS_FILE):
+# limiti di invio Telegram (~30 msg/s globali, ~20 msg/min per gruppo)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))         # msg/s su tutte le chat
+TG_CHAT_PER_MINUTE = int(os.getenv("TG_CHAT_PER_MINUTE", "20"))   # msg/min per singola chat
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))              # raffica iniziale consentita per chat
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))            # retry su errori di rete (backoff esponenziale)
+
+# ricezione update: "polling" (default) oppure "webhook" con server HTTP integrato
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()           # URL pubblico https; vuoto = non registrare (test locale)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()     # header X-Telegram-Bot-Api-Secret-Token
+TG_WORKERS = int(os.getenv("TG_WORKERS", "4"))               # worker del dispatcher per gli handler
+
+# motore: "threads" (Updater/JobQueue v13, default) oppure "asyncio" (async_engine, richiede aiohttp;
+# solo polling e senza cluster, altrimenti si ripiega sul motore a thread)
+ENGINE = os.getenv("ENGINE", "threads").strip().lower()
+ASYNC_DRIVE_CONCURRENCY = int(os.getenv("ASYNC_DRIVE_CONCURRENCY", str(SCAN_WORKERS)))  # chiamate Drive in parallelo
+ASYNC_SEND_CONCURRENCY = int(os.getenv("ASYNC_SEND_CONCURRENCY", "8"))   # invii Telegram in parallelo (chat diverse)
+ASYNC_PERMISSION_CONCURRENCY = int(os.getenv("ASYNC_PERMISSION_CONCURRENCY", "4"))  # permissions.create in volo
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))                  # connessioni keep-alive per host
+
+# documento di discovery Drive v3 salvato su disco (facoltativo): di default quello incluso in googleapiclient
+DRIVE_DISCOVERY_FILE = os.getenv("DRIVE_DISCOVERY_FILE", "").strip()
+
+# stato dei preventivi scritto nelle loro righe del foglio di bot_link_preventivi_drive.py (vuoto = disattivato):
+# Confermato = Sì alla conferma, più Stato/Solleciti/Aggiornato se il foglio ha quelle colonne.
+# Un giro ogni SHEET_FLUSH_INTERVAL secondi fa UNA batch_update, ben sotto le 60 scritture/min dei Sheets
+SHEET_WRITEBACK_ID = os.getenv("SHEET_WRITEBACK_ID", "").strip()
+SHEET_WRITEBACK_TAB = os.getenv("SHEET_WRITEBACK_TAB", "").strip()   # vuoto = primo foglio, come bot_link
+SHEET_WRITEBACK_STATE_FILE = os.getenv(
+    "SHEET_WRITEBACK_STATE_FILE", os.path.join(os.path.dirname(CACHE_FILE), "sheet_writeback_state.json")
+)
+SHEET_FLUSH_INTERVAL = max(5, int(os.getenv("SHEET_FLUSH_INTERVAL", "15")))
+SHEET_FLUSH_MAX_ROWS = int(os.getenv("SHEET_FLUSH_MAX_ROWS", "500"))
+
+# metriche Prometheus su http://METRICS_LISTEN:METRICS_PORT/metrics (0 = disattivato)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# === BACKEND (Drive + Telegram) ===
+# costruiti da init_backends() all'avvio, oppure iniettati con configure_backends()
+# (es. fakes.FakeDrive / fakes.FakeBot per benchmark e prove offline)
+drive = None
+bot = None
+
+# coda unica per TUTTI i messaggi in uscita (rate limit + RetryAfter + retry)
+outbox = Outbox(
+    None,
+    global_rate=TG_GLOBAL_RATE,
+    chat_per_minute=TG_CHAT_PER_MINUTE,
+    chat_burst=TG_CHAT_BURST,
+    max_retries=TG_MAX_RETRIES,
+)
+
+# messaggi di un giro (scansione o solleciti) uniti per chat; le notifiche di controllo in un riepilogo
+digest = DigestBatcher(
+    CONFIRMATION_GROUP_ID,
+    {
+        "nuovi": "✉️ <b>Nuovi preventivi disponibili:</b>",
+        "solleciti": "🔔 <b>Promemoria: preventivi da confermare</b>",
+        "scaduti": (
+            "❌ <b>Non abbiamo ricevuto conferma per questi preventivi.</b>\n"
+            "Il lavoro verrà assegnato a un'altra azienda."
+        ),
+    },
+    "📋 <b>Riepilogo invii</b>",
+    # preventivi in partenza: dopo un crash da qui in poi si considerano consegnati
+    on_dispatch=lambda keys: store.record_dispatch(keys),
+)
+
+# latenze per fase, chiamate API ed errori (vedi /perf e /metrics)
+metrics = Metrics()
+
+# eventi dei preventivi accumulati e scritti sul foglio a lotti (job sheet_flush)
+sheet_log = (
+    SheetWriteBack(
+        lambda: open_worksheet(SHEET_WRITEBACK_ID, SHEET_WRITEBACK_TAB or None),
+        SHEET_WRITEBACK_STATE_FILE,
+        max_rows=SHEET_FLUSH_MAX_ROWS,
+        metrics=metrics,
+    )
+    if SHEET_WRITEBACK_ID
+    else None
+)
+
+_scan_pool = None
+
+
+def configure_backends(drive_backend, telegram_bot):
+    """Imposta i client Drive/Telegram usati dal bot (reali o finti)."""
+    global drive, bot
+    drive = drive_backend
+    bot = telegram_bot
+    outbox.bot = telegram_bot
+
+
+def init_backends():
+    """Costruisce i client reali dalle variabili d'ambiente."""
+    if not BOT_TOKEN:
+        raise RuntimeError("❌ Manca BOT_TOKEN nelle variabili d'ambiente.")
+    if not credentials_configured():
         raise RuntimeError(
             "❌ Manca GOOGLE_CREDENTIALS_JSON (o GOOGLE_CREDENTIALS_B64) e non trovo credentials.json in locale."
         )
-    creds = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
+    # credenziali e client Drive si costruiscono alla prima chiamata (nel thread della scansione)
+    configure_backends(
+        GoogleDriveBackend(discovery_file=DRIVE_DISCOVERY_FILE or None), telegram.Bot(token=BOT_TOKEN)
+    )
+
+
+def init_store():
+    """Apre SQLite e il journal e avvia il flush differito (importare main non crea file né thread)."""
+    global store
+    state = StateStore(STATE_DB)
+    # il journal nasce insieme allo store che lo riapplica, dopo config e backend
+    journal = Journal(JOURNAL_DIR or STATE_DB + ".journal" + _INSTANCE_SUFFIX, fsync_interval=JOURNAL_FSYNC_INTERVAL)
+    try:
+        store = WriteBehindStore(
+            state,
+            max_delay=STATE_FLUSH_DELAY,
+            max_pending=STATE_FLUSH_MAX_PENDING,
+            metrics=metrics,
+            journal=journal,
+            seq_key="journal_seq" + _INSTANCE_SUFFIX,
+        )
+    except Exception:
+        journal.close()
+        state.close()
+        raise
+    return store
 
-drive = build("drive", "v3", credentials=creds)
 
-# === CACHE (thread-safe + persistente) ===
+def _get_scan_pool():
+    global _scan_pool
+    if _scan_pool is None:
+        _scan_pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix="drive-scan")
+    return _scan_pool
+
+
+# === STATO (thread-safe + persistente) ===
 # key = (gruppo_id:int, preventivo_folder_id:str)
+# sent/confirmed/statistiche vivono solo in SQLite (STATE_DB); in memoria restano i solleciti pendenti.
+# Le scritture passano da WriteBehindStore: chi le fa non aspetta SQLite e non tiene `lock`;
+# ogni evento è prima aggiunto al journal, così niente va perso tra un flush e l'altro.
+store = None          # WriteBehindStore, creato da init_store() all'avvio
 lock = Lock()
-sent_cache = set()
-reminder_cache = {}   # key -> {"t0": float, "count": int, "link": str, "nome": str}
-confirmed_cache = set()
-# stats_by_day[YYYY-MM-DD] = {"sent": int, "confirmed": int, "expired": int}
-stats_by_day = {}
+save_lock = Lock()    # serializza le scritture dei file JSON (topologia)
+# key -> {"t0": float, "count": int, "link": str, "nome": str}, indicizzato per gruppo
+reminder_cache = PendingReminders(SOLLECITO_INTERVAL, SOLLECITO_MAX)
+sending_keys = set()  # preventivi accodati nell'outbox ma non ancora consegnati
+# statistiche per giorno e gruppo aggiornate a ogni evento (/stato, /report, report giornaliero)
+ROLLING_DAYS = 60     # 30 giorni + i 30 precedenti per il confronto
+rolling = RollingStats(ROLLING_DAYS)
+
+# frasi di conferma (CONFERMA_FRASI*, vedi conferma_matcher), compilate una volta all'avvio
+confirm_matcher = load_matcher()
+
+# stato della scansione incrementale: token della Changes API (persistito in STATE_DB, uno per istanza)
+scan_state = {"changes_token": None, "last_full_scan": 0.0}
+CHANGES_TOKEN_KEY = "changes_token" + _INSTANCE_SUFFIX
+# topologia Drive (persistita in TOPOLOGY_FILE):
+# groups[folder_id] = {"name": str, "gruppo_id": int|None, "modified": str, "checked": float}
+topology = {"root_id": None, "root_checked": 0.0, "groups": {}}
+
+metrics.gauge(
+    "state_pending_writes",
+    lambda: store.pending() if store is not None else 0,
+    "Scritture di stato non ancora su SQLite",
+)
+metrics.gauge("pending_reminders", lambda: len(reminder_cache), "Preventivi in attesa di conferma")
+metrics.gauge("outbox_depth", lambda: outbox.depth(), "Messaggi Telegram in coda")
+metrics.gauge("outbox_sent", lambda: outbox.stats()["sent"], "Messaggi Telegram consegnati dall'avvio")
+metrics.gauge("outbox_failed", lambda: outbox.stats()["failed"], "Messaggi Telegram falliti dall'avvio")
+metrics.gauge("outbox_retried", lambda: outbox.stats()["retried"], "Retry Telegram (RetryAfter/rete) dall'avvio")
+metrics.gauge("outbox_latency_avg_seconds", lambda: outbox.stats()["latency_avg"], "Latenza media di consegna")
+
+# === CLUSTER ===
+LEADER_LEASE = "telegram"
+cluster = (
+    Cluster(
+        CLUSTER_DB,
+        INSTANCE_ID,
+        heartbeat=CLUSTER_HEARTBEAT,
+        ttl=CLUSTER_TTL,
+        # il vecchio proprietario deve vedere il cambio e scrivere lo stato prima del passaggio
+        grace=2 * CLUSTER_HEARTBEAT + STATE_FLUSH_DELAY,
+    )
+    if CLUSTER_MODE
+    else None
+)
+if cluster is not None:
+    metrics.gauge("cluster_members", lambda: len(cluster.members()), "Istanze attive nel cluster")
+    metrics.gauge("cluster_leader", lambda: int(cluster.holds(LEADER_LEASE)), "1 se questa istanza riceve gli update")
+
+
+def _owns(gruppo_id) -> bool:
+    """True se il gruppo è di questa istanza (sempre, senza cluster)."""
+    return cluster is None or cluster.owns(gruppo_id)
+
+
+def _is_leader() -> bool:
+    return cluster is None or cluster.holds(LEADER_LEASE)
+
+
+# gruppi di altre istanze con solleciti pendenti: le conferme arrivano tutte al leader, ma
+# basta rileggerli da SQLite ogni REMOTE_PENDING_TTL secondi, non a ogni messaggio
+remote_pending = set()
+_remote_pending_at = 0.0
+
+
+def _remote_has_pending(gruppo_id) -> bool:
+    global remote_pending, _remote_pending_at
+    now = time.monotonic()
+    if now - _remote_pending_at >= REMOTE_PENDING_TTL:
+        groups = store.pending_groups()
+        with lock:
+            remote_pending, _remote_pending_at = groups, now
+    return gruppo_id in remote_pending
+
+
+def _short(text: str, limit: int = 300) -> str:
+    """Tronca i nomi troppo lunghi, così una voce del digest sta sempre in un messaggio."""
+    return text if len(text) <= limit else text[: limit - 1] + "…"
 
 
 def _now_local():
@@ -78,117 +320,198 @@ def _day_key_for(d: dt.datetime = None) -> str:
     return d.strftime("%Y-%m-%d")
 
 
-def _inc_stat(field: str, n: int = 1):
-    """Incrementa una statistica del giorno corrente."""
-    if n <= 0:
+def load_cache():
+    """Migra l'eventuale vecchio CACHE_FILE e carica in memoria solo i solleciti pendenti."""
+    try:
+        store.migrate_json(CACHE_FILE)
+    except Exception as e:
+        print(f"⚠️ Cache non leggibile ({CACHE_FILE}), la ignoro: {e}")
+
+    replayed = store.recover()
+    if replayed:
+        print(f"📜 Journal: riapplicati {replayed} eventi non ancora nello snapshot")
+
+    _load_owned_reminders()
+    _load_rolling()
+    token = store.get_meta(CHANGES_TOKEN_KEY)
+    with lock:
+        scan_state["changes_token"] = token
+
+    print(f"📦 Stato ({STATE_DB}): pending={len(reminder_cache)}")
+    _resume_intents()
+
+
+def _load_owned_reminders():
+    """Carica in memoria i solleciti pendenti dei gruppi di questa istanza."""
+    reminders = store.load_reminders()
+    with lock:
+        reminder_cache.clear()
+        reminder_cache.update({k: v for k, v in reminders.items() if _owns(k[0])})
+
+
+def _load_rolling(target: RollingStats = None, pending_by_group: dict = None):
+    """Carica gli ultimi ROLLING_DAYS giorni di statistiche per gruppo (di default in `rolling`)."""
+    since = _day_key_for(_now_local() - dt.timedelta(days=ROLLING_DAYS - 1))
+    rows, ttc_rows = store.load_group_stats(since)
+    if pending_by_group is None:
+        pending_by_group = {}
+        with lock:
+            for gid, _fid in reminder_cache.keys():
+                pending_by_group[gid] = pending_by_group.get(gid, 0) + 1
+    target = rolling if target is None else target
+    target.load(rows, ttc_rows, pending_by_group)
+    return target
+
+
+def _stats_view() -> RollingStats:
+    """
+    Statistiche per /stato e i report: quelle tenute in memoria o, in modalità cluster
+    (ogni istanza vede solo i suoi eventi), ricaricate da SQLite.
+    """
+    if cluster is None:
+        return rolling
+    pending_by_group = {}
+    for gid, _fid in store.load_reminders():
+        pending_by_group[gid] = pending_by_group.get(gid, 0) + 1
+    return _load_rolling(RollingStats(ROLLING_DAYS), pending_by_group)
+
+
+def _day_stats(view: RollingStats, day: str) -> dict:
+    """Inviati/confermati/scaduti del giorno: dalla vista per gruppo se lo copre, altrimenti da SQLite."""
+    if view.covers(day):
+        return view.day(day)
+    return store.get_stats(day)
+
+
+def _on_cluster_change(members):
+    """Nuova ripartizione dei gruppi: ricarica lo stato e rilegge su Drive i gruppi acquisiti."""
+    # sent scritto dagli altri processi non è nel filtro di Bloom di questo
+    store.reload_bloom()
+    _load_owned_reminders()
+    with lock:
+        for entry in topology["groups"].values():
+            entry["modified"] = ""
+        scan_state["last_full_scan"] = 0.0
+    print(f"🧩 Gruppi ridistribuiti: pending in carico={len(reminder_cache)}")
+
+
+def _resume_intents():
+    """
+    Preventivi rimasti in uscita al crash precedente, senza rileggere Drive:
+    - mai passati a Telegram → di nuovo in coda;
+    - invio già iniziato → considerati consegnati (meglio un sollecito che un doppio invio).
+    """
+    intents = store.load_intents()
+    if not intents:
         return
-    day = _day_key_for()
+    requeued = 0
+    assumed = 0
+    for key, it in intents.items():
+        if not _owns(key[0]):
+            # gruppo di un'altra istanza: lo ritrova la sua scansione
+            continue
+        if it["dispatched"]:
+            info = {"t0": it["ts"], "count": 0, "link": it["link"], "nome": it["nome"]}
+            day = _day_key_for()
+            store.record_sent(key[0], key[1], info, day)
+            rolling.sent(key[0], day)
+            with lock:
+                reminder_cache[key] = info
+            _sheet_record(key, info, "in attesa")
+            assumed += 1
+        else:
+            invia_preventivo(key[0], it["nome"], it["link"], key)
+            requeued += 1
+    digest.flush(outbox)
+    print(f"📜 Invii interrotti: {requeued} rimessi in coda, {assumed} considerati consegnati")
+
+
+def _sheet_record(key, info: dict, stato: str):
+    if sheet_log is not None:
+        sheet_log.record(key[0], info.get("nome", ""), stato, info.get("count", 0), _now_local())
+
+
+def _set_changes_token(token):
     with lock:
-        day_stats = stats_by_day.setdefault(day, {"sent": 0, "confirmed": 0, "expired": 0})
-        day_stats[field] = int(day_stats.get(field, 0)) + n
+        changed = scan_state["changes_token"] != token
+        scan_state["changes_token"] = token
+    if changed:
+        with metrics.timed("save_state"):
+            store.set_meta(CHANGES_TOKEN_KEY, token)
 
 
-def load_cache():
-    if not os.path.exists(CACHE_FILE):
+def load_topology():
+    if not os.path.exists(TOPOLOGY_FILE):
         return
     try:
-        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+        with open(TOPOLOGY_FILE, "r", encoding="utf-8") as f:
             data = json.load(f)
     except Exception as e:
-        print(f"⚠️ Cache non leggibile ({CACHE_FILE}), la ignoro: {e}")
+        print(f"⚠️ Topologia non leggibile ({TOPOLOGY_FILE}), la ignoro: {e}")
         return
 
     with lock:
-        sent_cache.clear()
-        reminder_cache.clear()
-        confirmed_cache.clear()
-        stats_by_day.clear()
-
-        for entry in data.get("sent", []):
-            try:
-                gid, fid = entry
-                sent_cache.add((int(gid), str(fid)))
-            except Exception:
-                pass
-
-        for entry in data.get("confirmed", []):
-            try:
-                gid, fid = entry
-                confirmed_cache.add((int(gid), str(fid)))
-            except Exception:
-                pass
-
-        for r in data.get("reminders", []):
+        topology["root_id"] = data.get("root_id") or None
+        topology["root_checked"] = float(data.get("root_checked", 0.0))
+        topology["groups"] = {}
+        for fid, g in (data.get("groups") or {}).items():
             try:
-                gid = int(r["gruppo_id"])
-                fid = str(r["folder_id"])
-                reminder_cache[(gid, fid)] = {
-                    "t0": float(r.get("t0", time.time())),
-                    "count": int(r.get("count", 0)),
-                    "link": str(r.get("link", "")),
-                    "nome": str(r.get("nome", "")),
+                gid = g.get("gruppo_id")
+                topology["groups"][str(fid)] = {
+                    "name": str(g.get("name", "")),
+                    "gruppo_id": int(gid) if gid is not None else None,
+                    "modified": str(g.get("modified", "")),
+                    "checked": float(g.get("checked", 0.0)),
                 }
             except Exception:
                 pass
 
-        raw_stats = data.get("stats_by_day", {})
-        if isinstance(raw_stats, dict):
-            for day, stats in raw_stats.items():
-                try:
-                    stats_by_day[str(day)] = {
-                        "sent": int(stats.get("sent", 0)),
-                        "confirmed": int(stats.get("confirmed", 0)),
-                        "expired": int(stats.get("expired", 0)),
-                    }
-                except Exception:
-                    pass
-
-    print(
-        f"📦 Cache: sent={len(sent_cache)} pending={len(reminder_cache)} "
-        f"confirmed={len(confirmed_cache)} days_stats={len(stats_by_day)}"
-    )
+    print(f"🗂 Topologia: root={topology['root_id']} gruppi={len(topology['groups'])}")
 
 
-def save_cache():
+@metrics.timed("save_topology")
+def save_topology():
     with lock:
         payload = {
-            "sent": [[gid, fid] for (gid, fid) in sent_cache],
-            "confirmed": [[gid, fid] for (gid, fid) in confirmed_cache],
-            "reminders": [
-                {
-                    "gruppo_id": gid,
-                    "folder_id": fid,
-                    "t0": info.get("t0", 0),
-                    "count": info.get("count", 0),
-                    "link": info.get("link", ""),
-                    "nome": info.get("nome", ""),
-                }
-                for (gid, fid), info in reminder_cache.items()
-            ],
-            "stats_by_day": stats_by_day,
+            "root_id": topology["root_id"],
+            "root_checked": topology["root_checked"],
+            "groups": {fid: dict(g) for fid, g in topology["groups"].items()},
         }
 
     try:
-        tmp = CACHE_FILE + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False)
-        os.replace(tmp, CACHE_FILE)
+        with save_lock:
+            tmp = TOPOLOGY_FILE + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False)
+            os.replace(tmp, TOPOLOGY_FILE)
+    except Exception as e:
+        print(f"⚠️ Impossibile salvare topologia: {e}")
+
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+# campi letti per le cartelle preventivo: i permessi servono a saltare quelle già condivise
+# permissionIds c'è anche nei Drive condivisi, dove permissions non viene restituito
+PREVENTIVO_FIELDS = "id, name, permissionIds, permissions(type, role)"
+# id del permesso "chiunque abbia il link"
+ANYONE_PERMISSION_ID = "anyoneWithLink"
+
+
+def _drive_call(method: str, fn, *args, **kwargs):
+    """Chiamata al backend Drive, contata per metodo (errori di quota a parte)."""
+    metrics.inc("drive_requests_total", method=method)
+    try:
+        return fn(*args, **kwargs)
     except Exception as e:
-        print(f"⚠️ Impossibile salvare cache: {e}")
+        if is_quota_error(e):
+            metrics.inc("drive_quota_errors_total", method=method)
+        raise
 
 
-def _drive_list_folders(query: str):
+def _drive_list_folders(query: str, fields: str = "id, name"):
     files = []
     page_token = None
     while True:
-        resp = drive.files().list(
-            q=query,
-            fields="nextPageToken, files(id, name)",
-            pageSize=1000,
-            supportsAllDrives=True,
-            includeItemsFromAllDrives=True,
-            pageToken=page_token,
-        ).execute()
+        resp = _drive_call("files.list", drive.list_files, query, f"nextPageToken, files({fields})", page_token=page_token)
         files.extend(resp.get("files", []))
         page_token = resp.get("nextPageToken")
         if not page_token:
@@ -196,45 +519,120 @@ def _drive_list_folders(query: str):
     return files
 
 
+def _name_query(name: str) -> str:
+    return f"name = '{name}' and mimeType = '{FOLDER_MIME}' and trashed = false"
+
+
+def _children_query(parent_id: str) -> str:
+    return f"'{parent_id}' in parents and mimeType = '{FOLDER_MIME}' and trashed = false"
+
+
 def get_folder_id_by_name(name: str):
-    query = (
-        f"name = '{name}' and "
-        "mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-    )
-    results = drive.files().list(
-        q=query,
-        fields="files(id, name)",
-        pageSize=10,
-        supportsAllDrives=True,
-        includeItemsFromAllDrives=True,
-    ).execute()
+    results = _drive_call("files.list", drive.list_files, _name_query(name), "files(id)", page_size=1)
     folders = results.get("files", [])
     return folders[0]["id"] if folders else None
 
 
-def get_subfolders(parent_id: str):
-    query = (
-        f"'{parent_id}' in parents and "
-        "mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-    )
-    return _drive_list_folders(query)
+@metrics.timed("get_subfolders")
+def get_subfolders(parent_id: str, fields: str = "id, name"):
+    return _drive_list_folders(_children_query(parent_id), fields)
 
 
-def generate_share_link(folder_id: str) -> str:
-    permission = {"type": "anyone", "role": "reader", "allowFileDiscovery": False}
+def _list_group_worker(folder_id: str):
     try:
-        drive.permissions().create(
-            fileId=folder_id,
-            body=permission,
-            supportsAllDrives=True,
-            fields="id",
-        ).execute()
-    except Exception:
-        # se fallisce per policy/perms già presenti, ok
-        pass
+        return get_subfolders(folder_id, PREVENTIVO_FIELDS), None
+    except Exception as e:
+        return None, e
+
+
+def get_subfolders_many(folder_ids):
+    """
+    Lista in parallelo (max SCAN_WORKERS) le sottocartelle di più cartelle.
+    Ritorna [(folder_id, files|None, errore|None)] nello stesso ordine di folder_ids.
+    """
+    folder_ids = list(folder_ids)
+    if len(folder_ids) <= 1 or SCAN_WORKERS == 1:
+        results = map(_list_group_worker, folder_ids)
+    else:
+        results = _get_scan_pool().map(_list_group_worker, folder_ids)
+    return [(fid, files, err) for fid, (files, err) in zip(folder_ids, results)]
+
+
+def get_root_folder_id():
+    """ID della cartella radice, dalla topologia finché non scade TOPOLOGY_TTL."""
+    root_id = _cached_root_id()
+    if root_id:
+        return root_id
+    return _set_root_id(get_folder_id_by_name(FOLDER_NAME), time.time())
+
+
+def _cached_root_id():
+    """ID della radice se ancora valido (None = da cercare su Drive)."""
+    with lock:
+        if time.time() - topology["root_checked"] < TOPOLOGY_TTL:
+            return topology["root_id"]
+    return None
+
+
+def _set_root_id(root_id, now: float):
+    with lock:
+        if root_id != topology["root_id"]:
+            # radice cambiata: la vecchia mappa dei gruppi non vale più
+            topology["groups"] = {}
+        topology["root_id"] = root_id
+        topology["root_checked"] = now
+    return root_id
+
+
+def folder_link(folder_id: str) -> str:
     return f"https://drive.google.com/drive/folders/{folder_id}"
 
 
+def _is_public(folder: dict) -> bool:
+    if ANYONE_PERMISSION_ID in (folder.get("permissionIds") or ()):
+        return True
+    return any(
+        p.get("type") == "anyone" and p.get("role") in ("reader", "commenter", "writer")
+        for p in folder.get("permissions") or []
+    )
+
+
+@metrics.timed("generate_share_links")
+def generate_share_links(folders):
+    """
+    Rende leggibili via link le cartelle (batch Drive da max PERMISSION_BATCH_SIZE chiamate),
+    saltando quelle che hanno già un permesso 'anyone'.
+    Ritorna (links, errors): folder_id -> link e folder_id -> eccezione per gli elementi falliti.
+    """
+    links = {f["id"]: folder_link(f["id"]) for f in folders}
+    pending = [f["id"] for f in folders if not _is_public(f)]
+    errors = {}
+
+    permission = {"type": "anyone", "role": "reader", "allowFileDiscovery": False}
+    for i in range(0, len(pending), PERMISSION_BATCH_SIZE):
+        chunk = pending[i:i + PERMISSION_BATCH_SIZE]
+        metrics.inc("drive_permissions_total", len(chunk))
+        try:
+            errors.update(_drive_call("batch", drive.create_permissions, chunk, permission))
+        except Exception as e:
+            for folder_id in chunk:
+                errors.setdefault(folder_id, e)
+
+    _report_permission_errors(errors)
+    return links, errors
+
+
+def _report_permission_errors(errors: dict):
+    if errors:
+        metrics.inc("drive_permission_errors_total", len(errors))
+        quota = sum(1 for e in errors.values() if is_quota_error(e))
+        if quota:
+            metrics.inc("drive_quota_errors_total", quota, method="permissions.create")
+    for folder_id, e in errors.items():
+        # il link viene comunque inviato (come prima), ma l'errore resta visibile per cartella
+        print(f"⚠️ Permesso di condivisione non creato per {folder_id}: {e}")
+
+
 def extract_group_id(folder_name: str):
     cleaned = folder_name.replace("gruppo_", "").replace("_g", "")
     try:
@@ -244,208 +642,510 @@ def extract_group_id(folder_name: str):
         return int(m.group(0)) if m else None
 
 
-def invia_preventivo(gruppo_id: int, nome_preventivo: str, link: str, key):
-    msg = f"✉️ <b>Nuovo preventivo disponibile:</b>\n<b>{escape(nome_preventivo)}</b>\n{escape(link)}"
-    try:
-        bot.send_message(chat_id=gruppo_id, text=msg, parse_mode="HTML")
-        bot.send_message(
-            chat_id=CONFIRMATION_GROUP_ID,
-            text=f"✅ Inviato al gruppo <code>{gruppo_id}</code>: {escape(nome_preventivo)}",
-            parse_mode="HTML",
-        )
-
+def _group_chat_id(folder: dict):
+    """gruppo_id telegram per una cartella gruppo; riusa la topologia se il nome non è cambiato."""
+    with lock:
+        entry = topology["groups"].get(folder["id"])
+    name = folder.get("name", "")
+    if entry is not None and entry["name"] == name:
+        return entry["gruppo_id"], False
+    gruppo_id = extract_group_id(name)
+    if gruppo_id is None:
+        print(f"❌ Cartella gruppo non valida: {name}")
+    return gruppo_id, True
+
+
+@metrics.timed("invia_preventivo")
+def invia_preventivo(gruppo_id: int, nome_preventivo: str, link: str, key, on_failed=None):
+    """
+    Aggiunge il preventivo al digest del gruppo (inviato a digest.flush()). Cache, solleciti
+    e statistiche vengono aggiornati solo a consegna avvenuta; se l'invio fallisce
+    definitivamente viene chiamato on_failed(exc).
+    """
+    with lock:
+        if key in sending_keys:
+            return
+        sending_keys.add(key)
+
+    def _on_sent(_message):
+        info = {"t0": time.time(), "count": 0, "link": link, "nome": nome_preventivo}
+        day = _day_key_for()
+        with metrics.timed("save_state"):
+            store.record_sent(key[0], key[1], info, day)
+        rolling.sent(key[0], day)
         with lock:
-            sent_cache.add(key)
-            reminder_cache[key] = {"t0": time.time(), "count": 0, "link": link, "nome": nome_preventivo}
-        _inc_stat("sent", 1)
-        save_cache()
+            sending_keys.discard(key)
+            reminder_cache[key] = info
+        _sheet_record(key, info, "in attesa")
         print(f"✅ Inviato: {nome_preventivo} → gruppo {gruppo_id}")
-    except Exception as e:
+
+    def _on_failed(e):
+        with lock:
+            sending_keys.discard(key)
+        store.drop_intent(key[0], key[1])
+        metrics.inc("send_failures_total", kind="preventivo")
         print(f"❌ Errore invio a gruppo {gruppo_id}: {e}")
+        if on_failed is not None:
+            on_failed(e)
+
+    # intento su journal PRIMA dell'invio: dopo un crash si riprende da qui
+    store.record_intent(key[0], key[1], nome_preventivo, link)
+    nome = escape(_short(nome_preventivo))
+    digest.add(
+        gruppo_id,
+        "nuovi",
+        f"• <b>{nome}</b>\n{escape(link)}",
+        single=f"✉️ <b>Nuovo preventivo disponibile:</b>\n<b>{nome}</b>\n{escape(link)}",
+        notice=f"✅ Inviato al gruppo <code>{gruppo_id}</code>: {nome}",
+        on_sent=_on_sent,
+        on_failed=_on_failed,
+        dispatch_key=key,
+    )
 
 
-def scan_and_send():
-    root_id = get_folder_id_by_name(FOLDER_NAME)
-    if not root_id:
-        print(f"❌ Cartella '{FOLDER_NAME}' non trovata su Drive (o non condivisa col service account).")
+def get_changes_start_token():
+    return _drive_call("changes.getStartPageToken", drive.get_start_page_token)
+
+
+def list_changes(page_token: str):
+    """Ritorna (changes, nuovo_token) con tutte le modifiche successive a page_token."""
+    changes = []
+    while True:
+        resp = _drive_call(
+            "changes.list",
+            drive.list_changes,
+            page_token,
+            "nextPageToken, newStartPageToken, "
+            "changes(fileId, removed, file(id, name, mimeType, parents, trashed, permissionIds, permissions(type, role)))",
+        )
+        changes.extend(resp.get("changes", []))
+        if resp.get("newStartPageToken"):
+            return changes, resp["newStartPageToken"]
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            # risposta anomala senza token: ripartiamo da quello corrente
+            return changes, get_changes_start_token()
+
+
+def _collect_new(group_entry: dict, gruppo_id: int, preventivi, out: list):
+    """Aggiunge a out le cartelle preventivo non ancora inviate: (voce topologia gruppo, key, cartella)."""
+    if not _owns(gruppo_id):
         return
+    for p in preventivi:
+        key = (gruppo_id, p["id"])
+        with lock:
+            if key in sending_keys:
+                continue
+        if store.is_sent(gruppo_id, p["id"]):
+            continue
+        out.append((group_entry, key, p))
+
+
+def _forget_group_modified(group_entry: dict):
+    # invio fallito: senza modifiedTime memorizzato il gruppo viene riletto alla prossima scansione
+    with lock:
+        group_entry["modified"] = ""
+
+
+def _unique_items(items):
+    seen = set()
+    unique = []
+    for item in items:
+        if item[1] not in seen:
+            seen.add(item[1])
+            unique.append(item)
+    return unique
+
+
+def _enqueue_collected(unique, links):
+    try:
+        for group_entry, key, p in unique:
+            invia_preventivo(
+                key[0],
+                p.get("name", "Preventivo"),
+                links[p["id"]],
+                key,
+                on_failed=lambda _e, entry=group_entry: _forget_group_modified(entry),
+            )
+    finally:
+        # un messaggio per gruppo con tutti i nuovi preventivi del giro
+        digest.flush(outbox)
+
+
+def _send_collected(items) -> int:
+    """Condivide in batch e accoda i preventivi raccolti. Ritorna quanti sono stati accodati."""
+    unique = _unique_items(items)
+    if not unique:
+        return 0
+
+    links, _errors = generate_share_links([p for (_g, _k, p) in unique])
+    _enqueue_collected(unique, links)
+    return len(unique)
+
+
+# Le scansioni sono divise in passi che toccano solo lo stato (_plan_*, _collect_*, _finish_*)
+# e chiamate Drive: il motore asyncio (async_engine) riusa i primi e fa le chiamate in parallelo.
 
-    gruppi = get_subfolders(root_id)
+def _plan_full_scan(gruppi, now: float):
+    """Nuova mappa dei gruppi e cartelle gruppo da rilistare: (groups, to_list)."""
+    groups = {}
+    to_list = []
     for gruppo in gruppi:
-        gruppo_name = gruppo.get("name", "")
-        gruppo_id = extract_group_id(gruppo_name)
+        with lock:
+            old = topology["groups"].get(gruppo["id"])
+        gruppo_id, _ = _group_chat_id(gruppo)
+        modified = gruppo.get("modifiedTime", "")
+        entry = {"name": gruppo.get("name", ""), "gruppo_id": gruppo_id, "modified": modified, "checked": now}
+        groups[gruppo["id"]] = entry
         if gruppo_id is None:
-            print(f"❌ Cartella gruppo non valida: {gruppo_name}")
+            continue
+        if not _owns(gruppo_id):
+            # gruppo di un'altra istanza: se passa a questa va riletto da capo
+            entry["modified"] = ""
             continue
 
-        preventivi = get_subfolders(gruppo["id"])
-        for p in preventivi:
-            key = (gruppo_id, p["id"])
-            with lock:
-                if key in sent_cache:
-                    continue
-            link = generate_share_link(p["id"])
-            invia_preventivo(gruppo_id, p.get("name", "Preventivo"), link, key)
+        unchanged = (
+            old is not None
+            and old["gruppo_id"] == gruppo_id
+            and modified
+            and old["modified"] == modified
+            and now - old["checked"] < TOPOLOGY_TTL
+        )
+        if unchanged:
+            entry["checked"] = old["checked"]
+            continue
+        to_list.append(gruppo["id"])
+    return groups, to_list
 
 
-def invia_sollecito():
+def _collect_listed(entry: dict, preventivi, err, out: list):
+    if err is not None:
+        print(f"❌ Errore listing gruppo {entry['name']}: {err}")
+        entry["modified"] = ""
+        return
+    _collect_new(entry, entry["gruppo_id"], preventivi, out)
+
+
+def _finish_full_scan(groups: dict, token):
+    with lock:
+        topology["groups"] = groups
+        scan_state["last_full_scan"] = time.time()
+    _set_changes_token(token)
+    save_topology()
+
+
+def scan_full() -> int:
     """
-    Invia solleciti e messaggio finale.
-    Adesso include NOME PREVENTIVO e LINK sia nei promemoria che nel messaggio di chiusura.
+    Riconciliazione completa: rilegge la radice e le cartelle gruppo, ma lista i preventivi
+    solo dei gruppi con modifiedTime cambiato (o voce di topologia scaduta).
+    Ritorna il numero di gruppi cambiati.
     """
-    now = time.time()
+    # il token va preso PRIMA del listing, così le modifiche durante la scansione arrivano al prossimo giro
+    token = get_changes_start_token()
 
+    root_id = get_root_folder_id()
+    if not root_id:
+        print(f"❌ Cartella '{FOLDER_NAME}' non trovata su Drive (o non condivisa col service account).")
+        return 0
+
+    groups, to_list = _plan_full_scan(get_subfolders(root_id, "id, name, modifiedTime"), time.time())
+
+    # listing in parallelo, invii in sequenza nell'ordine restituito da Drive
+    new_items = []
+    for folder_id, preventivi, err in get_subfolders_many(to_list):
+        _collect_listed(groups[folder_id], preventivi, err, new_items)
+
+    _send_collected(new_items)
+    _finish_full_scan(groups, token)
+    return len(to_list)
+
+
+def _changes_cursor():
+    """(token Changes API, id radice) da cui riparte la scansione incrementale."""
     with lock:
-        items = list(reminder_cache.items())
+        return scan_state["changes_token"], topology["root_id"]
+
 
-    changed = False
+def _apply_changes(changes, root_id):
+    """
+    Applica alla topologia le modifiche lette da Drive.
+    Ritorna (cartelle modificate, [(folder_id, voce)] dei nuovi gruppi da listare, topologia cambiata).
+    """
+    folders = []
+    gone = []
+    topology_changed = False
+    for ch in changes:
+        f = ch.get("file") or {}
+        if ch.get("fileId") == root_id and (ch.get("removed") or f.get("trashed")):
+            # radice rimossa: la prossima scansione completa la ricerca di nuovo
+            with lock:
+                topology["root_id"] = None
+            topology_changed = True
+            continue
+        if ch.get("removed") or f.get("trashed"):
+            # cartella preventivo (o altro file) sparita: le sue chiavi potranno uscire dallo storico
+            if ch.get("fileId") and (ch.get("removed") or f.get("mimeType") == FOLDER_MIME):
+                gone.append(ch["fileId"])
+            continue
+        if f.get("mimeType") != FOLDER_MIME:
+            continue
+        folders.append(f)
 
-    for key, _ in items:
-        gruppo_id, _folder_id = key
+    store.mark_gone(gone)
+    # cartelle ripristinate dal cestino tornano fuori dalla retention
+    store.mark_restored(f["id"] for f in folders)
 
+    # prima le nuove cartelle gruppo (possono arrivare insieme ai loro preventivi)
+    new_groups = []
+    for f in folders:
+        if root_id not in (f.get("parents") or []):
+            continue
+        gruppo_id, renamed = _group_chat_id(f)
+        if not renamed:
+            continue
+        entry = {"name": f.get("name", ""), "gruppo_id": gruppo_id, "modified": "", "checked": time.time()}
         with lock:
-            if key not in reminder_cache:
-                continue
-            if key in confirmed_cache:
-                reminder_cache.pop(key, None)
-                changed = True
+            is_new = f["id"] not in topology["groups"]
+            topology["groups"][f["id"]] = entry
+        topology_changed = True
+        if is_new and gruppo_id is not None and _owns(gruppo_id):
+            new_groups.append((f["id"], entry))
+    return folders, new_groups, topology_changed
+
+
+def _collect_changed(folders, skip_parents, out: list):
+    """Preventivi comparsi nei gruppi già noti (esclusi quelli in skip_parents, già listati)."""
+    for f in folders:
+        for parent in f.get("parents") or []:
+            if parent in skip_parents:
                 continue
+            with lock:
+                entry = topology["groups"].get(parent)
+            if entry is not None and entry["gruppo_id"] is not None:
+                _collect_new(entry, entry["gruppo_id"], [f], out)
 
-            info = reminder_cache[key]
-            t0 = info["t0"]
-            count = info["count"]
-            link = info["link"]
-            nome = info.get("nome", "preventivo")
 
-        # Messaggio finale dopo tutti i solleciti
-        if count >= SOLLECITO_MAX:
-            try:
-                bot.send_message(
-                    chat_id=gruppo_id,
-                    text=(
+def _finish_incremental(new_token, topology_changed: bool):
+    _set_changes_token(new_token)
+    if topology_changed:
+        save_topology()
+
+
+def scan_incremental() -> int:
+    """
+    Legge solo le modifiche Drive dall'ultimo token: costo proporzionale alle novità.
+    Ritorna il numero di cartelle modificate.
+    """
+    token, root_id = _changes_cursor()
+    changes, new_token = list_changes(token)
+    folders, new_groups, topology_changed = _apply_changes(changes, root_id)
+
+    new_items = []
+    for folder_id, entry in new_groups:
+        _collect_new(entry, entry["gruppo_id"], get_subfolders(folder_id, PREVENTIVO_FIELDS), new_items)
+    _collect_changed(folders, {folder_id for folder_id, _entry in new_groups}, new_items)
+
+    _send_collected(new_items)
+    _finish_incremental(new_token, topology_changed)
+    return len(folders) + int(topology_changed)
+
+
+def _full_scan_due() -> bool:
+    with lock:
+        return (
+            SCAN_MODE != "incremental"
+            or not scan_state["changes_token"]
+            or not topology["root_id"]
+            or time.time() - scan_state["last_full_scan"] >= FULL_SCAN_INTERVAL
+        )
+
+
+@metrics.timed("scan_and_send")
+def scan_and_send() -> int:
+    """Scansione incrementale, o completa se dovuta. Ritorna il numero di novità trovate."""
+    if _full_scan_due():
+        return scan_full()
+
+    try:
+        return scan_incremental()
+    except Exception:
+        # token scaduto/non valido o errore API: ripieghiamo su una scansione completa
+        print(f"⚠️ Scansione incrementale fallita, eseguo scansione completa:\n{traceback.format_exc()}")
+        _set_changes_token(None)
+        return scan_full()
+
+
+@metrics.timed("invia_sollecito")
+def invia_sollecito() -> int:
+    """
+    Invia solleciti e messaggio finale.
+    Adesso include NOME PREVENTIVO e LINK sia nei promemoria che nel messaggio di chiusura.
+    Ritorna il numero di voci scadute elaborate.
+    """
+    now = time.time()
+
+    # solo le voci arrivate a scadenza, in ordine di scadenza
+    with lock:
+        due = [(key, dict(info)) for key, info in reminder_cache.pop_due(now)]
+
+    processed = 0
+    try:
+        if cluster is not None and due:
+            # confermati dall'istanza che riceve gli update, o gruppi passati a un'altra istanza
+            live = store.pending_reminder_keys([key for key, _info in due])
+            stale = [key for key, _info in due if key not in live or not _owns(key[0])]
+            if stale:
+                with lock:
+                    for key in stale:
+                        reminder_cache.pop(key, None)
+                due = [(key, info) for key, info in due if key in live and _owns(key[0])]
+
+        for key, info in due:
+            gruppo_id, folder_id = key
+            count = info["count"]
+            link = escape(info["link"])
+            nome = escape(_short(info.get("nome", "preventivo")))
+
+            # Messaggio finale dopo tutti i solleciti
+            if count >= SOLLECITO_MAX:
+                digest.add(
+                    gruppo_id,
+                    "scaduti",
+                    f"• <b>{nome}</b>\n{link}",
+                    single=(
                         "❌ Non abbiamo ricevuto conferma per il preventivo "
-                        f"<b>{escape(nome)}</b>.\n"
+                        f"<b>{nome}</b>.\n"
                         "Il lavoro verrà assegnato a un'altra azienda.\n"
-                        f"{escape(link)}"
+                        f"{link}"
                     ),
-                    parse_mode="HTML",
+                    on_failed=lambda e, g=gruppo_id: print(f"Errore messaggio finale a {g}: {e}"),
                 )
-                bot.send_message(
-                    chat_id=CONFIRMATION_GROUP_ID,
-                    text=(
-                        f"⛔ Nessuna risposta dal gruppo <code>{gruppo_id}</code> "
-                        f"per il preventivo <b>{escape(nome)}</b>. Lavoro riassegnato."
-                    ),
-                    parse_mode="HTML",
+                digest.notify(
+                    f"⛔ Nessuna risposta dal gruppo <code>{gruppo_id}</code> "
+                    f"per il preventivo <b>{nome}</b>. Lavoro riassegnato."
                 )
-            except Exception as e:
-                print(f"Errore messaggio finale a {gruppo_id}: {e}")
 
-            with lock:
-                reminder_cache.pop(key, None)
-            _inc_stat("expired", 1)
-            changed = True
-            continue
-
-        # Solleciti intermedi
-        if now - t0 >= (count + 1) * SOLLECITO_INTERVAL:
-            try:
-                bot.send_message(
-                    chat_id=gruppo_id,
-                    text=(
-                        "🔔 <b>Promemoria: preventivo da confermare</b>\n"
-                        f"<b>{escape(nome)}</b>\n"
-                        f"{escape(link)}"
-                    ),
-                    parse_mode="HTML",
-                )
                 with lock:
-                    if key in reminder_cache:
-                        reminder_cache[key]["count"] += 1
-                changed = True
-                print(f"🔁 Sollecito → gruppo {gruppo_id} per {nome}")
-            except Exception as e:
-                print(f"Errore sollecito a {gruppo_id}: {e}")
+                    expired = reminder_cache.pop(key, None) is not None
+                if expired:
+                    day = _day_key_for()
+                    with metrics.timed("save_state"):
+                        store.expire(gruppo_id, folder_id, day)
+                    rolling.expired(gruppo_id, day)
+                    _sheet_record(key, info, "scaduto")
+                processed += 1
+                continue
 
-    if changed:
-        save_cache()
+            # Sollecito intermedio: il conteggio avanza all'accodamento, i retry li gestisce l'outbox
+            digest.add(
+                gruppo_id,
+                "solleciti",
+                f"• <b>{nome}</b>\n{link}",
+                single=(
+                    "🔔 <b>Promemoria: preventivo da confermare</b>\n"
+                    f"<b>{nome}</b>\n"
+                    f"{link}"
+                ),
+                on_failed=lambda e, g=gruppo_id: print(f"Errore sollecito a {g}: {e}"),
+            )
+            with lock:
+                current = reminder_cache.get(key)
+                if current is not None:
+                    current["count"] += 1
+                    count = current["count"]
+                    reminder_cache.reschedule(key)
+            if current is not None:
+                day = _day_key_for()
+                with metrics.timed("save_state"):
+                    store.update_reminder_count(gruppo_id, folder_id, count, day)
+                rolling.reminded(gruppo_id, day)
+                _sheet_record(key, dict(info, count=count), "in attesa")
+            print(f"🔁 Sollecito → gruppo {gruppo_id} per {info.get('nome', 'preventivo')}")
+            processed += 1
+    finally:
+        # pop_due() le ha tolte dallo heap: quelle non elaborate per un errore tornano in coda
+        if processed < len(due):
+            with lock:
+                for key, _info in due[processed:]:
+                    reminder_cache.reschedule(key)
+        # promemoria e scadenze dello stesso gruppo in un unico messaggio
+        digest.flush(outbox)
+    return len(due)
 
 
+@metrics.timed("conferma")
 def conferma(update, context):
     msg = update.effective_message
-    testo = (msg.text or "").strip().lower()
-    # normalizza gli spazi: "ok   confermo" -> "ok confermo"
-    testo = re.sub(r"\s+", " ", testo)
-
-    # frasi base accettate (esattamente uguali)
-    BASE = {"ok", "confermo", "va bene", "accetto"}
-    # frasi più lunghe che vogliamo considerare conferma
-    EXTRA = ["ok confermo", "ok, confermo", "ok va bene", "ok, va bene"]
-
-    matched = False
-    if testo in BASE:
-        matched = True
-    elif any(phrase in testo for phrase in EXTRA):
-        matched = True
-
-    if not matched:
+    gruppo_id = msg.chat.id
+
+    # scarto immediato: nessun preventivo pendente nel gruppo, nessun lavoro sul testo
+    with lock:
+        pending_here = reminder_cache.has_group(gruppo_id)
+    if not pending_here and (_owns(gruppo_id) or not _remote_has_pending(gruppo_id)):
+        return
+
+    if not confirm_matcher.matches(msg.text or ""):
         # non è un messaggio di conferma, ignora
         return
 
-    gruppo_id = msg.chat.id
     user = msg.from_user.full_name if msg.from_user else "Utente"
 
-    with lock:
-        # tutti i preventivi ancora pendenti per questo gruppo
-        pending = [k for k in reminder_cache.keys() if k[0] == gruppo_id]
-        if not pending:
-            # se arriva una conferma ma non abbiamo nulla in attesa, mandiamo un avviso nel gruppo di controllo
-            try:
-                context.bot.send_message(
-                    chat_id=CONFIRMATION_GROUP_ID,
-                    text=(
-                        f"ℹ️ Messaggio di conferma rilevato da <b>{escape(user)}</b> "
-                        f"nel gruppo <code>{gruppo_id}</code> ma non ci sono preventivi pendenti "
-                        f"(forse già scaduti o già confermati)."
-                    ),
-                    parse_mode="HTML",
-                )
-            except Exception:
-                pass
-            return
-
-        nomi = ", ".join(escape(reminder_cache[k].get("nome", "")) for k in pending)
+    # tutti i preventivi ancora pendenti per questo gruppo
+    popped = _pop_group_reminders(gruppo_id)
+    if not popped:
+        # confermati/scaduti nel frattempo
+        return
 
-        for k in pending:
-            confirmed_cache.add(k)
-            reminder_cache.pop(k, None)
+    pending = [k for k, _info in popped]
+    nomi = ", ".join(escape(info.get("nome", "")) for _k, info in popped)
+    day = _day_key_for()
+    now = time.time()
+    with metrics.timed("save_state"):
+        store.confirm(pending, day)
+    rolling.confirmed(gruppo_id, day, [now - info["t0"] for _k, info in popped])
+    for key, info in popped:
+        _sheet_record(key, info, "confermato")
+
+    outbox.send(
+        CONFIRMATION_GROUP_ID,
+        f"✅ Conferma ricevuta da <b>{escape(user)}</b> nel gruppo <code>{gruppo_id}</code> per: {nomi}",
+        on_failed=lambda e: print(f"Errore invio conferma: {e}"),
+        parse_mode="HTML",
+    )
+    print(f"✅ Conferma → gruppo {gruppo_id} da {user}")
 
-    _inc_stat("confirmed", len(pending))
-    save_cache()
 
-    try:
-        context.bot.send_message(
-            chat_id=CONFIRMATION_GROUP_ID,
-            text=f"✅ Conferma ricevuta da <b>{escape(user)}</b> nel gruppo <code>{gruppo_id}</code> per: {nomi}",
-            parse_mode="HTML",
-        )
-        print(f"✅ Conferma → gruppo {gruppo_id} da {user}")
-    except Exception as e:
-        print(f"Errore invio conferma: {e}")
+def _pop_group_reminders(gruppo_id):
+    """Toglie e ritorna [(key, info)] dei pendenti del gruppo, anche se è di un'altra istanza."""
+    with lock:
+        popped = reminder_cache.pop_group(gruppo_id)
+    if popped or _owns(gruppo_id):
+        return popped
+    # la chiusura passa da SQLite: il proprietario la vede al prossimo giro di solleciti
+    with lock:
+        remote_pending.discard(gruppo_id)
+    return list(store.group_reminders(gruppo_id).items())
 
 
 # === COMANDI ADMIN ===
 
+def _reply(update, text: str, **kwargs):
+    """Risposta a un comando, passando dall'outbox come tutti gli altri invii."""
+    msg = update.effective_message
+    outbox.send(msg.chat_id, text, reply_to_message_id=msg.message_id, **kwargs)
+
+
 def cmd_stato(update, context):
     """Mostra lo stato del bot: pendenti e statistiche di oggi/ieri."""
     now = _now_local()
     today = _day_key_for(now)
     yesterday = _day_key_for(now - dt.timedelta(days=1))
 
-    with lock:
-        today_stats = stats_by_day.get(today, {"sent": 0, "confirmed": 0, "expired": 0})
-        y_stats = stats_by_day.get(yesterday, {"sent": 0, "confirmed": 0, "expired": 0})
-        pendenti = len(reminder_cache)
+    view = _stats_view()
+    today_stats = _day_stats(view, today)
+    y_stats = _day_stats(view, yesterday)
+    pendenti = view.pending()
+    coda = outbox.stats()
 
     text = (
         f"📊 <b>Stato bot preventivi</b>\n"
@@ -457,10 +1157,76 @@ def cmd_stato(update, context):
         f"Ieri ({yesterday}):\n"
         f"• Inviati: <b>{y_stats['sent']}</b>\n"
         f"• Confermati: <b>{y_stats['confirmed']}</b>\n"
-        f"• Scaduti: <b>{y_stats['expired']}</b>\n"
+        f"• Scaduti: <b>{y_stats['expired']}</b>\n\n"
+        f"Coda invii Telegram:\n"
+        f"• In coda: <b>{coda['depth']}</b> (inviati {coda['sent']}, falliti {coda['failed']}, "
+        f"retry {coda['retried']})\n"
+        f"• Latenza media: <b>{coda['latency_avg']:.1f}s</b> (max {coda['latency_max']:.1f}s)\n"
     )
 
-    update.effective_message.reply_text(text, parse_mode="HTML")
+    _reply(update, text, parse_mode="HTML")
+
+
+def cmd_perf(update, context):
+    """Latenze per fase, chiamate Drive ed errori dall'avvio."""
+    lines = ["⏱ <b>Prestazioni</b> (dall'avvio)", "<code>fase            n   err  media  p95   max</code>"]
+    for name, ph in metrics.phases().items():
+        lines.append(
+            f"<code>{name[:15]:<15} {ph['count']:>4} {ph['errors']:>4} "
+            f"{ph['avg']:>5.2f} {ph['p95']:>5.2f} {ph['max']:>5.2f}</code>"
+        )
+
+    drive_calls = metrics.counters("drive_requests_total")
+    lines.append("")
+    lines.append(f"Chiamate Drive: <b>{int(sum(drive_calls.values()))}</b>")
+    for labels, value in sorted(drive_calls.items()):
+        lines.append(f"• {dict(labels).get('method', '?')}: {int(value)}")
+    lines.append(f"Permessi non creati: <b>{int(metrics.counter('drive_permission_errors_total'))}</b>")
+    lines.append(f"Errori di quota Drive: <b>{int(_drive_quota_errors())}</b>")
+    counts = store.counts()
+    lines.append(
+        f"Storico: inviati {counts['sent']}, confermati {counts['confirmed']}, "
+        f"cartelle rimosse {counts['gone']}, giorni {counts['stats']} "
+        f"(filtro Bloom: {counts['bloom_skips']} query evitate)"
+    )
+    st = store.stats()
+    lines.append(
+        f"Stato SQLite: {st['flushes']} transazioni per {st['ops_written']} scritture, "
+        f"in attesa {st['pending']}, ultima {st['last_flush_ms']:.1f} ms, errori {st['errors']}"
+    )
+    for job in (scan_job, sollecito_job):
+        js = job.stats()
+        lines.append(
+            f"Job {job.name}: ogni <b>{js['interval']:.0f}s</b>, eseguiti {js['runs']}, "
+            f"saltati {js['skipped']}, overrun {js['overruns']}, backoff {js['backoffs']}"
+        )
+
+    if sheet_log is not None:
+        sh = sheet_log.stats()
+        lines.append(
+            f"Foglio: {sh['rows_written']} righe in {sh['calls']} chiamate, "
+            f"in attesa {sh['pending']}, senza riga {sh['unmatched']}, errori {sh['errors']}"
+        )
+    lines.append(f"Avvio: {_startup_report()}")
+    restarts = metrics.counters("component_restarts_total")
+    if restarts:
+        lines.append(
+            "Riavvii (supervisore): "
+            + ", ".join(f"{dict(labels).get('component', '?')} {int(v)}" for labels, v in sorted(restarts.items()))
+        )
+    if cluster is not None:
+        lines.append(
+            f"Cluster: istanza <code>{escape(INSTANCE_ID)}</code>, {len(cluster.members())} attive, "
+            f"in carico {len(reminder_cache)} pendenti"
+        )
+
+    gauges = metrics.gauges()
+    lines.append(
+        f"In attesa: <b>{int(gauges.get('pending_reminders', 0))}</b> · "
+        f"coda Telegram: <b>{int(gauges.get('outbox_depth', 0))}</b> "
+        f"(falliti {int(gauges.get('outbox_failed', 0))}, retry {int(gauges.get('outbox_retried', 0))})"
+    )
+    _reply(update, "\n".join(lines), parse_mode="HTML")
 
 
 def cmd_stop_solleciti(update, context):
@@ -469,42 +1235,41 @@ def cmd_stop_solleciti(update, context):
     gruppo_id = chat.id
     user = update.effective_user.full_name if update.effective_user else "Utente"
 
-    with lock:
-        keys = [k for k in reminder_cache.keys() if k[0] == gruppo_id]
-        for k in keys:
-            reminder_cache.pop(k, None)
-            confirmed_cache.add(k)
+    popped = _pop_group_reminders(gruppo_id)
+    keys = [k for k, _info in popped]
 
     if keys:
-        save_cache()
-        update.effective_message.reply_text(
-            "⏹ Solleciti disattivati per i preventivi pendenti in questo gruppo."
+        with metrics.timed("save_state"):
+            store.confirm(keys, _day_key_for(), count_stat=False)
+        rolling.closed(gruppo_id, len(keys))
+        for key, info in popped:
+            _sheet_record(key, info, "solleciti fermati")
+        _reply(update, "⏹ Solleciti disattivati per i preventivi pendenti in questo gruppo.")
+        outbox.send(
+            CONFIRMATION_GROUP_ID,
+            f"⏹ Solleciti disattivati per il gruppo <code>{gruppo_id}</code> da <b>{escape(user)}</b>",
+            on_failed=lambda e: print(f"Errore notifica stop_solleciti: {e}"),
+            parse_mode="HTML",
         )
-        try:
-            bot.send_message(
-                chat_id=CONFIRMATION_GROUP_ID,
-                text=f"⏹ Solleciti disattivati per il gruppo <code>{gruppo_id}</code> da <b>{escape(user)}</b>",
-                parse_mode="HTML",
-            )
-        except Exception as e:
-            print(f"Errore notifica stop_solleciti: {e}")
     else:
-        update.effective_message.reply_text(
-            "Non ci sono preventivi pendenti per questo gruppo."
-        )
+        _reply(update, "Non ci sono preventivi pendenti per questo gruppo.")
 
 
 # === REPORT GIORNALIERO ===
 
 def report_giornaliero(context):
+    if not _is_leader():
+        return
     now = _now_local()
     today = _day_key_for(now)
     yesterday = _day_key_for(now - dt.timedelta(days=1))
 
-    with lock:
-        today_stats = stats_by_day.get(today, {"sent": 0, "confirmed": 0, "expired": 0})
-        y_stats = stats_by_day.get(yesterday, {"sent": 0, "confirmed": 0, "expired": 0})
-        pendenti = len(reminder_cache)
+    view = _stats_view()
+    today_stats = _day_stats(view, today)
+    y_stats = _day_stats(view, yesterday)
+    pendenti = view.pending()
+    week = view.window(today, 7)
+    prev_week = view.window(_day_key_for(now - dt.timedelta(days=7)), 7)
 
     text = (
         f"📈 <b>Report giornaliero preventivi</b>\n"
@@ -517,54 +1282,358 @@ def report_giornaliero(context):
         f"Ieri ({yesterday}):\n"
         f"• Inviati: <b>{y_stats['sent']}</b>\n"
         f"• Confermati: <b>{y_stats['confirmed']}</b>\n"
-        f"• Scaduti: <b>{y_stats['expired']}</b>\n"
+        f"• Scaduti: <b>{y_stats['expired']}</b>\n\n"
+        f"Ultimi 7 giorni: tasso di conferma <b>{_fmt_rate(week['rate'])}</b> "
+        f"(settimana prima {_fmt_rate(prev_week['rate'])})\n"
     )
 
-    try:
-        context.bot.send_message(chat_id=CONFIRMATION_GROUP_ID, text=text, parse_mode="HTML")
-        print("📨 Report giornaliero inviato.")
-    except Exception as e:
-        print(f"Errore invio report giornaliero: {e}")
+    outbox.send(
+        CONFIRMATION_GROUP_ID,
+        text,
+        on_sent=lambda _m: print("📨 Report giornaliero inviato."),
+        on_failed=lambda e: print(f"Errore invio report giornaliero: {e}"),
+        parse_mode="HTML",
+    )
+
+
+def _fmt_rate(rate) -> str:
+    return "n/d" if rate is None else f"{rate:.0%}"
+
+
+def _fmt_ttc(stats: dict) -> str:
+    """Tempo mediano di conferma (limite superiore del bucket)."""
+    if not stats["confirmed_timed"]:
+        return "n/d"
+    seconds = stats["median_ttc"]
+    if seconds is None:
+        return f"oltre {TTC_BUCKETS[-1] // 3600}h"
+    return f"≤ {seconds // 60} min" if seconds < 3600 else f"≤ {seconds / 3600:g}h"
+
+
+def _fmt_delta(current: int, previous: int) -> str:
+    delta = current - previous
+    if not delta:
+        return "="
+    return f"{'▲' if delta > 0 else '▼'} {delta:+d}"
+
+
+REPORT_MAX_GROUPS = 15   # righe per gruppo nel /report (i gruppi con più invii)
+
+
+def _report_window(view: RollingStats, now, days: int) -> str:
+    cur = view.window(_day_key_for(now), days)
+    prev = view.window(_day_key_for(now - dt.timedelta(days=days)), days)
+    return (
+        f"<b>Ultimi {days} giorni</b> (rispetto ai {days} precedenti)\n"
+        f"• Inviati: <b>{cur['sent']}</b> ({_fmt_delta(cur['sent'], prev['sent'])})\n"
+        f"• Confermati: <b>{cur['confirmed']}</b> ({_fmt_delta(cur['confirmed'], prev['confirmed'])})\n"
+        f"• Scaduti: <b>{cur['expired']}</b> ({_fmt_delta(cur['expired'], prev['expired'])})\n"
+        f"• Solleciti inviati: <b>{cur['solleciti']}</b>\n"
+        f"• Tasso di conferma: <b>{_fmt_rate(cur['rate'])}</b> (prima {_fmt_rate(prev['rate'])})\n"
+        f"• Tempo mediano di conferma: <b>{_fmt_ttc(cur)}</b> (prima {_fmt_ttc(prev)})\n"
+    )
+
+
+def cmd_report(update, context):
+    """Andamento a 7 e 30 giorni, con confronto sul periodo precedente e dettaglio per gruppo."""
+    now = _now_local()
+    view = _stats_view()
+    month = view.window(_day_key_for(now), 30)
+
+    groups = sorted(month["groups"].items(), key=lambda item: (-item[1]["sent"], -item[1]["pending"]))
+    lines = [
+        f"• <code>{gid}</code>: inviati {g['sent']}, confermati {g['confirmed']} ({_fmt_rate(g['rate'])}), "
+        f"mediana {_fmt_ttc(g)}, in attesa {g['pending']}"
+        for gid, g in groups[:REPORT_MAX_GROUPS]
+    ]
+    if len(groups) > REPORT_MAX_GROUPS:
+        lines.append(f"… e altri {len(groups) - REPORT_MAX_GROUPS} gruppi")
+
+    text = (
+        f"📈 <b>Report preventivi</b> (al {_day_key_for(now)})\n"
+        f"Attualmente in attesa: <b>{view.pending()}</b>\n\n"
+        + _report_window(view, now, 7)
+        + "\n"
+        + _report_window(view, now, 30)
+        + "\n<b>Per gruppo (30 giorni)</b>\n"
+        + ("\n".join(lines) if lines else "Nessuna attività")
+    )
+    _reply(update, text, parse_mode="HTML")
+
+
+def sheet_flush(context=None):
+    """Scrive sul foglio gli eventi accumulati (vedi SHEET_WRITEBACK_ID)."""
+    if sheet_log is not None:
+        with metrics.timed("sheet_flush"):
+            sheet_log.flush()
 
 
-def tick(context):
+def manutenzione_stato(context=None):
+    """Retention giornaliera dello storico (vedi RETENTION_DAYS)."""
+    if RETENTION_DAYS <= 0 or not _is_leader():
+        return
     try:
-        scan_and_send()
-        invia_sollecito()
+        with metrics.timed("prune"):
+            res = store.prune(RETENTION_DAYS, _day_key_for())
     except Exception:
-        print(f"❌ Errore tick:\n{traceback.format_exc()}")
+        print(f"❌ Errore retention:\n{traceback.format_exc()}")
+        return
+    print(
+        f"🧹 Retention {RETENTION_DAYS}gg: sent -{res['sent']}, confirmed -{res['confirmed']}, "
+        f"cartelle rimosse -{res['gone']}, giorni → mesi {res['days']}"
+    )
 
 
-def main():
-    load_cache()
+# === TEMPI DI AVVIO ===
+# durata di ogni fase dell'avvio; "pronto" e "primo_giro" contati dall'inizio dell'import di main
+STARTUP_PHASES = ("import", "backend", "cluster", "stato", "updater", "pronto", "primo_giro")
+startup_times = {}
+for _phase in STARTUP_PHASES:
+    metrics.gauge(
+        f"startup_{_phase}_seconds",
+        lambda phase=_phase: startup_times.get(phase, 0.0),
+        f"Avvio: fase {_phase} (secondi)",
+    )
+
+
+def _startup_mark(phase: str, t0: float = None):
+    """Registra la fase (una volta sola): durata da t0, oppure tempo dall'import di main."""
+    if phase not in startup_times:
+        startup_times[phase] = time.perf_counter() - (_IMPORT_T0 if t0 is None else t0)
+
+
+def _startup_report() -> str:
+    parts = [f"{phase} {startup_times[phase]:.2f}s" for phase in STARTUP_PHASES if phase in startup_times]
+    init = getattr(drive, "init_seconds", None)
+    if init is not None:
+        parts.append(f"client Drive {init:.2f}s")
+    return " · ".join(parts)
 
-    # assicurati che non ci siano webhook pendenti
+
+# === JOB PERIODICI ===
+# scansione Drive e solleciti girano come job indipendenti: una scansione lenta non ritarda i solleciti
+
+def _drive_quota_errors() -> float:
+    return sum(metrics.counters("drive_quota_errors_total").values())
+
+
+def _next_sollecito_in():
+    """Secondi alla prossima scadenza di un sollecito (None se non ci sono pendenti)."""
+    with lock:
+        when = reminder_cache.next_due()
+    return None if when is None else max(0.0, when - time.time())
+
+
+def _scan_tick() -> int:
     try:
-        bot.delete_webhook()
-    except Exception:
-        pass
+        return scan_and_send()
+    finally:
+        if "primo_giro" not in startup_times:
+            _startup_mark("primo_giro")
+            print(f"⏱ Avvio: {_startup_report()}")
+
+
+scan_job = AdaptiveJob(
+    "scan",
+    _scan_tick,
+    SCAN_INTERVAL,
+    SCAN_INTERVAL_MIN,
+    SCAN_INTERVAL_MAX,
+    metrics=metrics,
+    is_backoff_error=is_quota_error,
+    pressure=_drive_quota_errors,
+)
+sollecito_job = AdaptiveJob(
+    "solleciti",
+    invia_sollecito,
+    SOLLECITO_CHECK_INTERVAL,
+    min(10, SOLLECITO_CHECK_INTERVAL),
+    SOLLECITO_CHECK_INTERVAL,
+    metrics=metrics,
+    wake_hint=_next_sollecito_in,
+)
+
+
+_startup_mark("import")
+
+
+def _start_receiving(updater):
+    if BOT_MODE == "webhook":
+        updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            drop_pending_updates=True,
+        )
+    else:
+        # assicurati che non ci siano webhook pendenti
+        try:
+            bot.delete_webhook()
+        except Exception:
+            pass
+        updater.start_polling(drop_pending_updates=True)
 
-    updater = Updater(token=BOT_TOKEN, use_context=True)
+
+def _run_cluster(updater):
+    """
+    Modalità cluster: i job girano su ogni istanza, gli update Telegram solo su quella che
+    detiene il lease. Se il lease va perso si esce (il supervisore riavvia come secondaria).
+    """
+    stop = Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_args: stop.set())
+
+    updater.job_queue.start()
+    _startup_mark("pronto")
+    receiving = False
+    try:
+        while not stop.is_set():
+            try:
+                leader = cluster.acquire_lease(LEADER_LEASE)
+            except Exception as e:
+                print(f"⚠️ Rinnovo lease fallito: {e}")
+                leader = False
+            if leader and not receiving:
+                print(f"👑 Istanza {INSTANCE_ID}: ricevo gli update Telegram ({BOT_MODE})")
+                _start_receiving(updater)
+                receiving = True
+            elif receiving and not leader:
+                print("⚠️ Lease Telegram perso: esco per non ricevere gli update due volte")
+                break
+            stop.wait(CLUSTER_HEARTBEAT)
+    finally:
+        updater.stop()
+
+
+def startup():
+    """Client, cluster e stato: la parte lenta dell'avvio, da fare una volta sola per processo."""
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise RuntimeError("❌ BOT_MODE=webhook richiede WEBHOOK_SECRET.")
+    t0 = time.perf_counter()
+    if drive is None or bot is None:
+        init_backends()
+    _startup_mark("backend", t0)
+
+    if cluster is not None:
+        t0 = time.perf_counter()
+        cluster.start()
+        print(f"🧩 Istanza {INSTANCE_ID}: attendo la ripartizione dei gruppi...")
+        while not cluster.settled():
+            time.sleep(0.2)
+        cluster.on_change = _on_cluster_change
+        _startup_mark("cluster", t0)
+
+    t0 = time.perf_counter()
+    if store is None:
+        init_store()
+    load_cache()
+    load_topology()
+    _startup_mark("stato", t0)
+
+
+def build_updater():
+    """Updater (polling o webhook) con tutti gli handler registrati."""
+    t0 = time.perf_counter()
+    # python-telegram-bot.ext (APScheduler, tornado) si importa solo qui
+    from telegram.ext import CommandHandler, Filters, MessageHandler, Updater
+
+    if BOT_MODE == "webhook":
+        from webhook import WebhookUpdater
+
+        updater = WebhookUpdater(
+            token=BOT_TOKEN,
+            use_context=True,
+            workers=TG_WORKERS,
+            secret_token=WEBHOOK_SECRET,
+            public_url=WEBHOOK_URL,
+        )
+    else:
+        updater = Updater(token=BOT_TOKEN, use_context=True, workers=TG_WORKERS)
     dp = updater.dispatcher
 
+    # gli handler sono thread-safe: run_async li distribuisce sui TG_WORKERS worker del dispatcher
     # conferme (solo messaggi di testo NON comandi)
-    dp.add_handler(MessageHandler(Filters.text & (~Filters.command), conferma))
+    dp.add_handler(MessageHandler(Filters.text & (~Filters.command), conferma, run_async=True))
 
     # comandi admin
-    dp.add_handler(CommandHandler("stato", cmd_stato))
-    dp.add_handler(CommandHandler("stop_solleciti", cmd_stop_solleciti))
+    dp.add_handler(CommandHandler("stato", cmd_stato, run_async=True))
+    dp.add_handler(CommandHandler("stop_solleciti", cmd_stop_solleciti, run_async=True))
+    dp.add_handler(CommandHandler("perf", cmd_perf, run_async=True))
+    dp.add_handler(CommandHandler("report", cmd_report, run_async=True))
+    _startup_mark("updater", t0)
+    return updater
 
-    # job periodico per scan + solleciti
-    updater.job_queue.run_repeating(tick, interval=CHECK_INTERVAL, first=1)
 
+def schedule_periodic_jobs(job_queue):
     # job giornaliero per report (ora locale definita da TZ_OFFSET_HOURS + DAILY_REPORT_HOUR)
     report_hour_utc = (DAILY_REPORT_HOUR - TZ_OFFSET_HOURS) % 24
     report_time_utc = dt.time(hour=report_hour_utc, minute=0)
-    updater.job_queue.run_daily(report_giornaliero, time=report_time_utc)
+    job_queue.run_daily(report_giornaliero, time=report_time_utc)
+    # retention dello storico: una volta al giorno, la prima poco dopo l'avvio
+    job_queue.run_repeating(manutenzione_stato, interval=24 * 3600, first=600)
+    if sheet_log is not None:
+        job_queue.run_repeating(sheet_flush, interval=SHEET_FLUSH_INTERVAL, first=SHEET_FLUSH_INTERVAL)
+
+
+def start_services():
+    outbox.start()
+    if METRICS_PORT:
+        try:
+            start_http_server(metrics, METRICS_LISTEN, METRICS_PORT)
+            print(f"📈 Metriche su http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            print(f"⚠️ Server metriche non avviato: {e}")
+
+
+def shutdown():
+    scan_job.stop()
+    sollecito_job.stop()
+    # svuota la coda prima di uscire (le consegne aggiornano ancora lo stato)
+    outbox.stop()
+    sheet_flush()
+    # scrive le scritture di stato ancora in attesa
+    if store is not None:
+        store.close()
+    if cluster is not None:
+        # solo ora i gruppi passano alle altre istanze: lo stato è già su SQLite
+        cluster.stop()
+
 
-    print("🚀 BOT preventivi avviato...")
-    updater.start_polling(drop_pending_updates=True)
-    updater.idle()
+def main():
+    if ENGINE == "asyncio":
+        if cluster is not None or BOT_MODE == "webhook":
+            print("⚠️ ENGINE=asyncio non supporta CLUSTER_MODE né webhook: uso il motore a thread")
+        else:
+            # async_engine importa `main`: con `python main.py` deve trovare questo modulo, non ricaricarlo
+            sys.modules.setdefault("main", sys.modules[__name__])
+            try:
+                import async_engine
+            except ImportError as e:
+                print(f"⚠️ ENGINE=asyncio non disponibile ({e}): uso il motore a thread")
+            else:
+                async_engine.run()
+                return
+
+    startup()
+    updater = build_updater()
+
+    # job periodici: scansione Drive e solleciti, ciascuno col proprio intervallo adattivo
+    scan_job.start(updater.job_queue, first=1)
+    sollecito_job.start(updater.job_queue, first=5)
+    schedule_periodic_jobs(updater.job_queue)
+    start_services()
+
+    print(f"🚀 BOT preventivi avviato ({BOT_MODE})...")
+    try:
+        if cluster is not None:
+            _run_cluster(updater)
+        else:
+            _start_receiving(updater)
+            _startup_mark("pronto")
+            # idle() ritorna su SIGTERM (Railway) / SIGINT dopo aver fermato updater e job queue
+            updater.idle()
+    finally:
+        shutdown()
 
 
 if __name__ == "__main__":
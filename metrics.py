@@ -0,0 +1,208 @@
+"""
+Metriche in memoria (contatori, istogrammi di latenza, gauge) esposte in formato
+Prometheus da un piccolo server HTTP locale (GET /metrics).
+"""
+import functools
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# limiti superiori dei bucket di latenza, in secondi
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # l'ultimo è +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """Stima dal limite superiore del bucket (come histogram_quantile, senza interpolazione)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+
+class Metrics:
+    """
+    Registro thread-safe delle metriche del bot.
+
+    timed(nome) si usa come decoratore o context manager: registra latenza, chiamate
+    ed errori (eccezioni propagate) della fase. inc() conta eventi con etichette opzionali,
+    gauge() registra una funzione letta al momento dell'esportazione.
+    """
+
+    def __init__(self, prefix: str = "preventivi", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._hist = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = Lock()
+
+    def observe(self, name: str, seconds: float, error: bool = False):
+        with self._lock:
+            h = self._hist.get(name)
+            if h is None:
+                h = self._hist[name] = _Histogram(self.buckets)
+            h.observe(seconds)
+            if error:
+                h.errors += 1
+
+    def timed(self, name: str):
+        return _Timer(self, name)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, fn, help_text: str = ""):
+        with self._lock:
+            self._gauges[name] = (fn, help_text)
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def counters(self, name: str) -> dict:
+        """Tutti i valori di un contatore: {etichette(tuple): valore}."""
+        with self._lock:
+            return {labels: v for (n, labels), v in self._counters.items() if n == name}
+
+    def phases(self) -> dict:
+        """Riepilogo per fase: chiamate, errori, media, p95, max, ultima (secondi)."""
+        with self._lock:
+            return {
+                name: {
+                    "count": h.count,
+                    "errors": h.errors,
+                    "avg": h.sum / h.count if h.count else 0.0,
+                    "p95": h.quantile(0.95),
+                    "max": h.max,
+                    "last": h.last,
+                }
+                for name, h in sorted(self._hist.items())
+            }
+
+    def gauges(self) -> dict:
+        with self._lock:
+            gauges = dict(self._gauges)
+        out = {}
+        for name, (fn, _help) in sorted(gauges.items()):
+            try:
+                out[name] = float(fn())
+            except Exception:
+                pass
+        return out
+
+    def render(self) -> str:
+        """Testo in formato Prometheus (text exposition 0.0.4)."""
+        p = self.prefix
+        lines = []
+        with self._lock:
+            hists = [(n, h, list(h.counts), h.count, h.sum, h.errors) for n, h in sorted(self._hist.items())]
+            counters = sorted(self._counters.items())
+            gauges = dict(self._gauges)
+
+        if hists:
+            lines.append(f"# HELP {p}_phase_seconds Durata delle fasi del bot")
+            lines.append(f"# TYPE {p}_phase_seconds histogram")
+        for name, h, counts, count, total, _errors in hists:
+            seen = 0
+            for bound, n in zip(h.buckets, counts):
+                seen += n
+                lines.append(f'{p}_phase_seconds_bucket{{phase="{name}",le="{bound}"}} {seen}')
+            lines.append(f'{p}_phase_seconds_bucket{{phase="{name}",le="+Inf"}} {count}')
+            lines.append(f'{p}_phase_seconds_sum{{phase="{name}"}} {total:.6f}')
+            lines.append(f'{p}_phase_seconds_count{{phase="{name}"}} {count}')
+        if hists:
+            lines.append(f"# TYPE {p}_phase_errors_total counter")
+        for name, _h, _c, _n, _s, errors in hists:
+            lines.append(f'{p}_phase_errors_total{{phase="{name}"}} {errors}')
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {p}_{name} counter")
+                typed.add(name)
+            label_txt = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{p}_{name}{{{label_txt}}} {value:g}" if label_txt else f"{p}_{name} {value:g}")
+
+        for name, (fn, help_text) in sorted(gauges.items()):
+            try:
+                value = float(fn())
+            except Exception:
+                continue
+            if help_text:
+                lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self._t0, error=exc_type is not None)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Timer(self.metrics, self.name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def start_http_server(metrics: Metrics, host: str, port: int):
+    """Serve GET /metrics in un thread daemon. Ritorna il server (shutdown() per fermarlo)."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0].rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
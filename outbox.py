@@ -0,0 +1,283 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, Unauthorized
+
+
+SWEEP_INTERVAL = 60.0   # secondi tra due pulizie dei bucket per chat
+
+
+class TokenBucket:
+    """Token bucket classico: `rate` token al secondo, al massimo `capacity` accumulati."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.last:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def wait_time(self, now: float) -> float:
+        """Secondi da attendere prima che sia disponibile un token (0 = subito)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Message:
+    __slots__ = ("seq", "chat_id", "text", "kwargs", "on_sent", "on_failed", "on_dispatch", "enqueued", "attempts")
+
+    def __init__(self, seq, chat_id, text, kwargs, on_sent, on_failed, on_dispatch=None):
+        self.seq = seq
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.on_dispatch = on_dispatch
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class Outbox:
+    """
+    Coda unica per i messaggi Telegram in uscita, servita da un thread dedicato.
+
+    - limite globale (msg/s) e per chat (msg/min) con token bucket;
+    - RetryAfter: il messaggio (e la sua chat) viene ripianificato, non perso;
+    - errori di rete: retry con backoff esponenziale fino a max_retries;
+    - errori definitivi (chat inesistente, bot rimosso, ...): on_failed(exc).
+
+    Le callback on_sent(message) / on_failed(exc) girano nel thread della coda, come
+    on_dispatch(), chiamata una volta subito prima del primo tentativo di invio.
+    """
+
+    def __init__(
+        self,
+        bot,
+        global_rate: float = 25.0,
+        chat_per_minute: int = 20,
+        chat_burst: int = 3,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+    ):
+        self.bot = bot
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        # burst + rate*60 <= chat_per_minute: non si sfora mai il limite sul minuto
+        burst = max(1, min(chat_burst, chat_per_minute))
+        self._chat_rate = max(chat_per_minute - burst, 1) / 60.0
+        self._chat_burst = burst
+        self._chats = {}           # chat_id -> TokenBucket
+        self._blocked_until = {}   # chat_id -> monotonic, da RetryAfter o backoff
+        self._last_sweep = time.monotonic()
+
+        # (pronto_da, seq, _Message): seq resta quello di accodamento anche nei retry,
+        # così a parità di istante vince il messaggio più vecchio e l'ordine per chat si conserva
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+        # metriche
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self._latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    # --- API ---
+
+    def send(self, chat_id, text, on_sent=None, on_failed=None, on_dispatch=None, **kwargs):
+        """Accoda un messaggio (stessi kwargs di bot.send_message)."""
+        with self._cond:
+            msg = _Message(next(self._seq), chat_id, text, kwargs, on_sent, on_failed, on_dispatch)
+            heapq.heappush(self._heap, (msg.enqueued, msg.seq, msg))
+            self._cond.notify()
+
+    def start(self):
+        if self.alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="telegram-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Attende lo svuotamento della coda (max timeout secondi) e ferma il thread."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._heap and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(max(0.0, deadline - time.monotonic()) + 1.0)
+            self._thread = None
+
+    def alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def stats(self) -> dict:
+        with self._cond:
+            depth = len(self._heap)
+        return {
+            "depth": depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "throttled": self.throttled,
+            "latency_avg": (self._latency_total / self.sent) if self.sent else 0.0,
+            "latency_max": self.latency_max,
+            "latency_last": self.latency_last,
+        }
+
+    # --- worker ---
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _sweep(self, now: float):
+        """
+        Toglie (al massimo ogni SWEEP_INTERVAL secondi) i bucket tornati pieni e i blocchi
+        scaduti: equivalgono a una chat mai vista, e senza pulizia i dizionari crescono con
+        ogni chat servita dall'avvio. Va chiamata con _cond acquisito.
+        """
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for chat_id in [c for c, until in self._blocked_until.items() if until <= now]:
+            del self._blocked_until[chat_id]
+        for chat_id in [c for c, b in self._chats.items() if b.full(now) and c not in self._blocked_until]:
+            del self._chats[chat_id]
+
+    def _reschedule(self, msg, when: float):
+        heapq.heappush(self._heap, (when, msg.seq, msg))
+
+    def _next_ready(self):
+        """Estrae il prossimo messaggio inviabile ora, rispettando i limiti (con _cond acquisito)."""
+        while not self._stopping:
+            self._sweep(time.monotonic())
+            if not self._heap:
+                self._cond.wait()
+                continue
+            ready_at, _, msg = self._heap[0]
+            now = time.monotonic()
+            if ready_at > now:
+                self._cond.wait(ready_at - now)
+                continue
+            heapq.heappop(self._heap)
+
+            wait = max(
+                self._blocked_until.get(msg.chat_id, 0.0) - now,
+                self._chat_bucket(msg.chat_id).wait_time(now),
+                self._global.wait_time(now),
+            )
+            if wait > 0:
+                self.throttled += 1
+                self._reschedule(msg, now + wait)
+                continue
+
+            self._chat_bucket(msg.chat_id).consume(now)
+            self._global.consume(now)
+            return msg
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                msg = self._next_ready()
+                # sveglia eventuali stop() in attesa dello svuotamento
+                self._cond.notify_all()
+            if msg is None:
+                return
+            self._deliver(msg)
+
+    def _deliver(self, msg):
+        msg.attempts += 1
+        if msg.attempts == 1 and msg.on_dispatch is not None:
+            try:
+                msg.on_dispatch()
+            except Exception:
+                print(f"❌ Errore callback dispatch:\n{traceback.format_exc()}")
+        try:
+            sent = self.bot.send_message(chat_id=msg.chat_id, text=msg.text, **msg.kwargs)
+        except RetryAfter as e:
+            delay = float(getattr(e, "retry_after", 1) or 1)
+            with self._cond:
+                self.retried += 1
+                until = time.monotonic() + delay
+                self._blocked_until[msg.chat_id] = until
+                self._reschedule(msg, until)
+                self._cond.notify()
+            print(f"⏳ Telegram RetryAfter {delay:.0f}s per chat {msg.chat_id}, messaggio ripianificato")
+            return
+        except (BadRequest, Unauthorized, ChatMigrated) as e:
+            self._fail(msg, e)
+            return
+        except NetworkError as e:
+            if msg.attempts > self.max_retries:
+                self._fail(msg, e)
+                return
+            delay = self.base_backoff * (2 ** (msg.attempts - 1))
+            with self._cond:
+                self.retried += 1
+                until = time.monotonic() + delay
+                self._blocked_until[msg.chat_id] = max(self._blocked_until.get(msg.chat_id, 0.0), until)
+                self._reschedule(msg, until)
+                self._cond.notify()
+            print(f"🔁 Errore rete verso chat {msg.chat_id} ({e}), nuovo tentativo tra {delay:.0f}s")
+            return
+        except Exception as e:
+            self._fail(msg, e)
+            return
+
+        latency = time.monotonic() - msg.enqueued
+        with self._cond:
+            self.sent += 1
+            self._latency_total += latency
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+        if msg.on_sent is not None:
+            try:
+                msg.on_sent(sent)
+            except Exception:
+                print(f"❌ Errore callback invio:\n{traceback.format_exc()}")
+
+    def _fail(self, msg, exc):
+        with self._cond:
+            self.failed += 1
+        if msg.on_failed is not None:
+            try:
+                msg.on_failed(exc)
+            except Exception:
+                print(f"❌ Errore callback fallimento:\n{traceback.format_exc()}")
+        else:
+            print(f"❌ Invio fallito a chat {msg.chat_id}: {exc}")
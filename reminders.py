@@ -0,0 +1,143 @@
+import heapq
+
+
+class PendingReminders:
+    """
+    Solleciti pendenti indicizzati per gruppo: key = (gruppo_id, folder_id) -> info.
+
+    Stessa interfaccia di un dict per gli accessi per chiave, più pop_group()/group_keys()
+    che costano O(pendenti del gruppo) invece di una scansione di tutti i pendenti.
+
+    Tiene anche un min-heap ordinato per scadenza del prossimo sollecito, così pop_due()
+    costa O(scaduti · log n). Le cancellazioni sono pigre: le voci obsolete dello heap
+    vengono scartate quando emergono (o con una ricostruzione se diventano troppe).
+    Non è thread-safe: va usata sotto il lock dello stato.
+    """
+
+    def __init__(self, interval: float, max_count: int):
+        self.interval = interval
+        self.max_count = max_count
+        self._by_group = {}   # gruppo_id -> {folder_id: info}
+        self._size = 0
+        self._heap = []       # (scadenza, gruppo_id, folder_id)
+
+    def due_at(self, info) -> float:
+        """Istante del prossimo passaggio: sollecito n. count+1, o subito il messaggio finale."""
+        count = info["count"]
+        if count >= self.max_count:
+            return info["t0"] + count * self.interval
+        return info["t0"] + (count + 1) * self.interval
+
+    def _push(self, gid, fid, info):
+        heapq.heappush(self._heap, (self.due_at(info), gid, fid))
+        if len(self._heap) > 2 * self._size + 64:
+            self._rebuild()
+
+    def _rebuild(self):
+        self._heap = [
+            (self.due_at(info), gid, fid)
+            for gid, group in self._by_group.items()
+            for fid, info in group.items()
+        ]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        gid, fid = key
+        group = self._by_group.get(gid)
+        return group is not None and fid in group
+
+    def __getitem__(self, key):
+        gid, fid = key
+        return self._by_group[gid][fid]
+
+    def __setitem__(self, key, info):
+        gid, fid = key
+        group = self._by_group.setdefault(gid, {})
+        if fid not in group:
+            self._size += 1
+        group[fid] = info
+        self._push(gid, fid, info)
+
+    def reschedule(self, key):
+        """Da chiamare dopo aver modificato t0/count di una voce già presente."""
+        info = self.get(key)
+        if info is not None:
+            self._push(key[0], key[1], info)
+
+    def pop_due(self, now: float):
+        """
+        Ritorna [(key, info)] delle voci con scadenza <= now, togliendole dallo heap
+        (restano pendenti: il chiamante le rimuove o le aggiorna e chiama reschedule, anche
+        per quelle che non riesce a elaborare, altrimenti non tornano più a scadenza).
+        """
+        due = []
+        seen = set()
+        while self._heap and self._heap[0][0] <= now:
+            when, gid, fid = heapq.heappop(self._heap)
+            info = self.get((gid, fid))
+            # voce cancellata o superata da un reschedule successivo
+            if info is None or self.due_at(info) != when or (gid, fid) in seen:
+                continue
+            seen.add((gid, fid))
+            due.append(((gid, fid), info))
+        return due
+
+    def next_due(self):
+        """Scadenza più vicina tra i pendenti (None se non ce ne sono)."""
+        while self._heap:
+            when, gid, fid = self._heap[0]
+            info = self.get((gid, fid))
+            if info is not None and self.due_at(info) == when:
+                return when
+            heapq.heappop(self._heap)
+        return None
+
+    def get(self, key, default=None):
+        gid, fid = key
+        group = self._by_group.get(gid)
+        if group is None:
+            return default
+        return group.get(fid, default)
+
+    def pop(self, key, default=None):
+        gid, fid = key
+        group = self._by_group.get(gid)
+        if group is None or fid not in group:
+            return default
+        info = group.pop(fid)
+        self._size -= 1
+        if not group:
+            del self._by_group[gid]
+        return info
+
+    def has_group(self, gruppo_id) -> bool:
+        return gruppo_id in self._by_group
+
+    def group_keys(self, gruppo_id):
+        return [(gruppo_id, fid) for fid in self._by_group.get(gruppo_id, ())]
+
+    def pop_group(self, gruppo_id):
+        """Rimuove e ritorna [(key, info)] di tutti i pendenti del gruppo."""
+        group = self._by_group.pop(gruppo_id, None)
+        if not group:
+            return []
+        self._size -= len(group)
+        return [((gruppo_id, fid), info) for fid, info in group.items()]
+
+    def keys(self):
+        return [(gid, fid) for gid, group in self._by_group.items() for fid in group]
+
+    def items(self):
+        return [((gid, fid), info) for gid, group in self._by_group.items() for fid, info in group.items()]
+
+    def update(self, other):
+        for key, info in other.items():
+            self[key] = info
+
+    def clear(self):
+        self._by_group.clear()
+        self._size = 0
+        self._heap = []
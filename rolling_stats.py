@@ -0,0 +1,203 @@
+import datetime as dt
+from bisect import bisect_left
+from threading import Lock
+
+# limiti superiori dei bucket del tempo di conferma, in secondi (l'ultimo bucket è "oltre 72h")
+TTC_BUCKETS = (900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600, 24 * 3600, 48 * 3600, 72 * 3600)
+
+FIELDS = ("sent", "confirmed", "expired", "solleciti")
+_SENT, _CONFIRMED, _EXPIRED, _SOLLECITI = range(len(FIELDS))
+
+
+def ttc_bucket(seconds: float) -> int:
+    """Indice del bucket per un tempo di conferma (len(TTC_BUCKETS) = oltre l'ultimo limite)."""
+    return bisect_left(TTC_BUCKETS, max(0.0, seconds))
+
+
+def ttc_quantile(hist, q: float):
+    """Limite superiore del bucket che contiene il quantile q (None = oltre 72h o nessun dato)."""
+    total = sum(hist)
+    if not total:
+        return None
+    seen = 0
+    for i, n in enumerate(hist):
+        seen += n
+        if seen >= q * total:
+            return TTC_BUCKETS[i] if i < len(TTC_BUCKETS) else None
+    return None
+
+
+def _day_before(day: str, n: int) -> str:
+    return (dt.date.fromisoformat(day) - dt.timedelta(days=n)).isoformat()
+
+
+class RollingStats:
+    """
+    Statistiche per giorno e per gruppo aggiornate a ogni evento (invio, sollecito,
+    conferma, scadenza), così /stato e il report non interrogano SQLite né prendono `lock`:
+    i totali del giorno e i pendenti si leggono in O(1), una finestra di N giorni somma
+    al massimo N giorni già aggregati.
+
+    In memoria restano gli ultimi `days` giorni; la copia persistente (tabelle group_stats e
+    confirm_times di StateStore) viene scritta dalle stesse operazioni che aggiornano lo
+    stato, e load() la ricarica all'avvio.
+    """
+
+    def __init__(self, days: int = 60):
+        self.days = days
+        self._lock = Lock()
+        self._totals = {}    # day -> [sent, confirmed, expired, solleciti]
+        self._groups = {}    # day -> {gruppo_id: [sent, confirmed, expired, solleciti]}
+        self._ttc = {}       # day -> {gruppo_id: [conteggi per bucket]}
+        self._pending = {}   # gruppo_id -> preventivi in attesa di conferma
+        self._pending_total = 0
+
+    # --- caricamento ---
+
+    def load(self, rows, ttc_rows, pending_by_group: dict):
+        """rows: (day, gruppo_id, sent, confirmed, expired, solleciti); ttc_rows: (day, gruppo_id, bucket, n)."""
+        with self._lock:
+            self._totals, self._groups, self._ttc = {}, {}, {}
+            for day, gid, *values in rows:
+                counters = self._counters(day, gid)
+                for i, n in enumerate(values):
+                    counters[i] += n
+                    self._totals[day][i] += n
+            for day, gid, bucket, n in ttc_rows:
+                self._hist(day, gid)[min(int(bucket), len(TTC_BUCKETS))] += n
+            self._trim()
+            self._pending = {gid: n for gid, n in pending_by_group.items() if n > 0}
+            self._pending_total = sum(self._pending.values())
+
+    # --- eventi ---
+
+    def _counters(self, day: str, gruppo_id):
+        if day not in self._totals:
+            self._totals[day] = [0] * len(FIELDS)
+            self._groups[day] = {}
+        counters = self._groups[day].get(gruppo_id)
+        if counters is None:
+            counters = self._groups[day][gruppo_id] = [0] * len(FIELDS)
+        return counters
+
+    def _hist(self, day: str, gruppo_id):
+        hist = self._ttc.setdefault(day, {}).get(gruppo_id)
+        if hist is None:
+            hist = self._ttc[day][gruppo_id] = [0] * (len(TTC_BUCKETS) + 1)
+        return hist
+
+    def _trim(self):
+        extra = len(self._totals) - self.days
+        if extra > 0:
+            for day in sorted(self._totals)[:extra]:
+                self._totals.pop(day, None)
+                self._groups.pop(day, None)
+                self._ttc.pop(day, None)
+
+    def _add(self, day: str, gruppo_id, field: int, n: int = 1):
+        new_day = day not in self._totals
+        self._counters(day, gruppo_id)[field] += n
+        self._totals[day][field] += n
+        if new_day:
+            self._trim()
+
+    def _add_pending(self, gruppo_id, n: int):
+        current = self._pending.get(gruppo_id, 0)
+        n = max(n, -current)
+        if current + n:
+            self._pending[gruppo_id] = current + n
+        else:
+            self._pending.pop(gruppo_id, None)
+        self._pending_total += n
+
+    def sent(self, gruppo_id, day: str):
+        with self._lock:
+            self._add(day, gruppo_id, _SENT)
+            self._add_pending(gruppo_id, 1)
+
+    def reminded(self, gruppo_id, day: str):
+        with self._lock:
+            self._add(day, gruppo_id, _SOLLECITI)
+
+    def expired(self, gruppo_id, day: str):
+        with self._lock:
+            self._add(day, gruppo_id, _EXPIRED)
+            self._add_pending(gruppo_id, -1)
+
+    def confirmed(self, gruppo_id, day: str, times):
+        """times: secondi dall'invio alla conferma, uno per preventivo confermato."""
+        times = list(times)
+        with self._lock:
+            self._add(day, gruppo_id, _CONFIRMED, len(times))
+            hist = self._hist(day, gruppo_id)
+            for seconds in times:
+                hist[ttc_bucket(seconds)] += 1
+            self._add_pending(gruppo_id, -len(times))
+
+    def closed(self, gruppo_id, n: int):
+        """Pendenti chiusi senza conferma (/stop_solleciti)."""
+        with self._lock:
+            self._add_pending(gruppo_id, -n)
+
+    # --- letture ---
+
+    def day(self, day: str) -> dict:
+        with self._lock:
+            values = self._totals.get(day) or [0] * len(FIELDS)
+        return dict(zip(FIELDS, values))
+
+    def covers(self, day: str) -> bool:
+        """
+        True se il giorno è tutto nelle statistiche per gruppo. Il primo giorno con dati può
+        essere parziale (aggiornamento a metà giornata): per quello, per i giorni precedenti e
+        per quelli importati da migrate_json fa fede la tabella stats di StateStore.
+        """
+        with self._lock:
+            return day in self._totals and day > min(self._totals)
+
+    def pending(self) -> int:
+        return self._pending_total
+
+    def window(self, end_day: str, days: int) -> dict:
+        """
+        Totali dei `days` giorni che finiscono con end_day (compreso), per gruppo e in tutto:
+        {campo: n, "rate": confermati/(confermati+scaduti), "median_ttc": secondi|None,
+         "groups": {gruppo_id: {... come sopra, "pending": n}}}.
+        """
+        totals = [0] * len(FIELDS)
+        hist = [0] * (len(TTC_BUCKETS) + 1)
+        groups = {}
+        group_hist = {}
+        with self._lock:
+            for i in range(days):
+                day = _day_before(end_day, i)
+                if day not in self._totals:
+                    continue
+                for k, n in enumerate(self._totals[day]):
+                    totals[k] += n
+                for gid, counters in self._groups[day].items():
+                    acc = groups.setdefault(gid, [0] * len(FIELDS))
+                    for k, n in enumerate(counters):
+                        acc[k] += n
+                for gid, h in self._ttc.get(day, {}).items():
+                    acc = group_hist.setdefault(gid, [0] * len(hist))
+                    for k, n in enumerate(h):
+                        acc[k] += n
+                        hist[k] += n
+            pending = dict(self._pending)
+
+        def _summary(values, h):
+            out = dict(zip(FIELDS, values))
+            closed = out["confirmed"] + out["expired"]
+            out["rate"] = out["confirmed"] / closed if closed else None
+            out["median_ttc"] = ttc_quantile(h, 0.5)
+            out["confirmed_timed"] = sum(h)
+            return out
+
+        result = _summary(totals, hist)
+        result["groups"] = {}
+        for gid in set(groups) | set(pending):
+            summary = _summary(groups.get(gid, [0] * len(FIELDS)), group_hist.get(gid, [0] * len(hist)))
+            summary["pending"] = pending.get(gid, 0)
+            result["groups"][gid] = summary
+        return result
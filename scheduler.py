@@ -1,15 +1,129 @@
-import time
-import subprocess
+import os
+import signal
+import threading
+import traceback
 
-print("✅ Avvio scheduler.py attivo")
+from telegram.ext import JobQueue
 
-# Loop infinito per eseguire main.py ciclicamente
-while True:
-    print("🔁 Avvio nuovo ciclo main.py")
+import main
+from supervisor import Supervisor
+
+# controlli del supervisore (secondi); in cluster non oltre l'heartbeat, che rinnova anche il lease
+SUPERVISOR_CHECK_INTERVAL = float(os.getenv("SUPERVISOR_CHECK_INTERVAL", "5"))
+SUPERVISOR_BACKOFF_MIN = float(os.getenv("SUPERVISOR_BACKOFF_MIN", "1"))
+SUPERVISOR_BACKOFF_MAX = float(os.getenv("SUPERVISOR_BACKOFF_MAX", "300"))
+# un job è bloccato se il giro previsto tarda (o quello in corso supera l'intervallo massimo) di tanto
+JOB_STALL_GRACE = float(os.getenv("JOB_STALL_GRACE", "600"))
+
+# Un solo processo: client Drive/Telegram, credenziali e stato si caricano una volta sola.
+# Se un componente (ricezione update, job di scansione, job solleciti, coda invii) smette
+# di funzionare viene riavviato solo lui, con backoff, invece di rilanciare main.py.
+
+receiver = {"running": False}
+
+
+def _poller_alive(updater) -> bool:
+    # il thread di polling/webhook di python-telegram-bot si chiama "Bot:<id>:updater"
+    return updater.running and any(
+        t.name.endswith(":updater") and t.is_alive() for t in threading.enumerate()
+    )
+
+
+def _wants_updates() -> bool:
+    """Senza cluster sempre; in cluster solo con il lease (rinnovato a ogni controllo)."""
+    if main.cluster is None:
+        return True
     try:
-        subprocess.run(["python", "main.py"], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Errore esecuzione main.py: {e}")
+        return main.cluster.acquire_lease(main.LEADER_LEASE)
+    except Exception as e:
+        print(f"⚠️ Rinnovo lease fallito: {e}")
+        return False
+
+
+def _start_receiver(updater):
+    if _wants_updates():
+        main._start_receiving(updater)
+        receiver["running"] = True
+
+
+def _stop_receiver(updater):
+    receiver["running"] = False
+    updater.stop()
+
+
+def _receiver_healthy(updater) -> bool:
+    wanted = _wants_updates()
+    if receiver["running"] and not wanted:
+        print("⚠️ Lease Telegram perso: smetto di ricevere gli update")
+        _stop_receiver(updater)
+        return True
+    if wanted and not receiver["running"]:
+        print(f"👑 Istanza {main.INSTANCE_ID}: ricevo gli update Telegram ({main.BOT_MODE})")
+        _start_receiver(updater)
+        return True
+    return not receiver["running"] or _poller_alive(updater)
+
+
+def run():
+    print("✅ Avvio scheduler.py (supervisore nel processo)")
+    main.startup()
+    updater = main.build_updater()
+
+    # i job hanno una JobQueue propria: riavviare la ricezione degli update non li ferma
+    job_queue = JobQueue()
+    job_queue.set_dispatcher(updater.dispatcher)
+    job_queue.start()
+    main.schedule_periodic_jobs(job_queue)
+
+    check_interval = SUPERVISOR_CHECK_INTERVAL
+    if main.cluster is not None:
+        check_interval = min(check_interval, main.CLUSTER_HEARTBEAT)
+    supervisor = Supervisor(
+        main.metrics,
+        check_interval=check_interval,
+        backoff_min=SUPERVISOR_BACKOFF_MIN,
+        backoff_max=SUPERVISOR_BACKOFF_MAX,
+    )
+    supervisor.add("outbox", main.outbox.start, main.outbox.alive)
+    supervisor.add(
+        "scan",
+        lambda: main.scan_job.start(job_queue, first=1),
+        lambda: main.scan_job.healthy(JOB_STALL_GRACE),
+        stop=main.scan_job.stop,
+    )
+    supervisor.add(
+        "solleciti",
+        lambda: main.sollecito_job.start(job_queue, first=5),
+        lambda: main.sollecito_job.healthy(JOB_STALL_GRACE),
+        stop=main.sollecito_job.stop,
+    )
+    supervisor.add(
+        "ricezione",
+        lambda: _start_receiver(updater),
+        lambda: _receiver_healthy(updater),
+        stop=lambda: _stop_receiver(updater),
+    )
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_args: stop.set())
+
+    main.start_services()
+    print(f"🚀 BOT preventivi avviato ({main.BOT_MODE}, supervisionato)...")
+    try:
+        supervisor.start()
+        main._startup_mark("pronto")
+        supervisor.run(stop)
+    except Exception:
+        print(f"❌ Supervisore interrotto:\n{traceback.format_exc()}")
+        raise
+    finally:
+        if receiver["running"]:
+            _stop_receiver(updater)
+        job_queue.stop()
+        main.shutdown()
+        print(f"👋 Riavvii durante l'esecuzione: {supervisor.stats()}")
+
 
-    # Aspetta 5 minuti prima del nuovo ciclo
-    time.sleep(300)
+if __name__ == "__main__":
+    run()
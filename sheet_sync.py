@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+
+
+def column_letter(index: int) -> str:
+    """1 → A, 27 → AA."""
+    letters = ""
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _row_hash(values) -> str:
+    return hashlib.blake2b("\x1f".join(values).encode("utf-8"), digest_size=8).hexdigest()
+
+
+class SheetSync:
+    """
+    Lettura incrementale di un foglio Google (gspread Worksheet).
+
+    Ogni sync() fa UNA chiamata batch_get con le sole colonne che servono: la cella di
+    intestazione di ognuna (verifica che le colonne non si siano spostate) e le righe da
+    `recent_rows` righe prima dell'ultima nota in giù, cioè le righe nuove più le ultime,
+    quelle che di solito cambiano. Una lettura completa si fa al primo sync(), ogni
+    `full_every` sync() (modifiche nelle righe vecchie), se cambia l'intestazione o se la
+    finestra torna più corta del previsto (righe cancellate).
+
+    Per ogni riga si tiene un hash dei valori: le righe già viste e non cambiate non vengono
+    riconvertite, sync() ritorna solo quelle nuove o modificate. Indice delle righe e lettere
+    delle colonne sono salvati in state_file, così dopo un riavvio non si riparte da zero.
+    """
+
+    def __init__(self, worksheet, columns, state_file: str, header_row: int = 1,
+                 recent_rows: int = 100, full_every: int = 10):
+        self.worksheet = worksheet
+        self.columns = list(columns)
+        self.state_file = state_file
+        self.header_row = header_row
+        self.recent_rows = max(1, recent_rows)
+        self.full_every = max(1, full_every)
+
+        self._letters = {}      # nome colonna -> lettera
+        self._rows = []         # per riga di dati: [hash, record]
+        self.last_row = header_row
+
+        # contatori dall'avvio
+        self.syncs = 0
+        self.reads = 0
+        self.full_reads = 0
+        self.changed = 0
+        self.skipped = 0
+        self._load()
+
+    # --- persistenza ---
+
+    def _load(self):
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("columns") != self.columns:
+                return
+            self._letters = dict(data.get("letters") or {})
+            self._rows = [[str(h), dict(rec)] for h, rec in data.get("rows") or []]
+            self.last_row = self.header_row + len(self._rows)
+        except Exception as e:
+            print(f"⚠️ Stato foglio non leggibile ({self.state_file}), lo ignoro: {e}")
+            self._letters, self._rows = {}, []
+
+    def save(self):
+        payload = {"columns": self.columns, "letters": self._letters, "rows": self._rows}
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp, self.state_file)
+
+    # --- lettura ---
+
+    def _resolve_columns(self):
+        header = [h.strip() for h in self.worksheet.row_values(self.header_row)]
+        letters = {}
+        for name in self.columns:
+            if name not in header:
+                raise KeyError(f"Colonna '{name}' non trovata nell'intestazione del foglio")
+            letters[name] = column_letter(header.index(name) + 1)
+        self._letters = letters
+
+    def _read_columns(self, first_row: int):
+        """(intestazione, [valori per riga da first_row in giù]) con una sola batch_get."""
+        letters = [self._letters[name] for name in self.columns]
+        ranges = [f"{L}{self.header_row}" for L in letters] + [f"{L}{first_row}:{L}" for L in letters]
+        self.reads += 1
+        result = self.worksheet.batch_get(ranges)
+        cols = [[str(cell[0]).strip() if cell else "" for cell in value_range] for value_range in result]
+        header = [c[0] if c else "" for c in cols[: len(letters)]]
+        data = cols[len(letters):]
+        n = max((len(c) for c in data), default=0)
+        return header, [[c[i] if i < len(c) else "" for c in data] for i in range(n)]
+
+    def sync(self):
+        """
+        Legge il foglio e ritorna [(numero riga, record)] delle righe nuove o cambiate.
+        record = {nome colonna: valore (stringa)}.
+        """
+        if not self._letters:
+            self._resolve_columns()
+        full = not self._rows or self.syncs % self.full_every == 0
+        self.syncs += 1
+        # indice (in _rows) della prima riga letta
+        first = 0 if full else max(0, len(self._rows) - self.recent_rows)
+        header, window = self._read_columns(self.header_row + 1 + first)
+        if header != self.columns:
+            # colonne spostate o rinominate: si rilegge l'intestazione e si riparte da capo
+            self._resolve_columns()
+            self._rows = []
+            first, full = 0, True
+            header, window = self._read_columns(self.header_row + 1)
+        elif first + len(window) < len(self._rows):
+            # meno righe di prima: cancellate sopra la finestra, gli indici non valgono più
+            first, full = 0, True
+            header, window = self._read_columns(self.header_row + 1)
+        if full:
+            self.full_reads += 1
+
+        changed = []
+        rows = self._rows[:first]
+        for i, values in enumerate(window, start=first):
+            h = _row_hash(values)
+            if i < len(self._rows) and self._rows[i][0] == h:
+                rows.append(self._rows[i])
+                self.skipped += 1
+                continue
+            record = dict(zip(self.columns, values))
+            rows.append([h, record])
+            changed.append((self.header_row + 1 + i, record))
+
+        self.changed += len(changed)
+        dirty = bool(changed) or len(rows) != len(self._rows)
+        self._rows = rows
+        self.last_row = self.header_row + len(rows)
+        if dirty:
+            self.save()
+        return changed
+
+    def records(self):
+        """Tutte le righe dell'ultima lettura (senza chiamate)."""
+        return [rec for _h, rec in self._rows]
+
+    def stats(self) -> dict:
+        return {
+            "reads": self.reads,
+            "full_reads": self.full_reads,
+            "rows": len(self._rows),
+            "changed": self.changed,
+            "skipped": self.skipped,
+        }
@@ -0,0 +1,151 @@
+import traceback
+from threading import Lock
+
+from sheet_sync import SheetSync, column_letter
+
+# colonne del foglio dei preventivi (le stesse lette da bot_link_preventivi_drive.py)
+COL_NOME = "Nome Preventivo"
+COL_GRUPPO = "ID Gruppo"
+COL_CONFERMATO = "Confermato"
+# facoltative: scritte solo se lo staff le ha aggiunte all'intestazione
+COL_STATO = "Stato"
+COL_SOLLECITI = "Solleciti"
+COL_AGGIORNATO = "Aggiornato"
+WRITE_COLUMNS = (COL_CONFERMATO, COL_STATO, COL_SOLLECITI, COL_AGGIORNATO)
+
+STATO_CONFERMATO = "confermato"
+CONFERMATO = "Sì"
+
+
+def sheet_key(gruppo_id, nome) -> tuple:
+    return (str(gruppo_id).strip(), str(nome).strip())
+
+
+class SheetWriteBack:
+    """
+    Stato dei preventivi scritto nelle righe del foglio letto da bot_link_preventivi_drive.py:
+    Confermato = Sì alla conferma, più Stato, Solleciti e Aggiornato se il foglio ha quelle
+    colonne. Gli eventi (invio, sollecito, conferma, scadenza) vengono solo accumulati, per
+    ogni preventivo conta l'ultimo, e flush() li scrive con UNA batch_update.
+
+    La riga di ogni preventivo (ID Gruppo + Nome Preventivo) viene dall'indice di una
+    SheetSync su quelle due colonne, salvato in state_file: prima di scrivere si rilegge solo
+    la coda del foglio (righe nuove e ultime), tutto solo ogni tanto o se il foglio si è
+    accorciato, così una riga cancellata non fa finire lo stato sulla riga sbagliata.
+    I preventivi senza una riga nel foglio vengono scartati (contati in unmatched).
+
+    open_worksheet() viene chiamato al primo flush (nel thread del job).
+    """
+
+    def __init__(self, open_worksheet, state_file: str, max_rows: int = 500, metrics=None, header_row: int = 1):
+        self.open_worksheet = open_worksheet
+        self.state_file = state_file
+        self.max_rows = max(1, max_rows)
+        self.metrics = metrics
+        self.header_row = header_row
+        self._ws = None
+        self._sync = None
+        self._letters = {}       # colonna scritta -> lettera
+        self._index = {}         # (gruppo, nome) -> numero di riga
+        self._pending = {}       # (gruppo, nome) -> {colonna: valore} (l'ultimo evento vince)
+        self._lock = Lock()
+        self._flush_lock = Lock()
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.unmatched = 0
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, gruppo_id, nome: str, stato: str, solleciti: int, aggiornato):
+        """aggiornato: datetime dell'evento nel fuso del bot (main._now_local), come report e statistiche."""
+        values = {
+            COL_STATO: stato,
+            COL_SOLLECITI: int(solleciti),
+            COL_AGGIORNATO: aggiornato.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if stato == STATO_CONFERMATO:
+            # gli altri stati non toccano Confermato: può averlo messo a mano lo staff
+            values[COL_CONFERMATO] = CONFERMATO
+        with self._lock:
+            self._pending[sheet_key(gruppo_id, nome)] = values
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _call(self, fn, *args, **kwargs):
+        self.calls += 1
+        if self.metrics is not None:
+            self.metrics.inc("sheet_requests_total")
+        return fn(*args, **kwargs)
+
+    def _refresh(self):
+        """Aggiorna l'indice delle righe con una lettura incrementale (vedi SheetSync)."""
+        if self._ws is None:
+            self._ws = self.open_worksheet()
+            self._sync = SheetSync(self._ws, [COL_GRUPPO, COL_NOME], self.state_file, header_row=self.header_row)
+        full_reads = self._sync.full_reads
+        changed = self._call(self._sync.sync)
+        if self._sync.full_reads != full_reads or not self._letters:
+            # colonne ricontrollate insieme alle letture complete (spostate, aggiunte)
+            header = [h.strip() for h in self._call(self._ws.row_values, self.header_row)]
+            if COL_CONFERMATO not in header:
+                raise KeyError(f"Colonna '{COL_CONFERMATO}' non trovata nell'intestazione del foglio")
+            self._letters = {name: column_letter(header.index(name) + 1) for name in WRITE_COLUMNS if name in header}
+        if changed or self._sync.full_reads != full_reads or not self._index:
+            first = self.header_row + 1
+            self._index = {
+                sheet_key(rec[COL_GRUPPO], rec[COL_NOME]): first + i
+                for i, rec in enumerate(self._sync.records())
+                if rec[COL_NOME]
+            }
+
+    def flush(self) -> int:
+        """Scrive le righe in attesa (max max_rows per volta). Ritorna quante ne ha scritte."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                keys = list(self._pending)[: self.max_rows]
+                batch = {k: self._pending.pop(k) for k in keys}
+
+            try:
+                self._refresh()
+                data = []
+                written = 0
+                for key, values in batch.items():
+                    row = self._index.get(key)
+                    if row is None:
+                        self.unmatched += 1
+                        continue
+                    for name, value in values.items():
+                        if name in self._letters:
+                            data.append({"range": f"{self._letters[name]}{row}", "values": [[value]]})
+                    written += 1
+                if data:
+                    self._call(self._ws.batch_update, data, value_input_option="RAW")
+            except Exception:
+                self.errors += 1
+                if self.metrics is not None:
+                    self.metrics.inc("sheet_errors_total")
+                with self._lock:
+                    # le righe tornano in coda, a meno che nel frattempo non sia arrivato un evento più recente
+                    for k, values in batch.items():
+                        self._pending.setdefault(k, values)
+                print(f"❌ Scrittura foglio fallita ({len(batch)} righe), riprovo al prossimo giro:\n{traceback.format_exc()}")
+                return 0
+
+            self.flushes += 1
+            self.rows_written += written
+            return written
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending(),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "unmatched": self.unmatched,
+            "calls": self.calls,
+            "errors": self.errors,
+        }
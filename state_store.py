@@ -0,0 +1,526 @@
+import datetime as dt
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from dedup import BloomFilter, pruned_key, sent_key
+from rolling_stats import FIELDS as GROUP_STAT_FIELDS, ttc_bucket
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sent (
+    gruppo_id INTEGER NOT NULL,
+    folder_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    PRIMARY KEY (gruppo_id, folder_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS confirmed (
+    gruppo_id INTEGER NOT NULL,
+    folder_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    PRIMARY KEY (gruppo_id, folder_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS reminders (
+    gruppo_id INTEGER NOT NULL,
+    folder_id TEXT NOT NULL,
+    t0 REAL NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    link TEXT NOT NULL DEFAULT '',
+    nome TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (gruppo_id, folder_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stats (
+    day TEXT PRIMARY KEY,
+    sent INTEGER NOT NULL DEFAULT 0,
+    confirmed INTEGER NOT NULL DEFAULT 0,
+    expired INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+-- preventivi in uscita non ancora consegnati (intento registrato prima dell'invio)
+CREATE TABLE IF NOT EXISTS intents (
+    gruppo_id INTEGER NOT NULL,
+    folder_id TEXT NOT NULL,
+    nome TEXT NOT NULL DEFAULT '',
+    link TEXT NOT NULL DEFAULT '',
+    ts REAL NOT NULL,
+    dispatched INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (gruppo_id, folder_id)
+) WITHOUT ROWID;
+
+-- statistiche giornaliere oltre la finestra di retention, sommate per mese (YYYY-MM)
+CREATE TABLE IF NOT EXISTS stats_monthly (
+    month TEXT PRIMARY KEY,
+    sent INTEGER NOT NULL DEFAULT 0,
+    confirmed INTEGER NOT NULL DEFAULT 0,
+    expired INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+-- cartelle preventivo cestinate/rimosse su Drive (dalla Changes API): solo queste possono uscire da sent/confirmed
+CREATE TABLE IF NOT EXISTS gone (
+    folder_id TEXT PRIMARY KEY,
+    ts REAL NOT NULL
+) WITHOUT ROWID;
+
+-- cartelle potate da sent con la retention: solo l'id, perché un ripristino dal cestino non le rimandi
+CREATE TABLE IF NOT EXISTS pruned (
+    folder_id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+
+-- statistiche per giorno e gruppo (report a 7/30 giorni), potate con la retention
+CREATE TABLE IF NOT EXISTS group_stats (
+    day TEXT NOT NULL,
+    gruppo_id INTEGER NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    confirmed INTEGER NOT NULL DEFAULT 0,
+    expired INTEGER NOT NULL DEFAULT 0,
+    solleciti INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, gruppo_id)
+) WITHOUT ROWID;
+
+-- tempi dall'invio alla conferma, contati per bucket (rolling_stats.TTC_BUCKETS)
+CREATE TABLE IF NOT EXISTS confirm_times (
+    day TEXT NOT NULL,
+    gruppo_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    n INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, gruppo_id, bucket)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+STAT_FIELDS = ("sent", "confirmed", "expired")
+
+
+class StateStore:
+    """
+    Stato persistente del bot su SQLite (WAL): ogni evento scrive solo le righe che cambia,
+    in una transazione. In memoria resta solo ciò che serve (i solleciti pendenti);
+    sent/confirmed si interrogano per chiave primaria, con davanti un filtro di Bloom
+    che risponde da solo ai "mai inviato" (le cartelle nuove di ogni scansione).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # le scritture arrivano a lotti (WriteBehindStore): FULL costa poco e rende durevole ogni commit
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self.bloom_skips = 0
+        self._rebuild_bloom()
+
+    def reload_bloom(self):
+        """Ricarica il filtro: serve quando altri processi scrivono sullo stesso database."""
+        self._rebuild_bloom()
+
+    def _rebuild_bloom(self):
+        """Ricarica il filtro da sent e pruned (all'avvio, dopo migrazione/potatura o se saturo)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT (SELECT count(*) FROM sent) + (SELECT count(*) FROM pruned)"
+            ).fetchone()[0]
+            bloom = BloomFilter(max(10000, 2 * rows))
+            for gid, fid in self._conn.execute("SELECT gruppo_id, folder_id FROM sent"):
+                bloom.add(sent_key(gid, fid))
+            for (fid,) in self._conn.execute("SELECT folder_id FROM pruned"):
+                bloom.add(pruned_key(fid))
+            self._bloom = bloom
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- meta ---
+
+    def get_meta(self, key: str, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value):
+        with self._lock, self._conn:
+            self._op_set_meta(key, value)
+
+    def _op_set_meta(self, key: str, value):
+        if value is None:
+            self._conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+        else:
+            self._conn.execute(
+                "INSERT INTO meta(key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, str(value)),
+            )
+
+    # --- letture ---
+
+    def is_sent(self, gruppo_id: int, folder_id: str) -> bool:
+        with self._lock:
+            maybe_sent = sent_key(gruppo_id, folder_id) in self._bloom
+            maybe_pruned = pruned_key(folder_id) in self._bloom
+            if not maybe_sent and not maybe_pruned:
+                self.bloom_skips += 1
+                return False
+            if maybe_sent and self._conn.execute(
+                "SELECT 1 FROM sent WHERE gruppo_id = ? AND folder_id = ?", (gruppo_id, folder_id)
+            ).fetchone():
+                return True
+            # potata dalla retention e poi ripristinata dal cestino: resta già inviata
+            return maybe_pruned and self._conn.execute(
+                "SELECT 1 FROM pruned WHERE folder_id = ?", (folder_id,)
+            ).fetchone() is not None
+
+    def load_reminders(self) -> dict:
+        """key -> {"t0", "count", "link", "nome"} per tutti i solleciti pendenti."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT gruppo_id, folder_id, t0, count, link, nome FROM reminders"
+            ).fetchall()
+        return {
+            (int(gid), str(fid)): {"t0": float(t0), "count": int(count), "link": link, "nome": nome}
+            for gid, fid, t0, count, link, nome in rows
+        }
+
+    def group_reminders(self, gruppo_id: int) -> dict:
+        """Solleciti pendenti di un solo gruppo (stesso formato di load_reminders)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT folder_id, t0, count, link, nome FROM reminders WHERE gruppo_id = ?", (gruppo_id,)
+            ).fetchall()
+        return {
+            (int(gruppo_id), str(fid)): {"t0": float(t0), "count": int(count), "link": link, "nome": nome}
+            for fid, t0, count, link, nome in rows
+        }
+
+    def pending_groups(self) -> set:
+        """Gruppi con almeno un sollecito pendente."""
+        with self._lock:
+            return {int(gid) for (gid,) in self._conn.execute("SELECT DISTINCT gruppo_id FROM reminders")}
+
+    def pending_reminder_keys(self, keys) -> set:
+        """Le chiavi di keys che hanno ancora un sollecito pendente (non confermate altrove)."""
+        with self._lock:
+            return {
+                (gid, fid)
+                for gid, fid in keys
+                if self._conn.execute(
+                    "SELECT 1 FROM reminders WHERE gruppo_id = ? AND folder_id = ?", (gid, fid)
+                ).fetchone()
+            }
+
+    def load_intents(self) -> dict:
+        """key -> {"nome", "link", "ts", "dispatched"} dei preventivi non ancora consegnati."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT gruppo_id, folder_id, nome, link, ts, dispatched FROM intents"
+            ).fetchall()
+        return {
+            (int(gid), str(fid)): {"nome": nome, "link": link, "ts": float(ts), "dispatched": bool(dispatched)}
+            for gid, fid, nome, link, ts, dispatched in rows
+        }
+
+    def get_stats(self, day: str) -> dict:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sent, confirmed, expired FROM stats WHERE day = ?", (day,)
+            ).fetchone()
+        if not row:
+            return {"sent": 0, "confirmed": 0, "expired": 0}
+        return {"sent": row[0], "confirmed": row[1], "expired": row[2]}
+
+    def load_group_stats(self, since_day: str):
+        """Righe di group_stats e confirm_times dal giorno since_day compreso (per RollingStats.load)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, gruppo_id, sent, confirmed, expired, solleciti FROM group_stats WHERE day >= ?",
+                (since_day,),
+            ).fetchall()
+            ttc_rows = self._conn.execute(
+                "SELECT day, gruppo_id, bucket, n FROM confirm_times WHERE day >= ?", (since_day,)
+            ).fetchall()
+        return rows, ttc_rows
+
+    # --- scritture ---
+    # ogni metodo pubblico è una transazione; apply() esegue più operazioni _op_* in una sola
+
+    def apply(self, ops):
+        """Esegue [(nome, args)] (nomi dei metodi di scrittura) in un'unica transazione."""
+        with self._lock, self._conn:
+            for name, args in ops:
+                getattr(self, f"_op_{name}")(*args)
+
+    def _inc_stat(self, day: str, field: str, n: int):
+        if field not in STAT_FIELDS:
+            raise ValueError(f"statistica sconosciuta: {field}")
+        if n <= 0:
+            return
+        self._conn.execute(
+            f"INSERT INTO stats(day, {field}) VALUES (?, ?) "
+            f"ON CONFLICT(day) DO UPDATE SET {field} = {field} + excluded.{field}",
+            (day, n),
+        )
+
+    def _inc_group_stat(self, day: str, gruppo_id: int, field: str, n: int = 1):
+        if field not in GROUP_STAT_FIELDS:
+            raise ValueError(f"statistica sconosciuta: {field}")
+        if n <= 0:
+            return
+        self._conn.execute(
+            f"INSERT INTO group_stats(day, gruppo_id, {field}) VALUES (?, ?, ?) "
+            f"ON CONFLICT(day, gruppo_id) DO UPDATE SET {field} = {field} + excluded.{field}",
+            (day, gruppo_id, n),
+        )
+
+    def record_sent(self, gruppo_id: int, folder_id: str, info: dict, day: str):
+        """Preventivo consegnato: riga in sent, sollecito pendente e statistica del giorno."""
+        with self._lock, self._conn:
+            self._op_record_sent(gruppo_id, folder_id, info, day)
+
+    def _op_record_sent(self, gruppo_id: int, folder_id: str, info: dict, day: str):
+        self._conn.execute(
+            "INSERT OR IGNORE INTO sent(gruppo_id, folder_id, ts) VALUES (?, ?, ?)",
+            (gruppo_id, folder_id, time.time()),
+        )
+        # se la transazione venisse annullata resta solo un falso positivo, verificato su SQLite
+        self._bloom.add(sent_key(gruppo_id, folder_id))
+        if self._bloom.full():
+            self._rebuild_bloom()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO reminders(gruppo_id, folder_id, t0, count, link, nome) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (gruppo_id, folder_id, info["t0"], info["count"], info["link"], info["nome"]),
+        )
+        self._inc_stat(day, "sent", 1)
+        self._inc_group_stat(day, gruppo_id, "sent")
+        self._conn.execute(
+            "DELETE FROM intents WHERE gruppo_id = ? AND folder_id = ?", (gruppo_id, folder_id)
+        )
+
+    def _op_intent(self, gruppo_id: int, folder_id: str, nome: str, link: str, ts: float):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO intents(gruppo_id, folder_id, nome, link, ts, dispatched) "
+            "VALUES (?, ?, ?, ?, ?, 0)",
+            (gruppo_id, folder_id, nome, link, ts),
+        )
+
+    def _op_dispatched(self, keys):
+        self._conn.executemany(
+            "UPDATE intents SET dispatched = 1 WHERE gruppo_id = ? AND folder_id = ?", keys
+        )
+
+    def _op_drop_intent(self, gruppo_id: int, folder_id: str):
+        self._conn.execute(
+            "DELETE FROM intents WHERE gruppo_id = ? AND folder_id = ?", (gruppo_id, folder_id)
+        )
+
+    def _op_gone(self, folder_ids, ts: float):
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO gone(folder_id, ts) VALUES (?, ?)", [(fid, ts) for fid in folder_ids]
+        )
+
+    def _op_restored(self, folder_ids):
+        self._conn.executemany("DELETE FROM gone WHERE folder_id = ?", [(fid,) for fid in folder_ids])
+
+    def update_reminder_count(self, gruppo_id: int, folder_id: str, count: int, day: str = None):
+        """Sollecito inviato; con day viene anche contato nelle statistiche del gruppo."""
+        with self._lock, self._conn:
+            self._op_update_reminder_count(gruppo_id, folder_id, count, day)
+
+    def _op_update_reminder_count(self, gruppo_id: int, folder_id: str, count: int, day: str = None):
+        self._conn.execute(
+            "UPDATE reminders SET count = ? WHERE gruppo_id = ? AND folder_id = ?",
+            (count, gruppo_id, folder_id),
+        )
+        if day is not None:
+            self._inc_group_stat(day, gruppo_id, "solleciti")
+
+    def expire(self, gruppo_id: int, folder_id: str, day: str):
+        """Solleciti esauriti senza risposta."""
+        with self._lock, self._conn:
+            self._op_expire(gruppo_id, folder_id, day)
+
+    def _op_expire(self, gruppo_id: int, folder_id: str, day: str):
+        self._conn.execute(
+            "DELETE FROM reminders WHERE gruppo_id = ? AND folder_id = ?", (gruppo_id, folder_id)
+        )
+        self._inc_stat(day, "expired", 1)
+        self._inc_group_stat(day, gruppo_id, "expired")
+
+    def confirm(self, keys, day: str, count_stat: bool = True):
+        """Chiude i solleciti di keys come confermati (count_stat=False per /stop_solleciti)."""
+        keys = list(keys)
+        if not keys:
+            return
+        with self._lock, self._conn:
+            self._op_confirm(keys, day, count_stat)
+
+    def _op_confirm(self, keys, day: str, count_stat: bool = True):
+        now = time.time()
+        if count_stat:
+            self._count_confirmed(keys, day, now)
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO confirmed(gruppo_id, folder_id, ts) VALUES (?, ?, ?)",
+            [(gid, fid, now) for gid, fid in keys],
+        )
+        self._conn.executemany(
+            "DELETE FROM reminders WHERE gruppo_id = ? AND folder_id = ?", keys
+        )
+
+    def _count_confirmed(self, keys, day: str, now: float):
+        """Statistiche di una conferma: per giorno, per gruppo e tempo dall'invio (t0 del sollecito)."""
+        self._inc_stat(day, "confirmed", len(keys))
+        per_group = {}
+        buckets = {}
+        for gid, fid in keys:
+            per_group[gid] = per_group.get(gid, 0) + 1
+            row = self._conn.execute(
+                "SELECT t0 FROM reminders WHERE gruppo_id = ? AND folder_id = ?", (gid, fid)
+            ).fetchone()
+            if row is not None:
+                bucket = (gid, ttc_bucket(now - row[0]))
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+        for gid, n in per_group.items():
+            self._inc_group_stat(day, gid, "confirmed", n)
+        self._conn.executemany(
+            "INSERT INTO confirm_times(day, gruppo_id, bucket, n) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(day, gruppo_id, bucket) DO UPDATE SET n = n + excluded.n",
+            [(day, gid, bucket, n) for (gid, bucket), n in buckets.items()],
+        )
+
+    # --- retention ---
+
+    def prune(self, retention_days: int, today: str, now: float = None) -> dict:
+        """
+        Toglie da sent/confirmed le chiavi più vecchie di retention_days la cui cartella è
+        stata cestinata o rimossa su Drive (tabella gone), e somma nelle statistiche mensili
+        i giorni più vecchi della finestra. Le cartelle ancora su Drive restano per sempre;
+        di quelle potate resta l'id in pruned, così se tornano dal cestino non si rimandano.
+        """
+        now = time.time() if now is None else now
+        cutoff = now - retention_days * 86400
+        cutoff_day = (dt.date.fromisoformat(today) - dt.timedelta(days=retention_days)).isoformat()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO pruned(folder_id) SELECT folder_id FROM sent "
+                "WHERE ts < ? AND folder_id IN (SELECT folder_id FROM gone WHERE ts < ?)",
+                (cutoff, cutoff),
+            )
+            sent = self._conn.execute(
+                "DELETE FROM sent WHERE ts < ? AND folder_id IN (SELECT folder_id FROM gone WHERE ts < ?)",
+                (cutoff, cutoff),
+            ).rowcount
+            confirmed = self._conn.execute(
+                "DELETE FROM confirmed WHERE ts < ? AND folder_id IN (SELECT folder_id FROM gone WHERE ts < ?)",
+                (cutoff, cutoff),
+            ).rowcount
+            gone = self._conn.execute(
+                "DELETE FROM gone WHERE ts < ? AND folder_id NOT IN (SELECT folder_id FROM sent) "
+                "AND folder_id NOT IN (SELECT folder_id FROM confirmed)",
+                (cutoff,),
+            ).rowcount
+            self._conn.execute(
+                "INSERT INTO stats_monthly(month, sent, confirmed, expired) "
+                "SELECT substr(day, 1, 7), sum(sent), sum(confirmed), sum(expired) FROM stats "
+                "WHERE day < ? GROUP BY substr(day, 1, 7) "
+                "ON CONFLICT(month) DO UPDATE SET sent = sent + excluded.sent, "
+                "confirmed = confirmed + excluded.confirmed, expired = expired + excluded.expired",
+                (cutoff_day,),
+            )
+            days = self._conn.execute("DELETE FROM stats WHERE day < ?", (cutoff_day,)).rowcount
+            self._conn.execute("DELETE FROM group_stats WHERE day < ?", (cutoff_day,))
+            self._conn.execute("DELETE FROM confirm_times WHERE day < ?", (cutoff_day,))
+        if sent:
+            self._rebuild_bloom()
+        return {"sent": sent, "confirmed": confirmed, "gone": gone, "days": days}
+
+    def get_monthly_stats(self) -> dict:
+        """month (YYYY-MM) -> statistiche dei mesi già usciti dalla finestra giornaliera."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT month, sent, confirmed, expired FROM stats_monthly ORDER BY month"
+            ).fetchall()
+        return {m: {"sent": s, "confirmed": c, "expired": e} for m, s, c, e in rows}
+
+    def counts(self) -> dict:
+        with self._lock:
+            counts = {
+                table: self._conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+                for table in ("sent", "confirmed", "reminders", "gone", "pruned", "stats")
+            }
+        counts["bloom_skips"] = self.bloom_skips
+        return counts
+
+    # --- migrazione dal vecchio bot_cache.json ---
+
+    def migrate_json(self, json_path: str) -> bool:
+        """
+        Importa una sola volta il vecchio file JSON e lo rinomina in *.migrated.
+        Ritorna True se la migrazione è avvenuta.
+        """
+        if self.get_meta("json_migrated") or not os.path.exists(json_path):
+            return False
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        now = time.time()
+        sent, confirmed, reminders, stats = [], [], [], []
+        for entry in data.get("sent", []):
+            try:
+                gid, fid = entry
+                sent.append((int(gid), str(fid), now))
+            except Exception:
+                pass
+        for entry in data.get("confirmed", []):
+            try:
+                gid, fid = entry
+                confirmed.append((int(gid), str(fid), now))
+            except Exception:
+                pass
+        for r in data.get("reminders", []):
+            try:
+                reminders.append((
+                    int(r["gruppo_id"]),
+                    str(r["folder_id"]),
+                    float(r.get("t0", now)),
+                    int(r.get("count", 0)),
+                    str(r.get("link", "")),
+                    str(r.get("nome", "")),
+                ))
+            except Exception:
+                pass
+        raw_stats = data.get("stats_by_day", {})
+        if isinstance(raw_stats, dict):
+            for day, s in raw_stats.items():
+                try:
+                    stats.append((str(day), int(s.get("sent", 0)), int(s.get("confirmed", 0)), int(s.get("expired", 0))))
+                except Exception:
+                    pass
+
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO sent VALUES (?, ?, ?)", sent)
+            self._conn.executemany("INSERT OR IGNORE INTO confirmed VALUES (?, ?, ?)", confirmed)
+            self._conn.executemany("INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?, ?, ?)", reminders)
+            self._conn.executemany("INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?)", stats)
+            token = data.get("changes_token")
+            if token:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta(key, value) VALUES ('changes_token', ?)", (str(token),)
+                )
+            self._conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('json_migrated', ?)", (str(now),))
+
+        self._rebuild_bloom()
+        os.replace(json_path, json_path + ".migrated")
+        print(
+            f"📦 Migrata cache JSON → SQLite: sent={len(sent)} confirmed={len(confirmed)} "
+            f"pending={len(reminders)} days_stats={len(stats)}"
+        )
+        return True
@@ -0,0 +1,90 @@
+import time
+import traceback
+
+
+class _Component:
+    __slots__ = ("name", "start", "stop", "healthy", "restarts", "failures", "next_restart", "restarted_at")
+
+    def __init__(self, name, start, stop, healthy):
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.healthy = healthy
+        self.restarts = 0
+        self.failures = 0          # riavvii consecutivi, azzerati quando il componente resta sano
+        self.next_restart = 0.0
+        self.restarted_at = 0.0
+
+
+class Supervisor:
+    """
+    Supervisore nel processo: controlla ogni check_interval secondi i componenti registrati
+    e riavvia SOLO quello non sano (stop + start), senza toccare client e stato già caricati.
+
+    Tra due riavvii dello stesso componente l'attesa raddoppia da backoff_min a backoff_max;
+    dopo stable_after secondi senza problemi si riparte da backoff_min. I riavvii sono
+    contati in component_restarts_total{component=...}.
+    """
+
+    def __init__(self, metrics=None, check_interval: float = 5.0, backoff_min: float = 1.0,
+                 backoff_max: float = 300.0, stable_after: float = 600.0):
+        self.metrics = metrics
+        self.check_interval = check_interval
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self._components = []
+
+    def add(self, name: str, start, healthy, stop=None):
+        self._components.append(_Component(name, start, stop, healthy))
+
+    def start(self):
+        for c in self._components:
+            c.start()
+
+    def stop(self):
+        for c in reversed(self._components):
+            if c.stop is not None:
+                try:
+                    c.stop()
+                except Exception as e:
+                    print(f"⚠️ Arresto {c.name} fallito: {e}")
+
+    def check(self):
+        """Un giro di controllo: riavvia i componenti non sani il cui backoff è scaduto."""
+        now = time.monotonic()
+        for c in self._components:
+            try:
+                ok = c.healthy()
+            except Exception:
+                print(f"⚠️ Controllo {c.name} fallito:\n{traceback.format_exc()}")
+                ok = False
+            if ok:
+                if c.failures and now - c.restarted_at >= self.stable_after:
+                    c.failures = 0
+                continue
+            if now < c.next_restart:
+                continue
+
+            c.restarts += 1
+            c.failures += 1
+            c.restarted_at = now
+            delay = min(self.backoff_max, self.backoff_min * 2 ** (c.failures - 1))
+            c.next_restart = now + delay
+            if self.metrics is not None:
+                self.metrics.inc("component_restarts_total", component=c.name)
+            print(f"🔄 Riavvio {c.name} (n. {c.restarts}, prossimo possibile tra {delay:g}s)")
+            try:
+                if c.stop is not None:
+                    c.stop()
+                c.start()
+            except Exception:
+                print(f"❌ Riavvio {c.name} fallito:\n{traceback.format_exc()}")
+
+    def run(self, stop_event):
+        """Controlla i componenti finché stop_event non viene impostato."""
+        while not stop_event.wait(self.check_interval):
+            self.check()
+
+    def stats(self) -> dict:
+        return {c.name: c.restarts for c in self._components}
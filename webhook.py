@@ -0,0 +1,85 @@
+import hmac
+
+import tornado.web
+from telegram.ext import Updater
+from telegram.ext.utils.webhookhandler import WebhookHandler, WebhookServer
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class SecretWebhookHandler(WebhookHandler):
+    """WebhookHandler di python-telegram-bot che in più verifica l'header secret_token."""
+
+    def initialize(self, bot, update_queue, secret_token: str = "") -> None:
+        super().initialize(bot, update_queue)
+        self.secret_token = secret_token
+
+    def _validate_post(self) -> None:
+        super()._validate_post()
+        if self.secret_token:
+            got = self.request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(got.encode(), self.secret_token.encode()):
+                raise tornado.web.HTTPError(403)
+
+
+class SecretWebhookApp(tornado.web.Application):
+    def __init__(self, webhook_path: str, bot, update_queue, secret_token: str):
+        shared = {"bot": bot, "update_queue": update_queue, "secret_token": secret_token}
+        tornado.web.Application.__init__(self, [(rf"{webhook_path}/?", SecretWebhookHandler, shared)])
+
+    def log_request(self, handler) -> None:
+        pass
+
+
+class WebhookUpdater(Updater):
+    """
+    Updater con webhook protetto da secret_token (la v13 non lo verifica da sola).
+
+    start_webhook() resta quello di python-telegram-bot (dispatcher, job queue, idle/stop);
+    cambia solo il server: handler con verifica dell'header e registrazione del webhook
+    con secret_token. Se public_url è vuoto il webhook NON viene registrato su Telegram,
+    così si può provare in locale postando update JSON registrati.
+    """
+
+    def __init__(self, *args, secret_token: str = "", public_url: str = "", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.secret_token = secret_token
+        self.public_url = public_url
+
+    def _start_webhook(
+        self,
+        listen,
+        port,
+        url_path,
+        cert,
+        key,
+        bootstrap_retries,
+        drop_pending_updates,
+        webhook_url,
+        allowed_updates,
+        ready=None,
+        ip_address=None,
+        max_connections: int = 40,
+    ):
+        if not url_path.startswith("/"):
+            url_path = f"/{url_path}"
+
+        app = SecretWebhookApp(url_path, self.bot, self.update_queue, self.secret_token)
+        self.httpd = WebhookServer(listen, port, app, None)
+
+        if self.public_url:
+            try:
+                self.bot.set_webhook(
+                    url=self.public_url.rstrip("/") + url_path,
+                    allowed_updates=allowed_updates,
+                    drop_pending_updates=drop_pending_updates,
+                    max_connections=max_connections,
+                    secret_token=self.secret_token or None,
+                )
+            except Exception as e:
+                # il server parte comunque: si può correggere la configurazione senza riavvio
+                print(f"❌ Registrazione webhook fallita: {e}")
+        else:
+            print("ℹ️ WEBHOOK_URL non impostato: webhook non registrato su Telegram (modalità locale)")
+
+        self.httpd.serve_forever(ready=ready)
@@ -0,0 +1,56 @@
+"""
+Invia al webhook locale degli update Telegram registrati (JSON), per provare BOT_MODE=webhook
+senza passare da Telegram.
+
+    BOT_MODE=webhook WEBHOOK_SECRET=prova python main.py        # WEBHOOK_URL vuoto: niente registrazione
+    WEBHOOK_SECRET=prova python webhook_replay.py update1.json updates.json ...
+
+Ogni file contiene un update oppure una lista di update (come restituiti da getUpdates).
+"""
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from webhook import SECRET_HEADER
+
+
+def post_update(url: str, secret: str, update: dict) -> int:
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode("utf-8"),
+        headers={"Content-Type": "application/json", SECRET_HEADER: secret},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    port = os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443"))
+    path = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+    url = os.getenv("WEBHOOK_REPLAY_URL", f"http://127.0.0.1:{port}/{path}")
+    secret = os.getenv("WEBHOOK_SECRET", "")
+
+    for name in sys.argv[1:]:
+        with open(name, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        updates = data if isinstance(data, list) else [data]
+        for update in updates:
+            t0 = time.perf_counter()
+            status = post_update(url, secret, update)
+            ms = (time.perf_counter() - t0) * 1000
+            print(f"{name} update_id={update.get('update_id')} → HTTP {status} ({ms:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import time
+import traceback
+from threading import Condition, Lock, Thread
+
+
+class _Batch:
+    """Operazioni non ancora scritte, più gli indici per leggerle prima del flush."""
+
+    def __init__(self):
+        self.ops = []
+        self.sent = set()    # (gruppo_id, folder_id) registrati come inviati
+        self.meta = {}       # chiave -> valore (None = cancellata)
+        self.t0 = 0.0        # monotonic della prima operazione
+        self.last_seq = 0    # ultimo evento del journal compreso nel lotto
+
+    def add(self, name: str, args: tuple):
+        if not self.ops:
+            self.t0 = time.monotonic()
+        self.ops.append((name, args))
+
+    def merge_front(self, older: "_Batch"):
+        """Rimette in testa le operazioni di un flush fallito."""
+        self.ops[:0] = older.ops
+        self.sent |= older.sent
+        for key, value in older.meta.items():
+            self.meta.setdefault(key, value)
+        self.t0 = older.t0 if older.ops else self.t0
+        self.last_seq = max(self.last_seq, older.last_seq)
+
+
+class WriteBehindStore:
+    """
+    Scritture differite sopra StateStore: i metodi di scrittura accodano l'operazione e
+    tornano subito, un thread le scrive in UNA transazione quando sono passati max_delay
+    secondi dalla prima in attesa o quando ce ne sono max_pending.
+
+    Il lotto in attesa viene scambiato con uno vuoto sotto un lock interno minimo; la
+    scrittura su SQLite avviene fuori da qualunque lock dei chiamanti. is_sent() e
+    get_meta() vedono anche le operazioni non ancora scritte; le altre letture fanno
+    prima un flush. close() (o flush()) scrive tutto: va chiamato allo spegnimento.
+
+    Con un journal (journal.Journal) ogni operazione viene prima aggiunta al journal come
+    evento: dopo un crash recover() riapplica gli eventi non ancora nello snapshot SQLite.
+    A ogni flush il segmento corrente viene chiuso, e dopo il commit i segmenti già
+    compresi nello snapshot (meta journal_seq) vengono cancellati.
+    """
+
+    def __init__(self, store, max_delay: float = 2.0, max_pending: int = 500, metrics=None, journal=None,
+                 seq_key: str = "journal_seq"):
+        self.store = store
+        self.journal = journal
+        # con più processi sullo stesso database ognuno ha il suo journal e la sua chiave
+        self.seq_key = seq_key
+        if journal is not None:
+            journal.advance_to(int(store.get_meta(seq_key) or 0))
+        self.path = store.path
+        self.max_delay = max_delay
+        self.max_pending = max(1, max_pending)
+        self.metrics = metrics
+
+        self._batch = _Batch()
+        self._inflight = None
+        self._cond = Condition(Lock())
+        self._flush_lock = Lock()
+        self._closed = False
+
+        self.flushes = 0
+        self.ops_written = 0
+        self.errors = 0
+        self.last_flush_s = 0.0
+
+        self._thread = Thread(target=self._run, name="state-flush", daemon=True)
+        self._thread.start()
+
+    # --- scritture (accodate) ---
+
+    def _enqueue(self, name: str, args: tuple, event: str, sent_key=None, meta=None, sync: bool = False):
+        with self._cond:
+            if self.journal is not None:
+                self._batch.last_seq = self.journal.append(event, [name, list(args)])
+            self._batch.add(name, args)
+            if sent_key is not None:
+                self._batch.sent.add(sent_key)
+            if meta is not None:
+                self._batch.meta[meta[0]] = meta[1]
+            if len(self._batch.ops) == 1 or len(self._batch.ops) >= self.max_pending:
+                self._cond.notify()
+        if sync and self.journal is not None:
+            # l'evento deve essere su disco prima che il chiamante prosegua
+            self.journal.sync()
+
+    def record_sent(self, gruppo_id: int, folder_id: str, info: dict, day: str):
+        self._enqueue(
+            "record_sent", (gruppo_id, folder_id, dict(info), day), "sent", sent_key=(gruppo_id, folder_id)
+        )
+
+    def update_reminder_count(self, gruppo_id: int, folder_id: str, count: int, day: str = None):
+        self._enqueue("update_reminder_count", (gruppo_id, folder_id, count, day), "reminded")
+
+    def expire(self, gruppo_id: int, folder_id: str, day: str):
+        self._enqueue("expire", (gruppo_id, folder_id, day), "expired")
+
+    def confirm(self, keys, day: str, count_stat: bool = True):
+        keys = [list(k) for k in keys]
+        if keys:
+            self._enqueue("confirm", (keys, day, count_stat), "confirmed" if count_stat else "stopped")
+
+    def set_meta(self, key: str, value):
+        self._enqueue("set_meta", (key, value), "meta", meta=(key, value))
+
+    def record_intent(self, gruppo_id: int, folder_id: str, nome: str, link: str):
+        """Preventivo in uscita, registrato prima di accodarlo per l'invio."""
+        self._enqueue("intent", (gruppo_id, folder_id, nome, link, time.time()), "intent")
+
+    def record_dispatch(self, keys):
+        """Invio in corso: dopo un crash questi preventivi si considerano consegnati (fsync immediato)."""
+        keys = [list(k) for k in keys]
+        if keys:
+            self._enqueue("dispatched", (keys,), "dispatched", sync=True)
+
+    def drop_intent(self, gruppo_id: int, folder_id: str):
+        self._enqueue("drop_intent", (gruppo_id, folder_id), "dropped")
+
+    def mark_gone(self, folder_ids):
+        """Cartelle cestinate/rimosse su Drive: candidate alla retention."""
+        folder_ids = list(folder_ids)
+        if folder_ids:
+            self._enqueue("gone", (folder_ids, time.time()), "gone")
+
+    def mark_restored(self, folder_ids):
+        folder_ids = list(folder_ids)
+        if folder_ids:
+            self._enqueue("restored", (folder_ids,), "restored")
+
+    # --- letture ---
+
+    def is_sent(self, gruppo_id: int, folder_id: str) -> bool:
+        key = (gruppo_id, folder_id)
+        with self._cond:
+            if key in self._batch.sent or (self._inflight is not None and key in self._inflight.sent):
+                return True
+        return self.store.is_sent(gruppo_id, folder_id)
+
+    def get_meta(self, key: str, default=None):
+        with self._cond:
+            for batch in (self._batch, self._inflight):
+                if batch is not None and key in batch.meta:
+                    value = batch.meta[key]
+                    return default if value is None else str(value)
+        return self.store.get_meta(key, default)
+
+    def load_reminders(self) -> dict:
+        self.flush()
+        return self.store.load_reminders()
+
+    def load_intents(self) -> dict:
+        self.flush()
+        return self.store.load_intents()
+
+    def get_stats(self, day: str) -> dict:
+        self.flush()
+        return self.store.get_stats(day)
+
+    def migrate_json(self, json_path: str) -> bool:
+        self.flush()
+        return self.store.migrate_json(json_path)
+
+    def prune(self, retention_days: int, today: str) -> dict:
+        self.flush()
+        return self.store.prune(retention_days, today)
+
+    def get_monthly_stats(self) -> dict:
+        self.flush()
+        return self.store.get_monthly_stats()
+
+    def load_group_stats(self, since_day: str):
+        self.flush()
+        return self.store.load_group_stats(since_day)
+
+    def group_reminders(self, gruppo_id: int) -> dict:
+        self.flush()
+        return self.store.group_reminders(gruppo_id)
+
+    def pending_groups(self) -> set:
+        self.flush()
+        return self.store.pending_groups()
+
+    def pending_reminder_keys(self, keys) -> set:
+        self.flush()
+        return self.store.pending_reminder_keys(keys)
+
+    def reload_bloom(self):
+        self.flush()
+        self.store.reload_bloom()
+
+    def counts(self) -> dict:
+        return self.store.counts()
+
+    # --- journal ---
+
+    def recover(self) -> int:
+        """Riapplica allo snapshot gli eventi del journal successivi a meta journal_seq (all'avvio)."""
+        if self.journal is None:
+            return 0
+        self.flush()
+        applied = int(self.store.get_meta(self.seq_key) or 0)
+        self.journal.rotate()
+        events = list(self.journal.events_after(applied))
+        if events:
+            last = events[-1]["seq"]
+            ops = [(e["args"][0], tuple(e["args"][1])) for e in events]
+            ops.append(("set_meta", (self.seq_key, last)))
+            self.store.apply(ops)
+            applied = last
+        self.journal.compact(applied)
+        return len(events)
+
+    # --- flush ---
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._batch.ops)
+
+    def flush(self) -> int:
+        """Scrive subito le operazioni in attesa. Ritorna quante ne sono state scritte."""
+        with self._flush_lock:
+            with self._cond:
+                batch = self._batch
+                if not batch.ops:
+                    return 0
+                self._batch = _Batch()
+                self._inflight = batch
+                if self.journal is not None:
+                    # gli eventi del lotto restano nei segmenti chiusi fino al commit
+                    self.journal.rotate()
+
+            ops = batch.ops
+            if self.journal is not None and batch.last_seq:
+                ops = ops + [("set_meta", (self.seq_key, batch.last_seq))]
+            t0 = time.perf_counter()
+            try:
+                if self.metrics is not None:
+                    with self.metrics.timed("state_flush"):
+                        self.store.apply(ops)
+                else:
+                    self.store.apply(ops)
+            except Exception:
+                # la transazione è annullata per intero: il lotto torna in coda e verrà ritentato
+                self.errors += 1
+                with self._cond:
+                    self._batch.merge_front(batch)
+                    self._inflight = None
+                print(f"❌ Salvataggio stato fallito ({len(batch.ops)} operazioni), riprovo:\n{traceback.format_exc()}")
+                return 0
+
+            with self._cond:
+                self._inflight = None
+            if self.journal is not None and batch.last_seq:
+                self.journal.compact(batch.last_seq)
+            self.flushes += 1
+            self.ops_written += len(batch.ops)
+            self.last_flush_s = time.perf_counter() - t0
+            return len(batch.ops)
+
+    def _due(self) -> bool:
+        ops = self._batch.ops
+        return bool(ops) and (
+            len(ops) >= self.max_pending or time.monotonic() - self._batch.t0 >= self.max_delay
+        )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    if self._batch.ops:
+                        self._cond.wait(max(0.0, self._batch.t0 + self.max_delay - time.monotonic()))
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            if self.flush() == 0 and self.pending():
+                # flush fallito: non ritentare a raffica
+                time.sleep(self.max_delay)
+
+    def close(self):
+        """Ferma il thread, scrive le operazioni in attesa e chiude il database."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
+        self.store.close()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending(),
+            "flushes": self.flushes,
+            "ops_written": self.ops_written,
+            "errors": self.errors,
+            "last_flush_ms": self.last_flush_s * 1000,
+        }